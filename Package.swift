@@ -20,9 +20,12 @@ let package = Package(
         .package(url: "https://github.com/tidepool-org/LoopAlgorithm.git", branch: "main"),
     ],
     targets: [
+        .target(
+            name: "CLoopAlgorithmToPython"
+        ),
         .target(
             name: "LoopAlgorithmToPython",
-            dependencies: ["LoopAlgorithm"]
+            dependencies: ["LoopAlgorithm", "CLoopAlgorithmToPython"]
         ),
         .testTarget(
             name: "LoopAlgorithmToPythonTests",
@@ -0,0 +1,66 @@
+// The types are declared in include/CLoopAlgorithmToPython.h. The profiling counters are kept in C, because Swift has
+// no portable atomics without an extra package dependency.
+#include "CLoopAlgorithmToPython.h"
+
+#include <stdatomic.h>
+
+static atomic_int profilingEnabled;
+static _Atomic int64_t profilingCalls[LoopStageCount];
+static _Atomic int64_t profilingTotal[LoopStageCount];
+static _Atomic int64_t profilingMax[LoopStageCount];
+static _Atomic int64_t profilingHistogram[LoopStageCount][LOOP_PROFILING_BUCKETS];
+
+int32_t loopProfilingIsEnabled(void) {
+    return atomic_load_explicit(&profilingEnabled, memory_order_relaxed);
+}
+
+void loopProfilingSetEnabled(int32_t enabled) {
+    atomic_store(&profilingEnabled, enabled != 0);
+}
+
+static int profilingBucket(int64_t nanoseconds) {
+    int64_t microseconds = nanoseconds / 1000;
+    int bucket = 0;
+    while (microseconds > 0 && bucket < LOOP_PROFILING_BUCKETS - 1) {
+        microseconds >>= 1;
+        bucket++;
+    }
+    return bucket;
+}
+
+void loopProfilingRecord(int32_t stage, int64_t nanoseconds) {
+    if (stage < 0 || stage >= LoopStageCount) {
+        return;
+    }
+    atomic_fetch_add_explicit(&profilingCalls[stage], 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&profilingTotal[stage], nanoseconds, memory_order_relaxed);
+    atomic_fetch_add_explicit(&profilingHistogram[stage][profilingBucket(nanoseconds)], 1, memory_order_relaxed);
+    int64_t max = atomic_load_explicit(&profilingMax[stage], memory_order_relaxed);
+    while (nanoseconds > max &&
+           !atomic_compare_exchange_weak_explicit(&profilingMax[stage], &max, nanoseconds, memory_order_relaxed,
+                                                  memory_order_relaxed)) {
+    }
+}
+
+void loopProfilingCopyStats(LoopProfilingStats *stats) {
+    for (int stage = 0; stage < LoopStageCount; stage++) {
+        stats->calls[stage] = atomic_load_explicit(&profilingCalls[stage], memory_order_relaxed);
+        stats->totalNanoseconds[stage] = atomic_load_explicit(&profilingTotal[stage], memory_order_relaxed);
+        stats->maxNanoseconds[stage] = atomic_load_explicit(&profilingMax[stage], memory_order_relaxed);
+        for (int bucket = 0; bucket < LOOP_PROFILING_BUCKETS; bucket++) {
+            stats->histogram[stage][bucket] = atomic_load_explicit(&profilingHistogram[stage][bucket],
+                                                                   memory_order_relaxed);
+        }
+    }
+}
+
+void loopProfilingReset(void) {
+    for (int stage = 0; stage < LoopStageCount; stage++) {
+        atomic_store(&profilingCalls[stage], 0);
+        atomic_store(&profilingTotal[stage], 0);
+        atomic_store(&profilingMax[stage], 0);
+        for (int bucket = 0; bucket < LOOP_PROFILING_BUCKETS; bucket++) {
+            atomic_store(&profilingHistogram[stage][bucket], 0);
+        }
+    }
+}
@@ -0,0 +1,137 @@
+//
+//  CLoopAlgorithmToPython.h
+//  LoopAlgorithmToPython
+//
+//  C types shared between the Swift exports and their callers.
+//  Buffers returned by the library are owned by the caller and must be released with the matching free function.
+//
+
+#ifndef CLoopAlgorithmToPython_h
+#define CLoopAlgorithmToPython_h
+
+#include <stdint.h>
+
+/// Version of the interface declared here and of the exported functions. Bump it whenever a type or an export
+/// signature changes, so that callers can refuse a library that was built from older sources.
+#define LOOP_ABI_VERSION 2
+
+/// An array of doubles allocated by the library. Release with freeLoopDoubleArray.
+typedef struct {
+    double *values;
+    int64_t count;
+} LoopDoubleArray;
+
+/// A NUL-terminated UTF-8 string allocated by the library. Release with freeLoopString.
+typedef struct {
+    char *data;
+    int64_t length;
+} LoopString;
+
+/// Values with their dates in seconds since 1970, both of length count. Release with freeLoopTimeSeries.
+typedef struct {
+    double *values;
+    double *dates;
+    int64_t count;
+} LoopTimeSeries;
+
+/// Several time series in one buffer. Series i is at the positions offsets[i] to offsets[i + 1] of series, and
+/// offsets has count + 1 entries. Release with freeLoopTimeSeriesBatch.
+typedef struct {
+    LoopTimeSeries series;
+    int64_t *offsets;
+    int64_t count;
+} LoopTimeSeriesBatch;
+
+/// Carb absorption models selectable by getDynamicCarbsOnBoardSeries
+enum {
+    LoopAbsorptionPiecewiseLinear = 0,
+    LoopAbsorptionLinear = 1,
+    LoopAbsorptionParabolic = 2,
+};
+
+/// All outputs of one LoopAlgorithm run. Glucose series are in mg/dL, insulin counteraction effects in mg/dL·s.
+/// activeCarbs is NaN if the algorithm returned none. If the dose recommendation failed, recommendation is empty and
+/// recommendationError holds the reason. Release with freeLoopAlgorithmResult.
+typedef struct {
+    LoopTimeSeries prediction;
+    LoopTimeSeries insulinCounteractionEffects;
+    LoopTimeSeries insulinEffects;
+    LoopTimeSeries carbEffects;
+    LoopTimeSeries retrospectiveCorrectionEffects;
+    LoopTimeSeries momentumEffects;
+    double activeInsulin;
+    double activeCarbs;
+    LoopString recommendation;
+    LoopString recommendationError;
+} LoopAlgorithmResult;
+
+/// One LoopAlgorithmResult per settings combination of a sweep, in the order of the combinations. Release with
+/// freeLoopSweepResult.
+typedef struct {
+    LoopAlgorithmResult *results;
+    int64_t count;
+} LoopSweepResult;
+
+/// Per-step outputs of runReplay, each array with count values. Doses are NaN when none was recommended, and
+/// predictions holds horizonCount predicted glucose values (mg/dL) per step, step by step. status is LoopErrorNone
+/// for steps that ran, LoopErrorInvalidInput for steps without glucose readings, and LoopErrorAlgorithm if the dose
+/// recommendation failed. Release with freeLoopReplayResult.
+typedef struct {
+    double *dates;
+    double *automaticBolus;
+    double *tempBasalRate;
+    double *tempBasalDuration;
+    double *manualBolus;
+    double *activeInsulin;
+    double *activeCarbs;
+    double *predictions;
+    int32_t *status;
+    int64_t count;
+    int64_t horizonCount;
+} LoopReplayResult;
+
+/// Error codes reported through LoopError
+enum {
+    LoopErrorNone = 0,
+    LoopErrorInvalidInput = 1,
+    LoopErrorDecoding = 2,
+    LoopErrorAlgorithm = 3,
+};
+
+/// Filled in by every export that can fail. code is LoopErrorNone on success. Otherwise message is allocated by the
+/// library and must be released with freeLoopError, and the returned value is empty.
+typedef struct {
+    int32_t code;
+    char *message;
+} LoopError;
+
+/// Stages timed by the native profiling counters
+enum {
+    LoopStageDecode = 0,     // JSON decoding, or converting columnar arrays into samples
+    LoopStageAlgorithm = 1,  // LoopAlgorithm computations
+    LoopStageOutput = 2,     // Building the returned arrays and strings
+    LoopStageExport = 3,     // Whole export calls, including the stages above
+    LoopStageCount = 4,
+};
+
+#define LOOP_PROFILING_BUCKETS 24
+
+/// Cumulative timings per stage since profiling was last reset, indexed by the LoopStage values. Bucket 0 of the
+/// histogram counts durations under 1 microsecond, bucket i counts durations in [2^(i-1), 2^i) microseconds, and the
+/// last bucket also counts everything longer.
+typedef struct {
+    int64_t calls[LoopStageCount];
+    int64_t totalNanoseconds[LoopStageCount];
+    int64_t maxNanoseconds[LoopStageCount];
+    int64_t histogram[LoopStageCount][LOOP_PROFILING_BUCKETS];
+} LoopProfilingStats;
+
+/// Process-wide profiling counters, implemented with atomics so that concurrent exports can record timings. They are
+/// used by the Swift exports setProfilingEnabled, getProfilingStats and resetProfilingStats.
+int32_t loopProfilingIsEnabled(void);
+void loopProfilingSetEnabled(int32_t enabled);
+void loopProfilingRecord(int32_t stage, int64_t nanoseconds);
+void loopProfilingCopyStats(LoopProfilingStats *stats);
+void loopProfilingReset(void);
+
+#endif /* CLoopAlgorithmToPython_h */
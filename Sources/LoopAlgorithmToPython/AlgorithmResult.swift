@@ -0,0 +1,80 @@
+//
+//  AlgorithmResult.swift
+//  LoopAlgorithmToPython
+//
+//  One-shot export: runs LoopAlgorithm once and returns every output together, instead of one export per output that
+//  each decode the input and re-run the algorithm.
+//
+
+import Foundation
+import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+func makeEffectSeries(_ effects: [GlucoseEffect]) -> LoopTimeSeries {
+    return makeTimeSeries(
+        dates: effects.map { $0.startDate },
+        values: effects.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) }
+    )
+}
+
+// Active insulin is computed by the caller, the same way as getActiveInsulin
+func algorithmResult<Input: AlgorithmInput>(_ input: Input, activeInsulin: Double) -> LoopAlgorithmResult {
+    let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+
+    var recommendationJSON = emptyString
+    var recommendationError = emptyString
+    do {
+        recommendationJSON = try encodeRecommendation(try recommendation(from: output.recommendationResult))
+    } catch {
+        recommendationError = makeString("\(error)")
+    }
+
+    return profiled(outputStage) {
+        LoopAlgorithmResult(
+            prediction: makeTimeSeries(
+                dates: output.predictedGlucose.map { $0.startDate },
+                values: output.predictedGlucose.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) }
+            ),
+            insulinCounteractionEffects: makeTimeSeries(
+                dates: output.effects.insulinCounteraction.map { $0.startDate },
+                values: output.effects.insulinCounteraction.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")) }
+            ),
+            insulinEffects: makeEffectSeries(output.effects.insulin),
+            carbEffects: makeEffectSeries(output.effects.carbs),
+            retrospectiveCorrectionEffects: makeEffectSeries(output.effects.retrospectiveCorrection),
+            momentumEffects: makeEffectSeries(output.effects.momentum),
+            activeInsulin: activeInsulin,
+            activeCarbs: output.activeCarbs ?? Double.nan,
+            recommendation: recommendationJSON,
+            recommendationError: recommendationError
+        )
+    }
+}
+
+@_cdecl("runAlgorithm")
+public func runAlgorithm(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopAlgorithmResult {
+    return reportingErrors("runAlgorithm", error, fallback: emptyAlgorithmResult) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        guard !input.glucoseHistory.isEmpty else {
+            throw ExportError.invalidInput("Empty glucose history in input data")
+        }
+        let activeInsulin = profiled(algorithmStage) {
+            input.doses.annotated(with: input.basal).insulinOnBoard(at: input.predictionStart)
+        }
+        return algorithmResult(input, activeInsulin: activeInsulin)
+    }
+}
+
+@_cdecl("runAlgorithmColumnar")
+public func runAlgorithmColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> LoopAlgorithmResult {
+    return reportingErrors("runAlgorithmColumnar", error, fallback: emptyAlgorithmResult) {
+        let input = try columnarInput(handle).input
+        guard !input.glucoseHistory.isEmpty else {
+            throw ExportError.invalidInput("Empty glucose history in input data")
+        }
+        let activeInsulin = profiled(algorithmStage) {
+            input.doses.annotated(with: input.basal).insulinOnBoard(at: input.predictionStart)
+        }
+        return algorithmResult(input, activeInsulin: activeInsulin)
+    }
+}
@@ -0,0 +1,96 @@
+//
+//  Buffers.swift
+//  LoopAlgorithmToPython
+//
+//  Ownership of buffers returned to the caller. Every LoopDoubleArray and LoopString returned by an export is
+//  allocated here and must be released by the caller with freeLoopDoubleArray, freeLoopTimeSeries or freeLoopString.
+//
+
+import Foundation
+import CLoopAlgorithmToPython
+
+// Returned when an export fails
+let emptyDoubleArray = LoopDoubleArray(values: nil, count: 0)
+let emptyTimeSeries = LoopTimeSeries(values: nil, dates: nil, count: 0)
+let emptyString = LoopString(data: nil, length: 0)
+let emptyTimeSeriesBatch = LoopTimeSeriesBatch(series: emptyTimeSeries, offsets: nil, count: 0)
+let emptyAlgorithmResult = LoopAlgorithmResult(
+    prediction: emptyTimeSeries,
+    insulinCounteractionEffects: emptyTimeSeries,
+    insulinEffects: emptyTimeSeries,
+    carbEffects: emptyTimeSeries,
+    retrospectiveCorrectionEffects: emptyTimeSeries,
+    momentumEffects: emptyTimeSeries,
+    activeInsulin: Double.nan,
+    activeCarbs: Double.nan,
+    recommendation: emptyString,
+    recommendationError: emptyString
+)
+
+func makeDoubleArray(_ values: [Double]) -> LoopDoubleArray {
+    let pointer = UnsafeMutablePointer<Double>.allocate(capacity: max(values.count, 1))
+    pointer.initialize(from: values, count: values.count)
+    return LoopDoubleArray(values: pointer, count: Int64(values.count))
+}
+
+func makeTimeSeries(dates: [Date], values: [Double]) -> LoopTimeSeries {
+    let valuesArray = makeDoubleArray(values)
+    let datesArray = makeDoubleArray(dates.map { $0.timeIntervalSince1970 })
+    return LoopTimeSeries(values: valuesArray.values, dates: datesArray.values, count: Int64(values.count))
+}
+
+// Concatenates the series into one buffer, with the offsets where each series starts
+func makeTimeSeriesBatch(_ series: [(dates: [Date], values: [Double])]) -> LoopTimeSeriesBatch {
+    var offsets: [Int64] = [0]
+    for (_, values) in series {
+        offsets.append(offsets[offsets.count - 1] + Int64(values.count))
+    }
+    let offsetsPointer = UnsafeMutablePointer<Int64>.allocate(capacity: offsets.count)
+    offsetsPointer.initialize(from: offsets, count: offsets.count)
+    return LoopTimeSeriesBatch(
+        series: makeTimeSeries(dates: series.flatMap { $0.dates }, values: series.flatMap { $0.values }),
+        offsets: offsetsPointer,
+        count: Int64(series.count)
+    )
+}
+
+func makeString(_ string: String) -> LoopString {
+    guard let cString = strdup(string) else {
+        fatalError("Failed to allocate memory for C-String.")
+    }
+    return LoopString(data: cString, length: Int64(strlen(cString)))
+}
+
+@_cdecl("freeLoopDoubleArray")
+public func freeLoopDoubleArray(_ array: LoopDoubleArray) {
+    array.values?.deallocate()
+}
+
+@_cdecl("freeLoopTimeSeries")
+public func freeLoopTimeSeries(_ series: LoopTimeSeries) {
+    series.values?.deallocate()
+    series.dates?.deallocate()
+}
+
+@_cdecl("freeLoopTimeSeriesBatch")
+public func freeLoopTimeSeriesBatch(_ batch: LoopTimeSeriesBatch) {
+    freeLoopTimeSeries(batch.series)
+    batch.offsets?.deallocate()
+}
+
+@_cdecl("freeLoopString")
+public func freeLoopString(_ string: LoopString) {
+    free(string.data)
+}
+
+@_cdecl("freeLoopAlgorithmResult")
+public func freeLoopAlgorithmResult(_ result: LoopAlgorithmResult) {
+    freeLoopTimeSeries(result.prediction)
+    freeLoopTimeSeries(result.insulinCounteractionEffects)
+    freeLoopTimeSeries(result.insulinEffects)
+    freeLoopTimeSeries(result.carbEffects)
+    freeLoopTimeSeries(result.retrospectiveCorrectionEffects)
+    freeLoopTimeSeries(result.momentumEffects)
+    freeLoopString(result.recommendation)
+    freeLoopString(result.recommendationError)
+}
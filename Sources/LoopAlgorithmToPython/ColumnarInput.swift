@@ -0,0 +1,392 @@
+//
+//  ColumnarInput.swift
+//  LoopAlgorithmToPython
+//
+//  Binary input path: the algorithm input is assembled from contiguous float64 arrays instead of JSON.
+//  All dates are seconds since 1970.
+//
+
+import Foundation
+import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+// The algorithm input assembled from arrays. Conforms to AlgorithmInput so it can be passed to LoopAlgorithm.run directly.
+public struct ColumnarAlgorithmInput: AlgorithmInput {
+    public var predictionStart: Date = Date()
+    public var glucoseHistory: [FixtureGlucoseSample] = []
+    public var doses: [FixtureInsulinDose] = []
+    public var carbEntries: [FixtureCarbEntry] = []
+    public var basal: [AbsoluteScheduleValue<Double>] = []
+    public var sensitivity: [AbsoluteScheduleValue<LoopQuantity>] = []
+    public var carbRatio: [AbsoluteScheduleValue<Double>] = []
+    public var target: GlucoseRangeTimeline = []
+    public var suspendThreshold: LoopQuantity? = nil
+    public var maxBolus: Double = 0
+    public var maxBasalRate: Double = 0
+    public var useIntegralRetrospectiveCorrection: Bool = false
+    public var includePositiveVelocityAndRC: Bool = true
+    public var carbAbsorptionModel: CarbAbsorptionModel = .piecewiseLinear
+    public var recommendationInsulinModel: InsulinModel = ExponentialInsulinModelPreset.rapidActingAdult
+    public var recommendationType: DoseRecommendationType = .automaticBolus
+    public var automaticBolusApplicationFactor: Double? = nil
+    public var useMidAbsorptionISF: Bool = false
+}
+
+// Schedule kinds for setColumnarSchedule
+let columnarScheduleBasal: Int32 = 0
+let columnarScheduleSensitivity: Int32 = 1
+let columnarScheduleCarbRatio: Int32 = 2
+
+// Dose types for setColumnarDoses
+let columnarDoseBolus: Double = 0
+let columnarDoseBasal: Double = 1
+
+// Recommendation types for setColumnarSettings
+let columnarRecommendationTypes: [DoseRecommendationType] = [.automaticBolus, .tempBasal, .manualBolus]
+
+// The handle owned by the Python side. Created with createColumnarInput and released with freeColumnarInput.
+final class ColumnarInput {
+    var input = ColumnarAlgorithmInput()
+    var insulinType: InsulinType? = nil
+}
+
+func insulinType(named name: String) -> InsulinType? {
+    return InsulinType.allCases.first { "\($0)" == name }
+}
+
+func insulinModel(named name: String) -> InsulinModel {
+    switch name {
+    case "fiasp":
+        return ExponentialInsulinModelPreset.fiasp
+    case "lyumjev":
+        return ExponentialInsulinModelPreset.lyumjev
+    case "afrezza":
+        return ExponentialInsulinModelPreset.afrezza
+    default:
+        return ExponentialInsulinModelPreset.rapidActingAdult
+    }
+}
+
+func columnarInput(_ handle: OpaquePointer?) throws -> ColumnarInput {
+    guard let handle = handle else {
+        throw ExportError.invalidInput("No columnar input handle provided")
+    }
+    return Unmanaged<ColumnarInput>.fromOpaque(UnsafeRawPointer(handle)).takeUnretainedValue()
+}
+
+func dates(_ pointer: UnsafePointer<Double>?, _ count: Int) throws -> [Date] {
+    return try doubles(pointer, count).map { Date(timeIntervalSince1970: $0) }
+}
+
+func doubles(_ pointer: UnsafePointer<Double>?, _ count: Int) throws -> [Double] {
+    guard count > 0 else {
+        return []
+    }
+    guard let pointer = pointer else {
+        throw ExportError.invalidInput("NULL array pointer provided for \(count) values")
+    }
+    return Array(UnsafeBufferPointer(start: pointer, count: count))
+}
+
+@_cdecl("createColumnarInput")
+public func createColumnarInput() -> OpaquePointer {
+    return OpaquePointer(Unmanaged.passRetained(ColumnarInput()).toOpaque())
+}
+
+@_cdecl("freeColumnarInput")
+public func freeColumnarInput(_ handle: OpaquePointer?) {
+    guard let handle = handle else {
+        return
+    }
+    Unmanaged<ColumnarInput>.fromOpaque(UnsafeRawPointer(handle)).release()
+}
+
+func glucoseSamples(_ glucoseDates: UnsafePointer<Double>?, _ values: UnsafePointer<Double>?, _ count: Int) throws -> [FixtureGlucoseSample] {
+    return try profiled(decodeStage) {
+        let unit = LoopUnit(from: "mg/dL")
+        return zip(try dates(glucoseDates, count), try doubles(values, count)).map {
+            FixtureGlucoseSample(startDate: $0, quantity: LoopQuantity(unit: unit, doubleValue: $1))
+        }
+    }
+}
+
+func insulinDoses(_ startDates: UnsafePointer<Double>?, _ endDates: UnsafePointer<Double>?, _ volumes: UnsafePointer<Double>?, _ types: UnsafePointer<Double>?, _ count: Int, insulinType: InsulinType?) throws -> [FixtureInsulinDose] {
+    return try profiled(decodeStage) {
+        let starts = try dates(startDates, count)
+        let ends = try dates(endDates, count)
+        let amounts = try doubles(volumes, count)
+        let kinds = try doubles(types, count)
+
+        return (0..<count).map {
+            FixtureInsulinDose(
+                deliveryType: kinds[$0] == columnarDoseBasal ? .basal : .bolus,
+                startDate: starts[$0],
+                endDate: ends[$0],
+                volume: amounts[$0],
+                insulinType: insulinType
+            )
+        }
+    }
+}
+
+func carbEntries(_ carbDates: UnsafePointer<Double>?, _ grams: UnsafePointer<Double>?, _ absorptionTimes: UnsafePointer<Double>?, _ count: Int) throws -> [FixtureCarbEntry] {
+    return try profiled(decodeStage) {
+        let starts = try dates(carbDates, count)
+        let amounts = try doubles(grams, count)
+        let durations = try doubles(absorptionTimes, count)
+
+        return (0..<count).map {
+            FixtureCarbEntry(
+                absorptionTime: durations[$0],
+                startDate: starts[$0],
+                quantity: LoopQuantity(unit: .gram, doubleValue: amounts[$0]),
+                foodType: nil
+            )
+        }
+    }
+}
+
+// Appends new values to a history sorted by start date. Values are normally appended in order, so sorting is only
+// needed when a value arrives late.
+func appending<T>(_ history: [T], _ newValues: [T], startDate: (T) -> Date) -> [T] {
+    let merged = history + newValues
+    guard let last = history.last, let first = newValues.first else {
+        return merged
+    }
+    if startDate(first) >= startDate(last) && zip(newValues, newValues.dropFirst()).allSatisfy({ startDate($0) <= startDate($1) }) {
+        return merged
+    }
+    return merged.enumerated().sorted {
+        (startDate($0.element), $0.offset) < (startDate($1.element), $1.offset)
+    }.map { $0.element }
+}
+
+@_cdecl("setColumnarGlucose")
+public func setColumnarGlucose(_ handle: OpaquePointer?, _ glucoseDates: UnsafePointer<Double>?, _ values: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarGlucose", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        columnar.input.glucoseHistory = try glucoseSamples(glucoseDates, values, count)
+    }
+}
+
+// Volumes are delivered units. Types are 0 for bolus and 1 for basal.
+@_cdecl("setColumnarDoses")
+public func setColumnarDoses(_ handle: OpaquePointer?, _ startDates: UnsafePointer<Double>?, _ endDates: UnsafePointer<Double>?, _ volumes: UnsafePointer<Double>?, _ types: UnsafePointer<Double>?, _ count: Int, _ insulinTypeName: UnsafePointer<CChar>?, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarDoses", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        if let insulinTypeName = insulinTypeName {
+            columnar.insulinType = insulinType(named: String(cString: insulinTypeName))
+        }
+        columnar.input.doses = try insulinDoses(startDates, endDates, volumes, types, count, insulinType: columnar.insulinType)
+    }
+}
+
+// Absorption times are in seconds
+@_cdecl("setColumnarCarbs")
+public func setColumnarCarbs(_ handle: OpaquePointer?, _ carbDates: UnsafePointer<Double>?, _ grams: UnsafePointer<Double>?, _ absorptionTimes: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarCarbs", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        columnar.input.carbEntries = try carbEntries(carbDates, grams, absorptionTimes, count)
+    }
+}
+
+// The append functions add to the history held by a handle, so a streaming session only sends new data each cycle.
+@_cdecl("appendColumnarGlucose")
+public func appendColumnarGlucose(_ handle: OpaquePointer?, _ glucoseDates: UnsafePointer<Double>?, _ values: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("appendColumnarGlucose", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        columnar.input.glucoseHistory = appending(columnar.input.glucoseHistory, try glucoseSamples(glucoseDates, values, count)) { $0.startDate }
+    }
+}
+
+// Uses the insulin type of the last setColumnarDoses call
+@_cdecl("appendColumnarDoses")
+public func appendColumnarDoses(_ handle: OpaquePointer?, _ startDates: UnsafePointer<Double>?, _ endDates: UnsafePointer<Double>?, _ volumes: UnsafePointer<Double>?, _ types: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("appendColumnarDoses", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        let doses = try insulinDoses(startDates, endDates, volumes, types, count, insulinType: columnar.insulinType)
+        columnar.input.doses = appending(columnar.input.doses, doses) { $0.startDate }
+    }
+}
+
+@_cdecl("appendColumnarCarbs")
+public func appendColumnarCarbs(_ handle: OpaquePointer?, _ carbDates: UnsafePointer<Double>?, _ grams: UnsafePointer<Double>?, _ absorptionTimes: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("appendColumnarCarbs", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        columnar.input.carbEntries = appending(columnar.input.carbEntries, try carbEntries(carbDates, grams, absorptionTimes, count)) { $0.startDate }
+    }
+}
+
+// Drops glucose samples before the cutoff, and doses, carb entries and schedule values that ended before it.
+// Carb entries are kept until their absorption time has passed.
+@_cdecl("trimColumnarInput")
+public func trimColumnarInput(_ handle: OpaquePointer?, _ cutoff: Double, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("trimColumnarInput", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        let date = Date(timeIntervalSince1970: cutoff)
+        columnar.input.glucoseHistory.removeAll { $0.startDate < date }
+        columnar.input.doses.removeAll { $0.endDate < date }
+        columnar.input.carbEntries.removeAll { $0.startDate.addingTimeInterval($0.absorptionTime ?? 0) < date }
+        columnar.input.basal.removeAll { $0.endDate < date }
+        columnar.input.sensitivity.removeAll { $0.endDate < date }
+        columnar.input.carbRatio.removeAll { $0.endDate < date }
+        columnar.input.target.removeAll { $0.endDate < date }
+    }
+}
+
+// Sets the basal (U/hr), insulin sensitivity (mg/dL/U) or carb ratio (g/U) schedule, selected by kind
+@_cdecl("setColumnarSchedule")
+public func setColumnarSchedule(_ handle: OpaquePointer?, _ kind: Int32, _ startDates: UnsafePointer<Double>?, _ endDates: UnsafePointer<Double>?, _ values: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarSchedule", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        let starts = try dates(startDates, count)
+        let ends = try dates(endDates, count)
+        let amounts = try doubles(values, count)
+
+        switch kind {
+        case columnarScheduleBasal:
+            columnar.input.basal = (0..<count).map { AbsoluteScheduleValue(startDate: starts[$0], endDate: ends[$0], value: amounts[$0]) }
+        case columnarScheduleSensitivity:
+            let unit = LoopUnit(from: "mg/dL")
+            columnar.input.sensitivity = (0..<count).map {
+                AbsoluteScheduleValue(startDate: starts[$0], endDate: ends[$0], value: LoopQuantity(unit: unit, doubleValue: amounts[$0]))
+            }
+        case columnarScheduleCarbRatio:
+            columnar.input.carbRatio = (0..<count).map { AbsoluteScheduleValue(startDate: starts[$0], endDate: ends[$0], value: amounts[$0]) }
+        default:
+            throw ExportError.invalidInput("Unknown schedule kind \(kind)")
+        }
+    }
+}
+
+@_cdecl("setColumnarTarget")
+public func setColumnarTarget(_ handle: OpaquePointer?, _ startDates: UnsafePointer<Double>?, _ endDates: UnsafePointer<Double>?, _ lowerBounds: UnsafePointer<Double>?, _ upperBounds: UnsafePointer<Double>?, _ count: Int, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarTarget", error, fallback: ()) {
+        let unit = LoopUnit(from: "mg/dL")
+        let starts = try dates(startDates, count)
+        let ends = try dates(endDates, count)
+        let lower = try doubles(lowerBounds, count)
+        let upper = try doubles(upperBounds, count)
+
+        for i in 0..<count where lower[i] > upper[i] {
+            throw ExportError.invalidInput("Target lower bound \(lower[i]) is above upper bound \(upper[i])")
+        }
+
+        try columnarInput(handle).input.target = (0..<count).map {
+            AbsoluteScheduleValue(
+                startDate: starts[$0],
+                endDate: ends[$0],
+                value: LoopQuantity(unit: unit, doubleValue: lower[$0])...LoopQuantity(unit: unit, doubleValue: upper[$0])
+            )
+        }
+    }
+}
+
+// Recommendation types are 0 for automaticBolus, 1 for tempBasal and 2 for manualBolus
+@_cdecl("setColumnarSettings")
+public func setColumnarSettings(_ handle: OpaquePointer?, _ predictionStart: Double, _ maxBasalRate: Double, _ maxBolus: Double, _ suspendThreshold: Double, _ recommendationType: Int32, _ recommendationInsulinType: UnsafePointer<CChar>?, _ useIntegralRetrospectiveCorrection: Int32, _ includePositiveVelocityAndRC: Int32, _ error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("setColumnarSettings", error, fallback: ()) {
+        let columnar = try columnarInput(handle)
+        guard columnarRecommendationTypes.indices.contains(Int(recommendationType)) else {
+            throw ExportError.invalidInput("Unknown recommendation type \(recommendationType)")
+        }
+        columnar.input.predictionStart = Date(timeIntervalSince1970: predictionStart)
+        columnar.input.maxBasalRate = maxBasalRate
+        columnar.input.maxBolus = maxBolus
+        columnar.input.suspendThreshold = suspendThreshold.isNaN ? nil : LoopQuantity(unit: LoopUnit(from: "mg/dL"), doubleValue: suspendThreshold)
+        columnar.input.recommendationType = columnarRecommendationTypes[Int(recommendationType)]
+        if let recommendationInsulinType = recommendationInsulinType {
+            columnar.input.recommendationInsulinModel = insulinModel(named: String(cString: recommendationInsulinType))
+        }
+        columnar.input.useIntegralRetrospectiveCorrection = useIntegralRetrospectiveCorrection != 0
+        columnar.input.includePositiveVelocityAndRC = includePositiveVelocityAndRC != 0
+    }
+}
+
+func predictedGlucose(_ input: ColumnarAlgorithmInput) throws -> [PredictedGlucoseValue] {
+    guard !input.glucoseHistory.isEmpty else {
+        throw ExportError.invalidInput("Empty glucose history in input data")
+    }
+
+    return profiled(algorithmStage) {
+        LoopAlgorithm.generatePrediction(
+            start: input.glucoseHistory.last?.startDate ?? Date(),
+            glucoseHistory: input.glucoseHistory,
+            doses: input.doses,
+            carbEntries: input.carbEntries,
+            basal: input.basal,
+            sensitivity: input.sensitivity,
+            carbRatio: input.carbRatio,
+            algorithmEffectsOptions: .all,
+            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection,
+            includingPositiveVelocityAndRC: input.includePositiveVelocityAndRC
+        ).glucose
+    }
+}
+
+@_cdecl("generatePredictionColumnar")
+public func generatePredictionColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> LoopDoubleArray {
+    return reportingErrors("generatePredictionColumnar", error, fallback: emptyDoubleArray) {
+        let prediction = try predictedGlucose(try columnarInput(handle).input)
+        return profiled(outputStage) {
+            makeDoubleArray(prediction.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) })
+        }
+    }
+}
+
+@_cdecl("getPredictionValuesAndDatesColumnar")
+public func getPredictionValuesAndDatesColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> LoopTimeSeries {
+    return reportingErrors("getPredictionValuesAndDatesColumnar", error, fallback: emptyTimeSeries) {
+        let prediction = try predictedGlucose(try columnarInput(handle).input)
+        return profiled(outputStage) {
+            makeTimeSeries(
+                dates: prediction.map { $0.startDate },
+                values: prediction.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) }
+            )
+        }
+    }
+}
+
+@_cdecl("getInsulinCounteractionEffectsColumnar")
+public func getInsulinCounteractionEffectsColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> LoopTimeSeries {
+    return reportingErrors("getInsulinCounteractionEffectsColumnar", error, fallback: emptyTimeSeries) {
+        let input = try columnarInput(handle).input
+        return insulinCounteractionEffects(
+            glucoseHistory: input.glucoseHistory,
+            doses: input.doses,
+            basal: input.basal,
+            sensitivity: input.sensitivity
+        )
+    }
+}
+
+@_cdecl("getActiveInsulinColumnar")
+public func getActiveInsulinColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("getActiveInsulinColumnar", error, fallback: Double.nan) {
+        let input = try columnarInput(handle).input
+        return profiled(algorithmStage) {
+            input.doses.annotated(with: input.basal).insulinOnBoard(at: input.predictionStart)
+        }
+    }
+}
+
+@_cdecl("getActiveCarbsColumnar")
+public func getActiveCarbsColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("getActiveCarbsColumnar", error, fallback: Double.nan) {
+        let input = try columnarInput(handle).input
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+        guard let activeCarbs = output.activeCarbs else {
+            throw ExportError.algorithm("The algorithm did not return active carbs")
+        }
+        return activeCarbs
+    }
+}
+
+@_cdecl("getLoopRecommendationsColumnar")
+public func getLoopRecommendationsColumnar(_ handle: OpaquePointer?, _ error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getLoopRecommendationsColumnar", error, fallback: emptyString) {
+        let input = try columnarInput(handle).input
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+        return try encodeRecommendation(try recommendation(from: output.recommendationResult))
+    }
+}
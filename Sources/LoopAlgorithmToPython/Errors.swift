@@ -0,0 +1,85 @@
+//
+//  Errors.swift
+//  LoopAlgorithmToPython
+//
+//  Recoverable error reporting. Exports catch errors and report them through a LoopError out-parameter instead of
+//  calling fatalError, so one bad input does not abort the calling process.
+//
+
+import Foundation
+import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+enum ExportError: Error, CustomStringConvertible {
+    case invalidInput(String)
+    case algorithm(String)
+
+    var code: Int32 {
+        switch self {
+        case .invalidInput:
+            return Int32(LoopErrorInvalidInput)
+        case .algorithm:
+            return Int32(LoopErrorAlgorithm)
+        }
+    }
+
+    var description: String {
+        switch self {
+        case .invalidInput(let message), .algorithm(let message):
+            return message
+        }
+    }
+}
+
+func describe(_ decodingError: DecodingError) -> String {
+    switch decodingError {
+    case .dataCorrupted(let context):
+        return "Data corrupted: \(context.debugDescription) Coding path: \(context.codingPath.map { $0.stringValue })"
+    case .keyNotFound(let key, let context):
+        return "Key not found: \(key.stringValue). \(context.debugDescription) Coding path: \(context.codingPath.map { $0.stringValue })"
+    case .typeMismatch(let type, let context):
+        return "Type mismatch: expected \(type). \(context.debugDescription) Coding path: \(context.codingPath.map { $0.stringValue })"
+    case .valueNotFound(let type, let context):
+        return "Value not found: expected \(type). \(context.debugDescription) Coding path: \(context.codingPath.map { $0.stringValue })"
+    @unknown default:
+        return "Unknown decoding error: \(decodingError)"
+    }
+}
+
+// Runs the body of an export. If it throws, the error is written to `error` and `fallback` is returned.
+func reportingErrors<T>(_ name: String, _ error: UnsafeMutablePointer<LoopError>?, fallback: T, _ body: () throws -> T) -> T {
+    error?.pointee = LoopError(code: Int32(LoopErrorNone), message: nil)
+    do {
+        return try profiled(exportStage, body)
+    } catch let decodingError as DecodingError {
+        setError(error, code: Int32(LoopErrorDecoding), message: "\(name) failed: JSON decoding error - \(describe(decodingError))")
+    } catch let exportError as ExportError {
+        setError(error, code: exportError.code, message: "\(name) failed: \(exportError)")
+    } catch let otherError {
+        setError(error, code: Int32(LoopErrorAlgorithm), message: "\(name) failed: \(otherError)")
+    }
+    return fallback
+}
+
+private func setError(_ error: UnsafeMutablePointer<LoopError>?, code: Int32, message: String) {
+    guard let error = error else {
+        // The caller did not ask for errors, so there is no way to report it
+        print("ERROR: \(message)")
+        return
+    }
+    error.pointee = LoopError(code: code, message: strdup(message))
+}
+
+func recommendation(from result: Result<LoopAlgorithmDoseRecommendation, Error>) throws -> LoopAlgorithmDoseRecommendation {
+    switch result {
+    case .success(let recommendation):
+        return recommendation
+    case .failure(let error):
+        throw ExportError.algorithm("Dose recommendation failed - \(error)")
+    }
+}
+
+@_cdecl("freeLoopError")
+public func freeLoopError(_ error: LoopError) {
+    free(error.message)
+}
@@ -7,6 +7,10 @@
 
 import Foundation
 import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+// All exports are reentrant: they only read immutable globals and allocate their own decoders and results, so they can
+// be called concurrently from several threads. A ColumnarInput handle must not be used by two threads at the same time.
 
 // ===== CROSS-PLATFORM EXCEPTION HANDLING =====
 
@@ -41,8 +45,9 @@ struct AlgorithmFactory {
     }
 }
 
-@_cdecl("initializeExceptionHandler")
-public func initializeExceptionHandler() {
+// Signal and exception handlers are process-global. Swift initializes globals lazily and exactly once, even when
+// several threads call initializeExceptionHandler at the same time, so the handlers are only installed once.
+private let installedHandlers: Void = {
     #if os(macOS) || os(iOS)
     NSSetUncaughtExceptionHandler { exception in
         print("Uncaught exception: \(exception.description)")
@@ -57,6 +62,11 @@ public func initializeExceptionHandler() {
     #else
     signals.forEach { signal($0, signalHandler) }
     #endif
+}()
+
+@_cdecl("initializeExceptionHandler")
+public func initializeExceptionHandler() {
+    _ = installedHandlers
 }
 
 @_cdecl("initializeSignalHandlers")
@@ -64,347 +74,206 @@ public func initializeSignalHandlers() {
     initializeExceptionHandler()
 }
 
+@_cdecl("getLibraryABIVersion")
+public func getLibraryABIVersion() -> Int32 {
+    return Int32(LOOP_ABI_VERSION)
+}
+
 @_cdecl("generatePrediction") // Use @_cdecl to expose the function with a C-compatible name
-public func generatePrediction(jsonData: UnsafePointer<Int8>?) -> UnsafeMutablePointer<Double> {
+public func generatePrediction(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopDoubleArray {
     // TODO: Add opportunity to get prediction effects from only one factor at a time
-    
-    // Enhanced input validation
-    guard let jsonData = jsonData else {
-        print("ERROR: generatePrediction - NULL JSON data pointer provided")
-        fatalError("generatePrediction failed: NULL JSON data pointer provided")
-    }
-    
-    let jsonLength = strlen(jsonData)
-    guard jsonLength > 0 else {
-        print("ERROR: generatePrediction - Empty JSON data provided (length: \(jsonLength))")
-        fatalError("generatePrediction failed: Empty JSON data provided")
-    }
-        
-    let data: Data
-    do {
-        data = getDataFromJson(jsonData: jsonData)
-    } catch {
-        print("ERROR: generatePrediction - Failed to convert JSON pointer to Data: \(error)")
-        print("ERROR: generatePrediction - JSON string (first 200 chars): \(String(cString: jsonData).prefix(200))")
-        fatalError("generatePrediction failed: JSON data conversion error - \(error)")
-    }
-
-    do {
-        // Decode JSON data with enhanced error reporting
-        let input = try getDecoder().decode(LoopPredictionInput.self, from: data)       
-        
-        guard !input.glucoseHistory.isEmpty else {
-            print("ERROR: generatePrediction - Empty glucose history provided")
-            fatalError("generatePrediction failed: Empty glucose history in input data")
-        }
+    return reportingErrors("generatePrediction", error, fallback: emptyDoubleArray) {
+        let prediction = try loopPrediction(jsonData: jsonData)
 
-        let startDate = input.glucoseHistory.last?.startDate ?? Date()
-               
-        let prediction = LoopAlgorithm.generatePrediction(
-            start: startDate,
-            glucoseHistory: input.glucoseHistory,
-            doses: input.doses,
-            carbEntries: input.carbEntries,
-            basal: input.basal,
-            sensitivity: input.sensitivity,
-            carbRatio: input.carbRatio,
-            algorithmEffectsOptions: .all, // Here we can adjust which predictive factor to output
-            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection,
-            includingPositiveVelocityAndRC: input.includePositiveVelocityAndRC
-        )
-        
-        
-        var predictedValues: [Double] = []
-                
-        for val in prediction.glucose {
-            predictedValues.append(val.quantity.doubleValue(for: LoopUnit(from: "mg/dL")))
+        guard !prediction.glucose.isEmpty else {
+            throw ExportError.algorithm("Algorithm generated empty prediction result")
         }
-        
-        guard !predictedValues.isEmpty else {
-            print("ERROR: generatePrediction - No predicted values generated")
-            fatalError("generatePrediction failed: Algorithm generated empty prediction result")
+        return profiled(outputStage) {
+            makeDoubleArray(prediction.glucose.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) })
         }
-
-        let pointer = UnsafeMutablePointer<Double>.allocate(capacity: predictedValues.count)
-        pointer.initialize(from: predictedValues, count: predictedValues.count)
-        
-        return pointer
-    } catch let decodingError as DecodingError {
-        print("ERROR: generatePrediction - JSON decoding failed:")
-        switch decodingError {
-        case .dataCorrupted(let context):
-            print("  - Data corrupted: \(context.debugDescription)")
-            print("  - Coding path: \(context.codingPath)")
-        case .keyNotFound(let key, let context):
-            print("  - Key not found: \(key.stringValue)")
-            print("  - Context: \(context.debugDescription)")
-            print("  - Coding path: \(context.codingPath)")
-        case .typeMismatch(let type, let context):
-            print("  - Type mismatch: expected \(type)")
-            print("  - Context: \(context.debugDescription)")
-            print("  - Coding path: \(context.codingPath)")
-        case .valueNotFound(let type, let context):
-            print("  - Value not found: expected \(type)")
-            print("  - Context: \(context.debugDescription)")
-            print("  - Coding path: \(context.codingPath)")
-        @unknown default:
-            print("  - Unknown decoding error: \(decodingError)")
-        }
-        print("ERROR: generatePrediction - JSON content (first 500 chars): \(String(data: data, encoding: .utf8)?.prefix(500) ?? "Unable to convert to string")")
-        fatalError("generatePrediction failed: JSON decoding error - \(decodingError)")
-    } catch {
-        print("ERROR: generatePrediction - Unexpected error during prediction generation:")
-        print("  - Error type: \(type(of: error))")
-        print("  - Error description: \(error)")
-        print("  - JSON content (first 500 chars): \(String(data: data, encoding: .utf8)?.prefix(500) ?? "Unable to convert to string")")
-        fatalError("generatePrediction failed: Unexpected error - \(error)")
     }
 }
 
 @_cdecl("getPredictionDates")
-public func getPredictionDates(jsonData: UnsafePointer<Int8>?) -> UnsafePointer<CChar> {
-    let data = getDataFromJson(jsonData: jsonData)
-
-    do {
-        let input = try getDecoder().decode(LoopPredictionInput.self, from: data)
+public func getPredictionDates(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getPredictionDates", error, fallback: emptyString) {
+        let prediction = try loopPrediction(jsonData: jsonData, forwardingPositiveVelocityAndRC: false)
+        return profiled(outputStage) { makeDateList(prediction.glucose.map { $0.startDate }) }
+    }
+}
 
-        let prediction = LoopAlgorithm.generatePrediction(
-            start: input.glucoseHistory.last?.startDate ?? Date(),
-            glucoseHistory: input.glucoseHistory,
-            doses: input.doses,
-            carbEntries: input.carbEntries,
-            basal: input.basal,
-            sensitivity: input.sensitivity,
-            carbRatio: input.carbRatio,
-            algorithmEffectsOptions: .all,
-            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection
-        )
-        // Prepare prediction dates as a comma-separated string
-        var predictionDates: String = ""
-        for val in prediction.glucose {
-            predictionDates += val.startDate.ISO8601Format() + ","
+// Runs the prediction once and returns the predicted values (mg/dL) together with their dates
+@_cdecl("getPredictionValuesAndDates")
+public func getPredictionValuesAndDates(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopTimeSeries {
+    return reportingErrors("getPredictionValuesAndDates", error, fallback: emptyTimeSeries) {
+        let prediction = try loopPrediction(jsonData: jsonData)
+        return profiled(outputStage) {
+            makeTimeSeries(
+                dates: prediction.glucose.map { $0.startDate },
+                values: prediction.glucose.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL")) }
+            )
         }
-        let cString = strdup(predictionDates)!
-                
-        return UnsafePointer<CChar>(cString)
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
     }
 }
 
 @_cdecl("getDoseRecommendations")
-public func getDoseRecommendations(jsonData: UnsafePointer<Int8>?) -> UnsafeMutablePointer<CChar> {
-    let data = getDataFromJson(jsonData: jsonData)
+public func getDoseRecommendations(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getDoseRecommendations", error, fallback: emptyString) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+        return try encodeRecommendation(try recommendation(from: output.recommendationResult))
+    }
+}
 
-    do {
-        let input = try getDecoder().decode(AlgorithmInputFixture.self, from: data)
-        let output = LoopAlgorithm.run(input: input)
-        let recommendation = output.recommendationResult
-        var result: LoopAlgorithmDoseRecommendation?
-        
-        switch recommendation {
-            case .success(let res):
-                result = res
-            case .failure(let e):
-                print(e)
+@_cdecl("getGlucoseEffectVelocity") // Use @_cdecl to expose the function with a C-compatible name
+public func getGlucoseEffectVelocity(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopDoubleArray {
+    return reportingErrors("getGlucoseEffectVelocity", error, fallback: emptyDoubleArray) {
+        let prediction = try loopPrediction(jsonData: jsonData, forwardingPositiveVelocityAndRC: false)
+        return profiled(outputStage) {
+            makeDoubleArray(prediction.effects.insulinCounteraction.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")) })
         }
-        let encoder = JSONEncoder()
-        do {
-            let jsonData = try encoder.encode(result)
-            if let jsonString = String(data: jsonData, encoding: .utf8) {
-                // Use strdup to create a mutable C-style string
-                if let cString = strdup(jsonString) {
-                    return cString // Return the mutable pointer directly
-                } else {
-                    fatalError("Failed to allocate memory for C-String.")
-                }
+    }
+}
+
+@_cdecl("getGlucoseEffectVelocityDates")
+public func getGlucoseEffectVelocityDates(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getGlucoseEffectVelocityDates", error, fallback: emptyString) {
+        let prediction = try loopPrediction(jsonData: jsonData, forwardingPositiveVelocityAndRC: false)
+        return profiled(outputStage) { makeDateList(prediction.effects.insulinCounteraction.map { $0.startDate }) }
+    }
+}
+
+@_cdecl("getGlucoseEffectVelocityAndDates")
+public func getGlucoseEffectVelocityAndDates(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getGlucoseEffectVelocityAndDates", error, fallback: emptyString) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+
+        return profiled(outputStage) {
+            // Prepare dates and values as space-separated "date,value" pairs
+            var predictionsAndDates: String = ""
+            for val in output.effects.insulinCounteraction {
+                predictionsAndDates += val.startDate.ISO8601Format() + ","
+                predictionsAndDates += val.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")).description + " "
             }
-        } catch {
-            print("Error encoding JSON: \(error)")
+            return makeString(predictionsAndDates)
         }
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
     }
-    
-    // If the function reaches here, return an empty C-string
-    return strdup("")!
 }
 
-@_cdecl("getGlucoseEffectVelocity") // Use @_cdecl to expose the function with a C-compatible name
-public func getGlucoseEffectVelocity(jsonData: UnsafePointer<Int8>?) -> UnsafeMutablePointer<Double> {
-    let data = getDataFromJson(jsonData: jsonData)
+// Computes insulin counteraction effects (mg/dL·s) for the whole glucose history, without running the dose recommendation
+func insulinCounteractionEffects(glucoseHistory: [FixtureGlucoseSample], doses: [FixtureInsulinDose], basal: [AbsoluteScheduleValue<Double>], sensitivity: [AbsoluteScheduleValue<LoopQuantity>]) -> LoopTimeSeries {
+    guard let start = glucoseHistory.first?.startDate, let end = glucoseHistory.last?.startDate else {
+        return makeTimeSeries(dates: [], values: [])
+    }
+    let counteractionEffects = profiled(algorithmStage) {
+        let dosesRelativeToBasal = doses.annotated(with: basal)
+        let insulinEffects = dosesRelativeToBasal.glucoseEffects(
+            insulinSensitivityHistory: sensitivity,
+            from: start,
+            to: end
+        )
+        return glucoseHistory.counteractionEffects(to: insulinEffects)
+    }
 
-    do {
-        // Decode JSON data
-        let input = try getDecoder().decode(LoopPredictionInput.self, from: data)
-        
-        let prediction = LoopAlgorithm.generatePrediction(
-            start: input.glucoseHistory.last?.startDate ?? Date(),
-            glucoseHistory: input.glucoseHistory,
-            doses: input.doses,
-            carbEntries: input.carbEntries,
-            basal: input.basal,
-            sensitivity: input.sensitivity,
-            carbRatio: input.carbRatio,
-            algorithmEffectsOptions: .all, // Here we can adjust which predictive factor to output
-            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection
+    return profiled(outputStage) {
+        makeTimeSeries(
+            dates: counteractionEffects.map { $0.startDate },
+            values: counteractionEffects.map { $0.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")) }
         )
-        var glucoseEffectVelocities: [Double] = []
-                
-        for val in prediction.effects.insulinCounteraction {
-            glucoseEffectVelocities.append(val.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")))
-        }
-        let pointer = UnsafeMutablePointer<Double>.allocate(capacity: glucoseEffectVelocities.count)
-        pointer.initialize(from: glucoseEffectVelocities, count: glucoseEffectVelocities.count)
-                
-        return pointer
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
     }
 }
 
-@_cdecl("getGlucoseEffectVelocityDates")
-public func getGlucoseEffectVelocityDates(jsonData: UnsafePointer<Int8>?) -> UnsafePointer<CChar> {
-    let data = getDataFromJson(jsonData: jsonData)
-    
-    do {
-        let input = try getDecoder().decode(LoopPredictionInput.self, from: data)
-                            
-        let prediction = LoopAlgorithm.generatePrediction(
-            start: input.glucoseHistory.last?.startDate ?? Date(),
+@_cdecl("getInsulinCounteractionEffects")
+public func getInsulinCounteractionEffects(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopTimeSeries {
+    return reportingErrors("getInsulinCounteractionEffects", error, fallback: emptyTimeSeries) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        return insulinCounteractionEffects(
             glucoseHistory: input.glucoseHistory,
             doses: input.doses,
-            carbEntries: input.carbEntries,
             basal: input.basal,
-            sensitivity: input.sensitivity,
-            carbRatio: input.carbRatio,
-            algorithmEffectsOptions: .all,
-            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection
+            sensitivity: input.sensitivity
         )
-        
-        // Prepare prediction dates as a comma-separated string
-        var predictionDates: String = ""
-        for val in prediction.effects.insulinCounteraction {
-            predictionDates += val.startDate.ISO8601Format() + ","
-        }
-        let cString = strdup(predictionDates)!
-        return UnsafePointer<CChar>(cString)
-    } catch {
-        print("Error reading or decoding JSON file: \(error)")
-        fatalError("Error reading or decoding JSON file: \(error)")
     }
 }
 
-@_cdecl("getGlucoseEffectVelocityAndDates")
-public func getGlucoseEffectVelocityAndDates(jsonData: UnsafePointer<Int8>?) -> UnsafePointer<CChar> {
-    let data = getDataFromJson(jsonData: jsonData)
-
-    do {
-        let input = try getDecoder().decode(AlgorithmInputFixture.self, from: data)
-        let output = LoopAlgorithm.run(input: input)
-
-        // Prepare prediction dates as a comma-separated string
-        var predictionsAndDates: String = ""
-        for val in output.effects.insulinCounteraction {
-            predictionsAndDates += val.startDate.ISO8601Format() + ","
-            predictionsAndDates += val.quantity.doubleValue(for: LoopUnit(from: "mg/dL·s")).description + " "
+@_cdecl("getActiveCarbs")
+public func getActiveCarbs(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("getActiveCarbs", error, fallback: Double.nan) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+        guard let activeCarbs = output.activeCarbs else {
+            throw ExportError.algorithm("The algorithm did not return active carbs")
         }
-        let cString = strdup(predictionsAndDates)!
-        
-        return UnsafePointer<CChar>(cString)
-
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+        return activeCarbs
     }
 }
 
-@_cdecl("getActiveCarbs")
-public func getActiveCarbs(jsonData: UnsafePointer<Int8>?) -> Double {
-    let data = getDataFromJson(jsonData: jsonData)
 
-    do {
-        let input = try getDecoder().decode(AlgorithmInputFixture.self, from: data)
-        let output = LoopAlgorithm.run(input: input)
-        return output.activeCarbs!
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+@_cdecl("getActiveInsulin")
+public func getActiveInsulin(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("getActiveInsulin", error, fallback: Double.nan) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        return profiled(algorithmStage) {
+            input.doses.annotated(with: input.basal).insulinOnBoard(at: input.predictionStart)
+        }
     }
 }
 
+// Computes insulin on board at many evaluation dates from one decoded dose history.
+// Dates are seconds since 1970. For each evaluation date, only doses that started in [windowStart, date) are included,
+// which matches calling getActiveInsulin once per window. Passing NULL for windowStarts includes all earlier doses.
+// The caller owns the output buffer, which must have room for `count` values.
+@_cdecl("getActiveInsulinBatch")
+public func getActiveInsulinBatch(jsonData: UnsafePointer<Int8>?, dates: UnsafePointer<Double>?, windowStarts: UnsafePointer<Double>?, count: Int, output: UnsafeMutablePointer<Double>?, error: UnsafeMutablePointer<LoopError>?) {
+    reportingErrors("getActiveInsulinBatch", error, fallback: ()) {
+        let data = try getDataFromJson(jsonData: jsonData)
 
-@_cdecl("getActiveInsulin")
-public func getActiveInsulin(jsonData: UnsafePointer<Int8>?) -> Double {
-    let data = getDataFromJson(jsonData: jsonData)
+        guard count > 0 else {
+            return
+        }
+        guard let dates = dates, let output = output else {
+            throw ExportError.invalidInput("NULL dates or output pointer provided")
+        }
 
-    do {
-        let input = try getDecoder().decode(AlgorithmInputFixture.self, from: data)
-        let dosesRelativeToBasal = input.doses.annotated(with: input.basal)
-        let activeInsulin = dosesRelativeToBasal.insulinOnBoard(at: input.predictionStart)
-        return activeInsulin
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+        let input = try profiled(decodeStage) { try getDecoder().decode(AlgorithmInputFixture.self, from: data) }
+        profiled(algorithmStage) {
+            // Annotating once for the whole history is what makes this faster than one getActiveInsulin call per date
+            let dosesRelativeToBasal = input.doses.annotated(with: input.basal).sorted { $0.startDate < $1.startDate }
+            let doseStartDates = dosesRelativeToBasal.map { $0.startDate }
+
+            for i in 0..<count {
+                let date = Date(timeIntervalSince1970: dates[i])
+                let lower = windowStarts.map { partitioningIndex(doseStartDates, Date(timeIntervalSince1970: $0[i])) } ?? 0
+                let upper = partitioningIndex(doseStartDates, date)
+                output[i] = lower < upper ? Array(dosesRelativeToBasal[lower..<upper]).insulinOnBoard(at: date) : 0.0
+            }
+        }
     }
 }
 
 @_cdecl("insulinPercentEffectRemaining")
-public func insulinPercentEffectRemaining(jsonData: UnsafePointer<Int8>?) -> Double {
-    let data = getDataFromJson(jsonData: jsonData)
+public func insulinPercentEffectRemaining(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("insulinPercentEffectRemaining", error, fallback: Double.nan) {
+        let input = try decodeInput(InsulinPercentEffectInput.self, jsonData: jsonData)
 
-    do {
-        let input = try getDecoder().decode(InsulinPercentEffectInput.self, from: data)
-        
         let actionDuration = TimeInterval(input.actionDuration * 60)
         let peakActivityTime = TimeInterval(input.peakActivityTime * 60)
         let delay = TimeInterval(input.delay * 60)
         let minutes = TimeInterval(input.minutes * 60)
-        
+
         let model = ExponentialInsulinModel(actionDuration: actionDuration, peakActivityTime: peakActivityTime, delay: delay)
-        return model.percentEffectRemaining(at: minutes)
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+        return profiled(algorithmStage) { model.percentEffectRemaining(at: minutes) }
     }
 }
 
 @_cdecl("getLoopRecommendations") // Use @_cdecl to expose the function with a C-compatible name
-public func getLoopRecommendations(jsonData: UnsafePointer<Int8>?) -> UnsafePointer<CChar> {
-    let data: Data = getDataFromJson(jsonData: jsonData)
-
-    do {
-        let input = try getDecoder().decode(AlgorithmInputFixture.self, from: data)
-        let output = LoopAlgorithm.run(input: input)
-        let result = output.recommendationResult
-        
-        var data: LoopAlgorithmDoseRecommendation?
-
-        switch result {
-            case .success(let resp_data):
-                data = resp_data
-            case .failure(let e):
-                print("FAIL")
-                print(e)
-        }
-        
-        let encoder: JSONEncoder = JSONEncoder()
-
-        do {
-            // Encode JSON data
-            let jsonData = try encoder.encode(data)
-
-            // Convert JSON data to string
-            if let jsonString = String(data: jsonData, encoding: .utf8) {
-                let cString: UnsafeMutablePointer<CChar> = strdup(jsonString)!
-                return UnsafePointer<CChar>(cString)
-            }
-
-        } catch {
-            print("Error encoding JSON: \(error)")
-        }
-      
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+public func getLoopRecommendations(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> LoopString {
+    return reportingErrors("getLoopRecommendations", error, fallback: emptyString) {
+        let input = try decodeInput(AlgorithmInputFixture.self, jsonData: jsonData)
+        let output = profiled(algorithmStage) { LoopAlgorithm.run(input: input) }
+        return try encodeRecommendation(try recommendation(from: output.recommendationResult))
     }
-    let cString: UnsafeMutablePointer<CChar> = strdup("")!
-    return UnsafePointer<CChar>(cString)
 }
 
 @_cdecl("percentAbsorptionAtPercentTime")
@@ -423,53 +292,199 @@ public func linearPercentRateAtPercentTime(_ percentTime: Double) -> Double {
 }
 
 @_cdecl("getDynamicCarbsOnBoard")
-public func getDynamicCarbsOnBoard(jsonData: UnsafePointer<Int8>?) -> Double {
-    let data = getDataFromJson(jsonData: jsonData)
+public func getDynamicCarbsOnBoard(jsonData: UnsafePointer<Int8>?, error: UnsafeMutablePointer<LoopError>?) -> Double {
+    return reportingErrors("getDynamicCarbsOnBoard", error, fallback: Double.nan) {
+        let input = try decodeInput(DynamicCarbsData.self, jsonData: jsonData)
+        let carbsOnBoard = try dynamicCarbsOnBoard(
+            inputICE: input.inputICE,
+            carbEntries: input.carbEntries,
+            sensitivity: input.sensitivity,
+            carbRatio: input.carbRatio,
+            absorptionModel: PiecewiseLinearAbsorption()
+        )
+        return carbsOnBoard.values.first ?? 100.0
+    }
+}
 
-    do {
-        let input = try getDecoder().decode(DynamicCarbsData.self, from: data)
+// Computes the dynamic carbs on board series for every input, each with all of its carb entries. The inputs are a
+// JSON list in the format of getDynamicCarbsOnBoard, optionally with "start" and "end" dates of the series.
+@_cdecl("getDynamicCarbsOnBoardSeries")
+public func getDynamicCarbsOnBoardSeries(jsonData: UnsafePointer<Int8>?, absorptionModel: Int32, delta: Double, error: UnsafeMutablePointer<LoopError>?) -> LoopTimeSeriesBatch {
+    return reportingErrors("getDynamicCarbsOnBoardSeries", error, fallback: emptyTimeSeriesBatch) {
+        let inputs = try decodeInput([DynamicCarbsData].self, jsonData: jsonData)
+        let model = try carbAbsorptionModel(absorptionModel)
+        guard delta > 0 else {
+            throw ExportError.invalidInput("delta must be positive")
+        }
 
-        let dateFormatter = ISO8601DateFormatter()
-        dateFormatter.formatOptions = [.withFullDate, .withTime, .withColonSeparatorInTime, .withDashSeparatorInDate]
+        let series = try inputs.map {
+            try dynamicCarbsOnBoard(
+                inputICE: $0.inputICE,
+                carbEntries: $0.carbEntries,
+                sensitivity: $0.sensitivity,
+                carbRatio: $0.carbRatio,
+                start: $0.start,
+                end: $0.end,
+                delta: delta,
+                absorptionModel: model
+            )
+        }
+        return profiled(outputStage) { makeTimeSeriesBatch(series) }
+    }
+}
 
-        let inputICE = loadICEInputFixture(from: input.inputICE)
-        let carbEntries = loadCarbEntryFixture(from: encodeCarbValuesToJsonData(carbValues: input.carbEntries)!)
+func carbAbsorptionModel(_ model: Int32) throws -> CarbAbsorptionComputable {
+    switch Int(model) {
+    case Int(LoopAbsorptionPiecewiseLinear):
+        return PiecewiseLinearAbsorption()
+    case Int(LoopAbsorptionLinear):
+        return LinearAbsorption()
+    case Int(LoopAbsorptionParabolic):
+        return ParabolicAbsorption()
+    default:
+        throw ExportError.invalidInput("Unknown absorption model \(model)")
+    }
+}
+
+// Maps all carb entries to the observed insulin counteraction effects, and returns their combined carbs on board from
+// start to end (by default the 6 hours from the first inputICE date)
+private func dynamicCarbsOnBoard(
+    inputICE iceInputs: [InputICE],
+    carbEntries carbValues: [CarbValue],
+    sensitivity: Double,
+    carbRatio: Double,
+    start: String? = nil,
+    end: String? = nil,
+    delta: TimeInterval = TimeInterval(5 * 60),
+    absorptionModel: CarbAbsorptionComputable
+) throws -> (dates: [Date], values: [Double]) {
+    let dateFormatter = ISO8601DateFormatter()
+    dateFormatter.formatOptions = [.withFullDate, .withTime, .withColonSeparatorInTime, .withDashSeparatorInDate]
+
+    guard let firstICE = iceInputs.first, let lastICE = iceInputs.last, !carbValues.isEmpty else {
+        throw ExportError.invalidInput("Empty inputICE or carbEntries in input data")
+    }
+    guard let carbValuesData = encodeCarbValuesToJsonData(carbValues: carbValues) else {
+        throw ExportError.invalidInput("Could not encode the carb entries")
+    }
+    guard let startDate = dateFormatter.date(from: firstICE.startAt), let endDate = dateFormatter.date(from: lastICE.startAt) else {
+        throw ExportError.invalidInput("Invalid inputICE dates")
+    }
+    let seriesStart = try start.map {
+        guard let date = dateFormatter.date(from: $0) else {
+            throw ExportError.invalidInput("Invalid start date \($0)")
+        }
+        return date
+    } ?? startDate
+    let seriesEnd = try end.map {
+        guard let date = dateFormatter.date(from: $0) else {
+            throw ExportError.invalidInput("Invalid end date \($0)")
+        }
+        return date
+    } ?? seriesStart.addingTimeInterval(TimeInterval(60*60*6))
+    guard seriesEnd >= seriesStart else {
+        throw ExportError.invalidInput("The end date is before the start date")
+    }
 
-        let startDate = dateFormatter.date(from: input.inputICE[0].startAt)!
-        let endDate = dateFormatter.date(from: input.inputICE.last!.startAt)!
+    let (inputICE, carbEntries) = try profiled(decodeStage) {
+        (loadICEInputFixture(from: iceInputs), try loadCarbEntryFixture(from: carbValuesData))
+    }
 
-        // Mixed types: Double for carbRatio, LoopQuantity for ISF (as required by API)
-        let carbRatio = [AbsoluteScheduleValue(startDate: startDate, endDate: endDate, value: input.carbRatio)]
-        let isf = [AbsoluteScheduleValue(startDate: startDate, endDate: endDate, value: LoopQuantity(unit: LoopUnit(from: "mg/dL"), doubleValue: input.sensitivity))]
+    // The settings wrap the effects and the series
+    let settingsStart = min(startDate, seriesStart)
+    let settingsEnd = max(endDate, seriesEnd)
+    // Mixed types: Double for carbRatio, LoopQuantity for ISF (as required by API)
+    let carbRatioSchedule = [AbsoluteScheduleValue(startDate: settingsStart, endDate: settingsEnd, value: carbRatio)]
+    let isf = [AbsoluteScheduleValue(startDate: settingsStart, endDate: settingsEnd, value: LoopQuantity(unit: LoopUnit(from: "mg/dL"), doubleValue: sensitivity))]
 
-        let statuses = [carbEntries[0]].map(
+    let carbsOnBoard = profiled(algorithmStage) { () -> [(Date, Double)] in
+        let statuses = carbEntries.map(
             to: inputICE,
-            carbRatio: carbRatio,
+            carbRatio: carbRatioSchedule,
             insulinSensitivity: isf,
             initialAbsorptionTimeOverrun: 2.0,
-            absorptionModel: PiecewiseLinearAbsorption()
+            absorptionModel: absorptionModel
         )
-        // TODO: Add a function for different absorbrionmodels
-
-        // The output here is a list of CarbValues with startDate, endDate (equal to startDate), and value (ICE?)
-        let carbsOnBoard = statuses.dynamicCarbsOnBoard(
-            from: inputICE[0].startDate,
-            to: inputICE[0].startDate.addingTimeInterval(TimeInterval(60*60*6)),
-            absorptionModel: PiecewiseLinearAbsorption())
-
-        return carbsOnBoard.first?.value ?? 100.0
-    } catch {
-        fatalError("Error reading or decoding JSON file: \(error)")
+        return statuses.dynamicCarbsOnBoard(
+            from: seriesStart,
+            to: seriesEnd,
+            delta: delta,
+            absorptionModel: absorptionModel
+        ).map { ($0.startDate, $0.value) }
     }
+    return (carbsOnBoard.map { $0.0 }, carbsOnBoard.map { $0.1 })
 }
 
-func getDataFromJson(jsonData: UnsafePointer<Int8>?) -> Data {
+func getDataFromJson(jsonData: UnsafePointer<Int8>?) throws -> Data {
     guard let jsonData = jsonData else {
-        fatalError("No JSON data provided")
+        throw ExportError.invalidInput("No JSON data provided")
+    }
+    let jsonLength = strlen(jsonData)
+    guard jsonLength > 0 else {
+        throw ExportError.invalidInput("Empty JSON data provided")
     }
     // Convert JSON data to Data
-    let data = Data(bytes: jsonData, count: strlen(jsonData))
-    return data
+    return Data(bytes: jsonData, count: jsonLength)
+}
+
+// Decodes a LoopPredictionInput and runs the prediction. The older date/velocity exports never forwarded
+// includePositiveVelocityAndRC, so they pass `forwardingPositiveVelocityAndRC: false` to keep their output unchanged.
+func loopPrediction(jsonData: UnsafePointer<Int8>?, forwardingPositiveVelocityAndRC: Bool = true) throws -> LoopPrediction {
+    let input = try decodeInput(LoopPredictionInput.self, jsonData: jsonData)
+
+    guard !input.glucoseHistory.isEmpty else {
+        throw ExportError.invalidInput("Empty glucose history in input data")
+    }
+
+    guard forwardingPositiveVelocityAndRC else {
+        return profiled(algorithmStage) {
+            LoopAlgorithm.generatePrediction(
+                start: input.glucoseHistory.last?.startDate ?? Date(),
+                glucoseHistory: input.glucoseHistory,
+                doses: input.doses,
+                carbEntries: input.carbEntries,
+                basal: input.basal,
+                sensitivity: input.sensitivity,
+                carbRatio: input.carbRatio,
+                algorithmEffectsOptions: .all,
+                useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection
+            )
+        }
+    }
+
+    return profiled(algorithmStage) {
+        LoopAlgorithm.generatePrediction(
+            start: input.glucoseHistory.last?.startDate ?? Date(),
+            glucoseHistory: input.glucoseHistory,
+            doses: input.doses,
+            carbEntries: input.carbEntries,
+            basal: input.basal,
+            sensitivity: input.sensitivity,
+            carbRatio: input.carbRatio,
+            algorithmEffectsOptions: .all, // Here we can adjust which predictive factor to output
+            useIntegralRetrospectiveCorrection: input.useIntegralRetrospectiveCorrection,
+            includingPositiveVelocityAndRC: input.includePositiveVelocityAndRC
+        )
+    }
+}
+
+func encodeRecommendation(_ recommendation: LoopAlgorithmDoseRecommendation) throws -> LoopString {
+    return try profiled(outputStage) {
+        let jsonData = try JSONEncoder().encode(recommendation)
+        guard let jsonString = String(data: jsonData, encoding: .utf8) else {
+            throw ExportError.algorithm("Could not encode the dose recommendation")
+        }
+        return makeString(jsonString)
+    }
+}
+
+// Dates as a comma-separated string of ISO 8601 dates, with a trailing comma
+func makeDateList(_ dates: [Date]) -> LoopString {
+    var dateList: String = ""
+    for date in dates {
+        dateList += date.ISO8601Format() + ","
+    }
+    return makeString(dateList)
 }
 
 func getDecoder() -> JSONDecoder {
@@ -478,11 +493,34 @@ func getDecoder() -> JSONDecoder {
     return decoder
 }
 
+func decodeInput<T: Decodable>(_ type: T.Type, jsonData: UnsafePointer<Int8>?) throws -> T {
+    let data = try getDataFromJson(jsonData: jsonData)
+    return try profiled(decodeStage) { try getDecoder().decode(type, from: data) }
+}
+
+// Returns the index of the first date in the sorted array that is not earlier than `date`
+func partitioningIndex(_ sortedDates: [Date], _ date: Date) -> Int {
+    var low = 0
+    var high = sortedDates.count
+    while low < high {
+        let mid = (low + high) / 2
+        if sortedDates[mid] < date {
+            low = mid + 1
+        } else {
+            high = mid
+        }
+    }
+    return low
+}
+
 public struct DynamicCarbsData: Codable {
     let inputICE: [InputICE]
     let carbEntries: [CarbValue]
     let sensitivity: Double
     let carbRatio: Double
+    // Range of the series returned by getDynamicCarbsOnBoardSeries, formatted like the inputICE dates
+    let start: String?
+    let end: String?
 }
 
 public struct InsulinPercentEffectInput: Codable {
@@ -545,30 +583,30 @@ private func loadICEInputFixture(from inputs: [InputICE]) -> [GlucoseEffectVeloc
 
 public typealias JSONDictionary = [String: Any]
 
-private func loadCarbEntryFixture(from inputs: Data) -> [FixtureCarbEntry] {
-    let fixture: [JSONDictionary] = loadFixture(inputs)
-    return carbEntriesFromFixture(fixture)
-}
-
-public func loadFixture<T>(_ inputs: Data) -> T {
-    return try! JSONSerialization.jsonObject(with: inputs, options: []) as! T
+private func loadCarbEntryFixture(from inputs: Data) throws -> [FixtureCarbEntry] {
+    guard let fixture = try JSONSerialization.jsonObject(with: inputs, options: []) as? [JSONDictionary] else {
+        throw ExportError.invalidInput("Carb entries must be a list of objects")
+    }
+    return try carbEntriesFromFixture(fixture)
 }
 
-private func carbEntriesFromFixture(_ fixture: [JSONDictionary]) -> [FixtureCarbEntry] {
+private func carbEntriesFromFixture(_ fixture: [JSONDictionary]) throws -> [FixtureCarbEntry] {
     let dateFormatter = ISO8601DateFormatter.localTimeDate(timeZone: TimeZone(secondsFromGMT: 0)!)
 
-    return fixture.map {
+    return try fixture.map {
         let absorptionTime: TimeInterval?
         if let absorptionTimeMinutes = $0["absorptionTime"] as? Double {
             absorptionTime = TimeInterval(absorptionTimeMinutes * 60)
         } else {
             absorptionTime = nil
         }
-        let startAt = dateFormatter.date(from: $0["date"] as! String)!
+        guard let date = $0["date"] as? String, let startAt = dateFormatter.date(from: date), let grams = $0["grams"] as? Double else {
+            throw ExportError.invalidInput("Invalid carb entry: \($0)")
+        }
         return FixtureCarbEntry(
             absorptionTime: absorptionTime,
             startDate: startAt,
-            quantity: LoopQuantity(unit: .gram, doubleValue: $0["grams"] as! Double),
+            quantity: LoopQuantity(unit: .gram, doubleValue: grams),
             foodType: nil
         )
     }
@@ -661,3 +699,43 @@ struct LinearAbsorption: CarbAbsorptionComputable {
         }
     }
 }
+
+// Copied code because the struct was not public
+struct ParabolicAbsorption: CarbAbsorptionComputable {
+    func percentAbsorptionAtPercentTime(_ percentTime: Double) -> Double {
+        switch percentTime {
+        case let t where t <= 0.0:
+            return 0.0
+        case let t where t <= 0.5:
+            return 2.0 * pow(t, 2)
+        case let t where t < 1.0:
+            return -1.0 + 2.0 * t * (2.0 - t)
+        default:
+            return 1.0
+        }
+    }
+
+    func percentTimeAtPercentAbsorption(_ percentAbsorption: Double) -> Double {
+        switch percentAbsorption {
+        case let a where a <= 0.0:
+            return 0.0
+        case let a where a <= 0.5:
+            return sqrt(0.5 * a)
+        case let a where a < 1.0:
+            return 1.0 - sqrt(0.5 * (1.0 - a))
+        default:
+            return 1.0
+        }
+    }
+
+    func percentRateAtPercentTime(_ percentTime: Double) -> Double {
+        switch percentTime {
+        case let t where t > 0.0 && t <= 0.5:
+            return 4.0 * t
+        case let t where t > 0.5 && t < 1.0:
+            return 4.0 - 4.0 * t
+        default:
+            return 0.0
+        }
+    }
+}
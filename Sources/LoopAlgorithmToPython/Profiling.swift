@@ -0,0 +1,52 @@
+//
+//  Profiling.swift
+//  LoopAlgorithmToPython
+//
+//  Opt-in timing of the stages inside the exports (decoding, algorithm, output building). The counters are
+//  process-wide and kept in CLoopAlgorithmToPython.c. While profiling is disabled, each stage costs one atomic load.
+//
+
+import Foundation
+import CLoopAlgorithmToPython
+
+// Runs body, and adds its duration to the counters of the stage if profiling is enabled
+@inline(__always)
+func profiled<T>(_ stage: Int32, _ body: () throws -> T) rethrows -> T {
+    guard loopProfilingIsEnabled() != 0 else {
+        return try body()
+    }
+    let start = DispatchTime.now().uptimeNanoseconds
+    defer {
+        loopProfilingRecord(stage, Int64(DispatchTime.now().uptimeNanoseconds - start))
+    }
+    return try body()
+}
+
+let decodeStage = Int32(LoopStageDecode)
+let algorithmStage = Int32(LoopStageAlgorithm)
+let outputStage = Int32(LoopStageOutput)
+let exportStage = Int32(LoopStageExport)
+
+@_cdecl("setProfilingEnabled")
+public func setProfilingEnabled(_ enabled: Int32) {
+    loopProfilingSetEnabled(enabled)
+}
+
+@_cdecl("isProfilingEnabled")
+public func isProfilingEnabled() -> Int32 {
+    return loopProfilingIsEnabled()
+}
+
+// Copies the counters into a caller-owned LoopProfilingStats
+@_cdecl("getProfilingStats")
+public func getProfilingStats(_ stats: UnsafeMutablePointer<LoopProfilingStats>?) {
+    guard let stats = stats else {
+        return
+    }
+    loopProfilingCopyStats(stats)
+}
+
+@_cdecl("resetProfilingStats")
+public func resetProfilingStats() {
+    loopProfilingReset()
+}
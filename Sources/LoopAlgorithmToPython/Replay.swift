@@ -0,0 +1,226 @@
+//
+//  Replay.swift
+//  LoopAlgorithmToPython
+//
+//  Closed-loop replay: the full history is held by a ColumnarInput handle, and a cursor steps through time, running
+//  the algorithm on the data known at each step. Optionally, the recommended doses are delivered instead of the
+//  observed basal deliveries, as if the loop had been running.
+//
+
+import Foundation
+import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+let emptyReplayResult = LoopReplayResult(
+    dates: nil,
+    automaticBolus: nil,
+    tempBasalRate: nil,
+    tempBasalDuration: nil,
+    manualBolus: nil,
+    activeInsulin: nil,
+    activeCarbs: nil,
+    predictions: nil,
+    status: nil,
+    count: 0,
+    horizonCount: 0
+)
+
+// The value of the schedule at the date, or nil if the schedule does not cover it
+func scheduleValue<T>(_ schedule: [AbsoluteScheduleValue<T>], at date: Date) -> T? {
+    return schedule.first { $0.startDate <= date && date < $0.endDate }?.value
+}
+
+// Linear interpolation of the predicted glucose at the date. NaN outside of the prediction.
+func interpolatedGlucose(_ prediction: [PredictedGlucoseValue], at date: Date) -> Double {
+    let unit = LoopUnit(from: "mg/dL")
+    let index = partitioningIndex(prediction.map { $0.startDate }, date)
+    guard index < prediction.count else {
+        return Double.nan
+    }
+    let after = prediction[index]
+    guard index > 0, after.startDate > date else {
+        return after.startDate == date ? after.quantity.doubleValue(for: unit) : Double.nan
+    }
+    let before = prediction[index - 1]
+    let fraction = date.timeIntervalSince(before.startDate) / after.startDate.timeIntervalSince(before.startDate)
+    let start = before.quantity.doubleValue(for: unit)
+    return start + fraction * (after.quantity.doubleValue(for: unit) - start)
+}
+
+// Runs the algorithm at every step date (ascending, seconds since 1970) with the glucose readings, doses and carb
+// entries from `retention` seconds before the step up to the step. Predicted glucose is returned at the horizons,
+// in seconds after each step. With applyRecommendations, the observed basal deliveries from the first step on are
+// replaced by the recommended temp basals, delivered until the next step or until they end, with the scheduled basal
+// after that, and the recommended automatic boluses are added. Observed boluses are kept, because they cannot be told apart from manual boluses. Glucose is always the
+// observed glucose.
+@_cdecl("runReplay")
+public func runReplay(_ handle: OpaquePointer?, _ stepDates: UnsafePointer<Double>?, _ stepCount: Int, _ horizons: UnsafePointer<Double>?, _ horizonCount: Int, _ retention: Double, _ applyRecommendations: Int32, _ error: UnsafeMutablePointer<LoopError>?) -> LoopReplayResult {
+    return reportingErrors("runReplay", error, fallback: emptyReplayResult) {
+        let columnar = try columnarInput(handle)
+        let input = columnar.input
+        let steps = try dates(stepDates, stepCount)
+        let horizonIntervals = try doubles(horizons, horizonCount)
+        let apply = applyRecommendations != 0
+        guard zip(steps, steps.dropFirst()).allSatisfy({ $0 <= $1 }) else {
+            throw ExportError.invalidInput("Step dates must be in ascending order")
+        }
+        guard retention > 0 else {
+            throw ExportError.invalidInput("retention must be positive")
+        }
+
+        let (glucose, observedDoses, carbs) = profiled(decodeStage) { () -> ([FixtureGlucoseSample], [FixtureInsulinDose], [FixtureCarbEntry]) in
+            var doses = input.doses
+            if apply, let first = steps.first {
+                doses.removeAll { $0.deliveryType == .basal && $0.startDate >= first }
+            }
+            return (
+                input.glucoseHistory.sorted { $0.startDate < $1.startDate },
+                doses.sorted { $0.startDate < $1.startDate },
+                input.carbEntries.sorted { $0.startDate < $1.startDate }
+            )
+        }
+
+        // With the observed doses, the doses are annotated with the basal schedule once for the whole history instead
+        // of once per step
+        let annotatedDoses = apply ? [] : profiled(algorithmStage) {
+            observedDoses.annotated(with: input.basal).sorted { $0.startDate < $1.startDate }
+        }
+
+        var stepDatesOut = [Double](repeating: Double.nan, count: stepCount)
+        var automaticBolus = [Double](repeating: Double.nan, count: stepCount)
+        var tempBasalRate = [Double](repeating: Double.nan, count: stepCount)
+        var tempBasalDuration = [Double](repeating: Double.nan, count: stepCount)
+        var manualBolus = [Double](repeating: Double.nan, count: stepCount)
+        var activeInsulin = [Double](repeating: Double.nan, count: stepCount)
+        var activeCarbs = [Double](repeating: Double.nan, count: stepCount)
+        var predictions = [Double](repeating: Double.nan, count: stepCount * horizonCount)
+        var status = [Int32](repeating: Int32(LoopErrorNone), count: stepCount)
+
+        // Half-open ranges of each history in the current window. The cursors only move forward, because the steps
+        // are in ascending order.
+        var glucoseRange = 0..<0
+        var doseRange = 0..<0
+        var carbRange = 0..<0
+        var annotatedRange = 0..<0
+        var simulatedDoses: [FixtureInsulinDose] = []
+        var simulatedStart = 0
+        var currentTempBasal: (rate: Double, end: Date)? = nil
+
+        func advance(_ range: inout Range<Int>, _ count: Int, _ date: (Int) -> Date, from cutoff: Date, to step: Date) {
+            var upper = range.upperBound
+            while upper < count && date(upper) <= step {
+                upper += 1
+            }
+            var lower = range.lowerBound
+            while lower < upper && date(lower) < cutoff {
+                lower += 1
+            }
+            range = lower..<upper
+        }
+
+        for (i, step) in steps.enumerated() {
+            stepDatesOut[i] = step.timeIntervalSince1970
+            let cutoff = step.addingTimeInterval(-retention)
+            advance(&glucoseRange, glucose.count, { glucose[$0].startDate }, from: cutoff, to: step)
+            advance(&doseRange, observedDoses.count, { observedDoses[$0].startDate }, from: cutoff, to: step)
+            advance(&carbRange, carbs.count, { carbs[$0].startDate }, from: cutoff, to: step)
+            advance(&annotatedRange, annotatedDoses.count, { annotatedDoses[$0].startDate }, from: cutoff, to: step)
+            while simulatedStart < simulatedDoses.count && simulatedDoses[simulatedStart].startDate < cutoff {
+                simulatedStart += 1
+            }
+
+            var stepInput = input
+            stepInput.predictionStart = step
+            stepInput.glucoseHistory = Array(glucose[glucoseRange])
+            stepInput.doses = appending(Array(observedDoses[doseRange]), Array(simulatedDoses[simulatedStart...])) { $0.startDate }
+            stepInput.carbEntries = Array(carbs[carbRange])
+
+            var bolus = 0.0
+            if stepInput.glucoseHistory.isEmpty {
+                status[i] = Int32(LoopErrorInvalidInput)
+            } else {
+                activeInsulin[i] = profiled(algorithmStage) {
+                    apply ? stepInput.doses.annotated(with: stepInput.basal).insulinOnBoard(at: step)
+                        : Array(annotatedDoses[annotatedRange]).insulinOnBoard(at: step)
+                }
+                let output = profiled(algorithmStage) { LoopAlgorithm.run(input: stepInput) }
+                activeCarbs[i] = output.activeCarbs ?? Double.nan
+                profiled(outputStage) {
+                    for (h, interval) in horizonIntervals.enumerated() {
+                        predictions[i * horizonCount + h] = interpolatedGlucose(output.predictedGlucose, at: step.addingTimeInterval(interval))
+                    }
+                }
+
+                switch output.recommendationResult {
+                case .success(let recommendation):
+                    if let automatic = recommendation.automatic {
+                        automaticBolus[i] = automatic.bolusUnits ?? Double.nan
+                        bolus = automatic.bolusUnits ?? 0
+                        if let tempBasal = automatic.basalAdjustment {
+                            tempBasalRate[i] = tempBasal.unitsPerHour
+                            tempBasalDuration[i] = tempBasal.duration
+                            currentTempBasal = (tempBasal.unitsPerHour, step.addingTimeInterval(tempBasal.duration))
+                        }
+                    }
+                    if let manual = recommendation.manual {
+                        manualBolus[i] = manual.amount
+                    }
+                case .failure:
+                    status[i] = Int32(LoopErrorAlgorithm)
+                }
+            }
+
+            if apply {
+                // Without a new recommendation, a running temp basal continues, otherwise the scheduled basal is
+                // delivered. Loop issues a new temp basal every cycle, so it is delivered until the next step, or until
+                // it ends if the next step is later, and the scheduled basal is delivered from then on.
+                let next = i + 1 < steps.count ? steps[i + 1] : step.addingTimeInterval(5 * 60)
+                func deliverBasal(from start: Date, to end: Date, rate: Double) {
+                    if end > start {
+                        simulatedDoses.append(FixtureInsulinDose(deliveryType: .basal, startDate: start, endDate: end, volume: rate * end.timeIntervalSince(start) / 3600, insulinType: columnar.insulinType))
+                    }
+                }
+                var scheduledStart = step
+                if let tempBasal = currentTempBasal, tempBasal.end > step {
+                    scheduledStart = min(next, tempBasal.end)
+                    deliverBasal(from: step, to: scheduledStart, rate: tempBasal.rate)
+                }
+                deliverBasal(from: scheduledStart, to: next, rate: scheduleValue(input.basal, at: scheduledStart) ?? 0)
+                if bolus > 0 {
+                    simulatedDoses.append(FixtureInsulinDose(deliveryType: .bolus, startDate: step, endDate: step.addingTimeInterval(5 * 60), volume: bolus, insulinType: columnar.insulinType))
+                }
+            }
+        }
+
+        return profiled(outputStage) {
+            let statusPointer = UnsafeMutablePointer<Int32>.allocate(capacity: max(stepCount, 1))
+            statusPointer.initialize(from: status, count: stepCount)
+            return LoopReplayResult(
+                dates: makeDoubleArray(stepDatesOut).values,
+                automaticBolus: makeDoubleArray(automaticBolus).values,
+                tempBasalRate: makeDoubleArray(tempBasalRate).values,
+                tempBasalDuration: makeDoubleArray(tempBasalDuration).values,
+                manualBolus: makeDoubleArray(manualBolus).values,
+                activeInsulin: makeDoubleArray(activeInsulin).values,
+                activeCarbs: makeDoubleArray(activeCarbs).values,
+                predictions: makeDoubleArray(predictions).values,
+                status: statusPointer,
+                count: Int64(stepCount),
+                horizonCount: Int64(horizonCount)
+            )
+        }
+    }
+}
+
+@_cdecl("freeLoopReplayResult")
+public func freeLoopReplayResult(_ result: LoopReplayResult) {
+    result.dates?.deallocate()
+    result.automaticBolus?.deallocate()
+    result.tempBasalRate?.deallocate()
+    result.tempBasalDuration?.deallocate()
+    result.manualBolus?.deallocate()
+    result.activeInsulin?.deallocate()
+    result.activeCarbs?.deallocate()
+    result.predictions?.deallocate()
+    result.status?.deallocate()
+}
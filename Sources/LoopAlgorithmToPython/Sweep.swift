@@ -0,0 +1,92 @@
+//
+//  Sweep.swift
+//  LoopAlgorithmToPython
+//
+//  Therapy-setting sweeps: one history, held by a ColumnarInput handle, evaluated under many combinations of basal
+//  rate, insulin sensitivity, carb ratio and target in a single call.
+//
+
+import Foundation
+import LoopAlgorithm
+import CLoopAlgorithmToPython
+
+// Replaces every value of a schedule, keeping its dates. NaN keeps the schedule unchanged.
+func replacingValues<T>(_ schedule: [AbsoluteScheduleValue<T>], with value: T?) -> [AbsoluteScheduleValue<T>] {
+    guard let value = value else {
+        return schedule
+    }
+    return schedule.map { AbsoluteScheduleValue(startDate: $0.startDate, endDate: $0.endDate, value: value) }
+}
+
+func nonNaN(_ value: Double) -> Double? {
+    return value.isNaN ? nil : value
+}
+
+// Runs the algorithm for every settings combination. Each array holds `count` values, or is NULL to keep the schedule
+// of the input; NaN values also keep it. The combinations are split over `threads` threads.
+@_cdecl("runSettingsSweep")
+public func runSettingsSweep(_ handle: OpaquePointer?, _ basalRates: UnsafePointer<Double>?, _ sensitivities: UnsafePointer<Double>?, _ carbRatios: UnsafePointer<Double>?, _ targetLowerBounds: UnsafePointer<Double>?, _ targetUpperBounds: UnsafePointer<Double>?, _ count: Int, _ threads: Int32, _ error: UnsafeMutablePointer<LoopError>?) -> LoopSweepResult {
+    return reportingErrors("runSettingsSweep", error, fallback: LoopSweepResult(results: nil, count: 0)) {
+        let input = try columnarInput(handle).input
+        guard !input.glucoseHistory.isEmpty else {
+            throw ExportError.invalidInput("Empty glucose history in input data")
+        }
+        func column(_ pointer: UnsafePointer<Double>?) -> [Double] {
+            return pointer.map { Array(UnsafeBufferPointer(start: $0, count: count)) } ?? Array(repeating: Double.nan, count: count)
+        }
+        let basal = column(basalRates)
+        let sensitivity = column(sensitivities)
+        let carbRatio = column(carbRatios)
+        let lower = column(targetLowerBounds)
+        let upper = column(targetUpperBounds)
+        for i in 0..<count where lower[i].isNaN != upper[i].isNaN || lower[i] > upper[i] {
+            throw ExportError.invalidInput("Invalid target \(lower[i])...\(upper[i]) for settings combination \(i)")
+        }
+
+        // Doses are annotated once per distinct basal rate, not once per combination. LoopAlgorithm.run still
+        // annotates the doses internally, because it does not accept annotated doses.
+        let activeInsulin: [Double?: Double] = Dictionary(uniqueKeysWithValues: Set(basal.map(nonNaN)).map { rate in
+            let schedule = replacingValues(input.basal, with: rate)
+            return (rate, profiled(algorithmStage) { input.doses.annotated(with: schedule).insulinOnBoard(at: input.predictionStart) })
+        })
+
+        let unit = LoopUnit(from: "mg/dL")
+        func result(_ i: Int) -> LoopAlgorithmResult {
+            var settings = input
+            settings.basal = replacingValues(input.basal, with: nonNaN(basal[i]))
+            settings.sensitivity = replacingValues(input.sensitivity, with: nonNaN(sensitivity[i]).map { LoopQuantity(unit: unit, doubleValue: $0) })
+            settings.carbRatio = replacingValues(input.carbRatio, with: nonNaN(carbRatio[i]))
+            if !lower[i].isNaN {
+                settings.target = replacingValues(input.target, with: LoopQuantity(unit: unit, doubleValue: lower[i])...LoopQuantity(unit: unit, doubleValue: upper[i]))
+            }
+            return algorithmResult(settings, activeInsulin: activeInsulin[nonNaN(basal[i])]!)
+        }
+
+        let results = UnsafeMutablePointer<LoopAlgorithmResult>.allocate(capacity: max(count, 1))
+        let workers = max(1, min(Int(threads), count))
+        if workers == 1 {
+            for i in 0..<count {
+                (results + i).initialize(to: result(i))
+            }
+        } else {
+            // Every worker writes its own elements, so the buffer needs no locking
+            DispatchQueue.concurrentPerform(iterations: workers) { worker in
+                for i in stride(from: worker, to: count, by: workers) {
+                    (results + i).initialize(to: result(i))
+                }
+            }
+        }
+        return LoopSweepResult(results: results, count: Int64(count))
+    }
+}
+
+@_cdecl("freeLoopSweepResult")
+public func freeLoopSweepResult(_ result: LoopSweepResult) {
+    guard let results = result.results else {
+        return
+    }
+    for i in 0..<Int(result.count) {
+        freeLoopAlgorithmResult(results[i])
+    }
+    results.deallocate()
+}
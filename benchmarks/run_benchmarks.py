@@ -0,0 +1,264 @@
+"""
+Throughput benchmarks for the public API functions and the DataFrame helpers, on seeded synthetic data.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --days 7 --subjects 10 --output benchmark_results.json
+    python -m benchmarks.run_benchmarks --compare benchmark_results.json --output new_results.json
+
+Each benchmark reports calls per second, per-call and per-row latency percentiles, and the peak RSS of the process
+after it ran. Results are saved as JSON with the library version information, so that builds can be compared.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import loop_to_python_api.api as api
+import loop_to_python_api.helpers as helpers
+from loop_to_python_api.session import LoopSession
+from benchmarks.synthetic import SETTINGS, generate_subject, generate_cohort
+
+PERCENTILES = [50, 90, 99]
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def get_library_info():
+    with open(api.lib_path, 'rb') as f:
+        library_hash = hashlib.sha256(f.read()).hexdigest()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'library_path': api.lib_path,
+        'library_sha256': library_hash,
+        'git_commit': commit,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+
+
+def time_calls(function, inputs, rows_per_call, repeats):
+    """
+    Call the function once per input, `repeats` times over, and summarize the latencies.
+    """
+    latencies = []
+    for _ in range(repeats):
+        for arguments in inputs:
+            start = time.perf_counter()
+            function(*arguments)
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    per_row = latencies / rows_per_call
+    return {
+        'calls': len(latencies),
+        'rows_per_call': rows_per_call,
+        'calls_per_second': len(latencies) / latencies.sum(),
+        'rows_per_second': len(latencies) * rows_per_call / latencies.sum(),
+        'latency_ms': {f'p{p}': float(np.percentile(latencies, p) * 1e3) for p in PERCENTILES},
+        'latency_per_row_us': {f'p{p}': float(np.percentile(per_row, p) * 1e6) for p in PERCENTILES},
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+def get_windows(df, window, count):
+    """
+    Up to `count` evenly spaced windows of `window` rows each.
+    """
+    starts = np.linspace(0, len(df) - window, min(count, max(len(df) - window + 1, 1))).astype(int)
+    return [df.iloc[start:start + window] for start in starts]
+
+
+def get_benchmarks(args):
+    """
+    :return: A list of (name, function, list of argument tuples, rows per call).
+    """
+    data = generate_subject(args.days, seed=args.seed)
+    windows = get_windows(data, args.window, args.calls)
+    rows = args.window
+
+    def json_input(window):
+        return helpers.get_json_loop_prediction_input_from_df(window, SETTINGS['basal'], SETTINGS['isf'],
+                                                              SETTINGS['cr'], window.index[-1],
+                                                              insulin_type=SETTINGS['insulin_type'])
+
+    def columnar_input(window):
+        return helpers.get_columnar_loop_prediction_input_from_df(window, SETTINGS['basal'], SETTINGS['isf'],
+                                                                  SETTINGS['cr'], window.index[-1],
+                                                                  insulin_type=SETTINGS['insulin_type'])
+
+    # Time-varying basal schedule, with a higher rate from 3 to 9 AM, encoded once for the whole subject
+    hours = data.index.hour
+    basal_schedule = helpers.get_schedule(np.where((hours >= 3) & (hours < 9), 1.2, 1.0) * SETTINGS['basal'],
+                                          data.index)
+
+    def scheduled_json_input(window):
+        return helpers.get_json_loop_prediction_input_from_df(window, basal_schedule, SETTINGS['isf'], SETTINGS['cr'],
+                                                              window.index[-1], insulin_type=SETTINGS['insulin_type'])
+
+    def scheduled_columnar_input(window):
+        return helpers.get_columnar_loop_prediction_input_from_df(window, basal_schedule, SETTINGS['isf'],
+                                                                  SETTINGS['cr'], window.index[-1],
+                                                                  insulin_type=SETTINGS['insulin_type'])
+
+    json_inputs = [(json_input(window),) for window in windows]
+    json_bytes_inputs = [(helpers.get_bytes_from_json(json_data),) for json_data, in json_inputs]
+    columnar_inputs = [(columnar_input(window),) for window in windows]
+    percent_times = np.linspace(-0.1, 1.1, 10_000)
+    minutes = np.linspace(0, 400, 10_000)
+    settings = (SETTINGS['basal'], SETTINGS['isf'], SETTINGS['cr'])
+
+    def session_cycle(window):
+        # One session per window, warmed up with all but the last reading, then one 5-minute cycle
+        session = LoopSession(*settings, insulin_type=SETTINGS['insulin_type'])
+        window = window[window['CGM'].notna()]
+        history = window.iloc[:-1]
+        session.add_glucose(history.index, history['CGM'].to_numpy())
+        session.add_basal(history.index, history['basal'].to_numpy())
+
+        def cycle():
+            # Repeated cycles re-send the same reading, which the native merge keeps in date order
+            session.add_glucose(window.index[-1], window['CGM'].iloc[-1])
+            session.add_basal(window.index[-1], window['basal'].iloc[-1])
+            return session.get_loop_recommendations()
+        return cycle
+
+    benchmarks = [
+        ('generate_prediction', api.generate_prediction, json_inputs, rows),
+        ('generate_prediction (bytes input)', api.generate_prediction, json_bytes_inputs, rows),
+        ('get_prediction_dates', api.get_prediction_dates, json_inputs, rows),
+        ('get_prediction_values_and_dates', api.get_prediction_values_and_dates, json_inputs, rows),
+        ('get_prediction', api.get_prediction, json_inputs, rows),
+        ('get_dose_recommendations', api.get_dose_recommendations, json_inputs, rows),
+        ('get_glucose_effect_velocity', api.get_glucose_effect_velocity, json_inputs, rows),
+        ('get_glucose_effect_velocity_dates', api.get_glucose_effect_velocity_dates, json_inputs, rows),
+        ('get_glucose_effect_velocity_and_dates', api.get_glucose_effect_velocity_and_dates, json_inputs, rows),
+        ('get_insulin_counteraction_effects', api.get_insulin_counteraction_effects, json_inputs, rows),
+        ('get_active_carbs', api.get_active_carbs, json_inputs, rows),
+        ('get_active_insulin', api.get_active_insulin, json_inputs, rows),
+        ('get_active_insulin_batch', api.get_active_insulin_batch,
+         [(json_data, window.index) for (json_data,), window in zip(json_inputs, windows)], rows),
+        ('get_loop_recommendations', api.get_loop_recommendations, json_inputs, rows),
+        ('run_algorithm', api.run_algorithm, json_inputs, rows),
+        ('generate_prediction_columnar', api.generate_prediction_columnar, columnar_inputs, rows),
+        ('get_active_insulin_columnar', api.get_active_insulin_columnar, columnar_inputs, rows),
+        ('get_active_carbs_columnar', api.get_active_carbs_columnar, columnar_inputs, rows),
+        ('get_loop_recommendations_columnar', api.get_loop_recommendations_columnar, columnar_inputs, rows),
+        ('run_algorithm_columnar', api.run_algorithm_columnar, columnar_inputs, rows),
+        ('generate_predictions (threads)', lambda inputs: api.generate_predictions(inputs),
+         [([json_data for json_data, in json_inputs],)], rows * len(json_inputs)),
+        ('LoopSession cycle', lambda cycle: cycle(), [(session_cycle(window),) for window in windows], 1),
+        ('percent_absorption_at_percent_time', api.percent_absorption_at_percent_time, [(0.3,)], 1),
+        ('piecewise_linear_percent_rate_at_percent_time', api.piecewise_linear_percent_rate_at_percent_time,
+         [(0.3,)], 1),
+        ('linear_percent_rate_at_percent_time', api.linear_percent_rate_at_percent_time, [(0.3,)], 1),
+        ('insulin_percent_effect_remaining', api.insulin_percent_effect_remaining, [(60, 360, 75, 10)], 1),
+        ('percent_absorption_at_percent_time_array', api.percent_absorption_at_percent_time_array,
+         [(percent_times,)], len(percent_times)),
+        ('piecewise_linear_percent_rate_at_percent_time_array',
+         api.piecewise_linear_percent_rate_at_percent_time_array, [(percent_times,)], len(percent_times)),
+        ('linear_percent_rate_at_percent_time_array', api.linear_percent_rate_at_percent_time_array,
+         [(percent_times,)], len(percent_times)),
+        ('insulin_percent_effect_remaining_array', api.insulin_percent_effect_remaining_array,
+         [(minutes, 360, 75, 10)], len(minutes)),
+        ('get_json_loop_prediction_input_from_df', json_input, [(data,)], len(data)),
+        ('get_json_loop_prediction_input_from_df (bytes)',
+         lambda df: helpers.get_json_loop_prediction_input_from_df(df, *settings, df.index[-1], as_bytes=True),
+         [(data,)], len(data)),
+        ('get_columnar_loop_prediction_input_from_df', columnar_input, [(data,)], len(data)),
+        ('get_json_loop_prediction_input_from_df (basal schedule, per window)', scheduled_json_input,
+         [(window,) for window in windows], rows),
+        ('get_columnar_loop_prediction_input_from_df (basal schedule, per window)', scheduled_columnar_input,
+         [(window,) for window in windows], rows),
+        ('add_insulin_on_board_to_df', lambda df: api.add_insulin_on_board_to_df(df, *settings), [(data,)],
+         len(data)),
+        ('add_insulin_on_board_to_df (native)',
+         lambda df: api.add_insulin_on_board_to_df(df, *settings, method='native'), [(data,)], len(data)),
+        ('add_insulin_counteraction_effect_to_df', lambda df: api.add_insulin_counteraction_effect_to_df(df, *settings),
+         [(data,)], len(data)),
+    ]
+    if args.subjects > 1:
+        cohort = generate_cohort(args.subjects, args.days, seed=args.seed)
+        benchmarks.append(('add_iob_and_ice', lambda df: api.add_iob_and_ice(df, 'subject_id', dict(SETTINGS),
+                                                                              workers=args.workers),
+                           [(cohort,)], len(cohort)))
+    # get_dynamic_carbs_on_board is left out because of the known unit conversion issue (see README.md)
+    return benchmarks
+
+
+def compare(results, baseline):
+    print(f"{'benchmark':<55} {'calls/s':>12} {'baseline':>12} {'ratio':>7}")
+    baseline = {entry['name']: entry for entry in baseline['benchmarks']}
+    for entry in results['benchmarks']:
+        old = baseline.get(entry['name'])
+        if old is None or 'calls_per_second' not in old or 'calls_per_second' not in entry:
+            continue
+        ratio = entry['calls_per_second'] / old['calls_per_second']
+        print(f"{entry['name']:<55} {entry['calls_per_second']:>12.1f} {old['calls_per_second']:>12.1f} "
+              f"{ratio:>7.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=float, default=7, help='Days of data per subject.')
+    parser.add_argument('--subjects', type=int, default=10, help='Subjects for the multi-subject benchmark.')
+    parser.add_argument('--window', type=int, default=288, help='Rows in each API input window.')
+    parser.add_argument('--calls', type=int, default=20, help='Distinct input windows per API benchmark.')
+    parser.add_argument('--repeats', type=int, default=3, help='Times each benchmark is run over its inputs.')
+    parser.add_argument('--workers', type=int, default=None, help='Workers for add_iob_and_ice.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--filter', default=None, help='Only run benchmarks whose name contains this text.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='A previous results file to compare against.')
+    args = parser.parse_args(argv)
+
+    results = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'parameters': vars(args),
+        'environment': get_library_info(),
+        'benchmarks': [],
+    }
+    for name, function, inputs, rows_per_call in get_benchmarks(args):
+        if args.filter and args.filter not in name:
+            continue
+        try:
+            # One warm-up call, so one-time costs are not counted
+            function(*inputs[0])
+            entry = dict(name=name, **time_calls(function, inputs, rows_per_call, args.repeats))
+            print(f"{name:<55} {entry['calls_per_second']:>10.1f} calls/s  "
+                  f"p50 {entry['latency_ms']['p50']:>9.3f} ms")
+        except Exception as error:
+            entry = {'name': name, 'error': repr(error)}
+            print(f"{name:<55} failed: {error!r}")
+        results['benchmarks'].append(entry)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Seeded synthetic CGM, bolus, basal and carb data for benchmarks, in the DataFrame format used by the API helpers
+(5-minute datetime index with 'CGM' (mg/dL), 'bolus' (U), 'basal' (U/hr) and 'carbs' (g) columns).
+
+The data is plausible enough to exercise every code path (meals, boluses, temp basals, sensor gaps), but it is not a
+physiological simulation. The same seed always gives the same data.
+"""
+import numpy as np
+import pandas as pd
+
+from loop_to_python_api.curves import insulin_percent_effect_remaining_array, percent_absorption_at_percent_time_array
+
+ROWS_PER_DAY = 24 * 12
+
+# Therapy settings used to generate and to evaluate the data
+SETTINGS = {'basal': 0.8, 'isf': 45, 'cr': 10, 'insulin_type': 'novolog'}
+
+
+def _effect_kernel(curve, length):
+    # Glucose change per 5 minutes caused by one unit of insulin or one gram of carbs
+    return -np.diff(curve(np.arange(length + 1)))
+
+
+def generate_subject(days=1, seed=0, start='2024-01-01', gap_fraction=0.01):
+    """
+    Generate data for one subject.
+
+    :param days: The number of days. Fractions are allowed.
+    :param seed: The random seed.
+    :param start: The first date.
+    :param gap_fraction: The fraction of CGM readings that are missing.
+    :return: A DataFrame with a 5-minute DatetimeIndex and 'CGM', 'bolus', 'basal' and 'carbs' columns.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = max(int(days * ROWS_PER_DAY), 2)
+    index = pd.date_range(start=start, periods=n_rows, freq='5min')
+    n_days = (n_rows - 1) // ROWS_PER_DAY + 1
+
+    # Three meals a day with jittered times and sizes, and occasional snacks
+    carbs = np.zeros(n_rows)
+    for hour, grams in [(7.5, 45), (12.5, 60), (18.5, 70)]:
+        rows = np.arange(n_days) * ROWS_PER_DAY + ((hour + rng.normal(0, 0.75, n_days)) * 12).astype(int)
+        rows = rows[(rows >= 0) & (rows < n_rows)]
+        carbs[rows] += np.round(np.clip(rng.normal(grams, grams / 3, len(rows)), 10, 150))
+    snacks = rng.random(n_rows) < 1 / (ROWS_PER_DAY / 2)
+    carbs[snacks] += np.round(rng.uniform(5, 25, snacks.sum()))
+
+    # Meal boluses with some under- and over-dosing, and occasional correction boluses
+    bolus = np.round(carbs / SETTINGS['cr'] * rng.uniform(0.7, 1.2, n_rows), 2)
+    corrections = rng.random(n_rows) < 1 / ROWS_PER_DAY
+    bolus[corrections] += np.round(rng.uniform(0.5, 3, corrections.sum()), 2)
+
+    # Automated temp basals around the scheduled rate
+    basal = np.round(SETTINGS['basal'] * np.clip(rng.normal(1, 0.5, n_rows), 0, 3), 2)
+
+    # Glucose from the carb and insulin effects, a circadian drift and noise, pulled back towards 120 mg/dL
+    insulin_kernel = _effect_kernel(lambda t: insulin_percent_effect_remaining_array(t * 5, 360, 75, 10), 74)
+    carb_kernel = _effect_kernel(lambda t: 1 - percent_absorption_at_percent_time_array(t / 36), 36)
+    net_insulin = bolus + (basal - SETTINGS['basal']) / 12
+    changes = (np.convolve(carbs, carb_kernel)[:n_rows] * SETTINGS['isf'] / SETTINGS['cr']
+               - np.convolve(net_insulin, insulin_kernel)[:n_rows] * SETTINGS['isf']
+               + 0.5 * np.sin(2 * np.pi * np.arange(n_rows) / ROWS_PER_DAY)
+               + rng.normal(0, 2, n_rows))
+    cgm = np.empty(n_rows)
+    glucose = 120.0
+    for i, change in enumerate(changes):
+        glucose += change - 0.02 * (glucose - 120)
+        cgm[i] = glucose
+    cgm = np.round(np.clip(cgm, 40, 400))
+    cgm[rng.random(n_rows) < gap_fraction] = np.nan
+
+    return pd.DataFrame({
+        'CGM': cgm,
+        'bolus': bolus,
+        'basal': basal,
+        'carbs': carbs,
+    }, index=index)
+
+
+def iter_subjects(n_subjects, days=1, seed=0, start='2024-01-01'):
+    """
+    Generate subjects one at a time, so that large cohorts do not have to be held in memory.
+
+    :return: An iterator of (subject id, DataFrame) tuples.
+    """
+    for subject in range(n_subjects):
+        yield f'subject_{subject}', generate_subject(days, seed=[seed, subject], start=start)
+
+
+def generate_cohort(n_subjects, days=1, seed=0, start='2024-01-01'):
+    """
+    Generate many subjects in one long DataFrame with a 'subject_id' column, as used by api.add_iob_and_ice.
+    """
+    return pd.concat([data.assign(subject_id=subject) for subject, data in
+                      iter_subjects(n_subjects, days, seed, start)])
@@ -1,14 +1,37 @@
 """
 This file provides an API for calling the functions in the dynamic library. These functions are c-embeddings
 for swift functions, found in Sources/LoopAlgorithmToPython/LoopAlgorithmToPython.swift.
+
+Importing this module is cheap: the dynamic library (and with it the Swift runtime) is loaded on the first native
+call, and pandas is only imported by the functions that need it.
 """
 import numpy as np
-import pandas as pd
 
 import loop_to_python_api.helpers as helpers
+from loop_to_python_api.exceptions import WorkerCrashError, error_from_code
+from loop_to_python_api.cache import cached, enable_cache, disable_cache, get_cache_stats
+import loop_to_python_api.profiling as profiling
+from loop_to_python_api.profiling import enable_profiling, disable_profiling, profile, get_native_stats
+from loop_to_python_api.curves import (
+    percent_absorption_at_percent_time_array,
+    piecewise_linear_percent_rate_at_percent_time_array,
+    linear_percent_rate_at_percent_time_array,
+    insulin_percent_effect_remaining_array,
+    insulin_kernel,
+    insulin_on_board_array,
+    insulin_effect_array,
+)
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import ctypes
+import json
 import os
+import threading
+import time
+import typing
 import ast
+import warnings
+import weakref
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 dlibs_dir = os.path.join(current_dir, 'dlibs')
@@ -25,81 +48,422 @@ elif os.name == 'nt':  # Windows
 else:
     raise OSError("Unsupported operating system")
 
-swift_lib = ctypes.CDLL(lib_path)
 
 
-# This function helps with providing more informative error messages if the code fails
-def initialize_exception_handlers():
-    # Define the function prototypes
-    initializeExceptionHandler = swift_lib.initializeExceptionHandler
-    initializeExceptionHandler.restype = None
+# Mirrors of the result types in Sources/CLoopAlgorithmToPython/include/CLoopAlgorithmToPython.h. The buffers are owned
+# by the caller, and are released with the matching free function after being copied.
+class LoopDoubleArray(ctypes.Structure):
+    _fields_ = [("values", ctypes.POINTER(ctypes.c_double)),
+                ("count", ctypes.c_int64)]
+
+
+class LoopTimeSeries(ctypes.Structure):
+    _fields_ = [("values", ctypes.POINTER(ctypes.c_double)),
+                ("dates", ctypes.POINTER(ctypes.c_double)),
+                ("count", ctypes.c_int64)]
+
+
+class LoopString(ctypes.Structure):
+    _fields_ = [("data", ctypes.POINTER(ctypes.c_char)),
+                ("length", ctypes.c_int64)]
+
+
+class LoopTimeSeriesBatch(ctypes.Structure):
+    _fields_ = [("series", LoopTimeSeries),
+                ("offsets", ctypes.POINTER(ctypes.c_int64)),
+                ("count", ctypes.c_int64)]
+
+
+class LoopAlgorithmResult(ctypes.Structure):
+    _fields_ = [("prediction", LoopTimeSeries),
+                ("insulinCounteractionEffects", LoopTimeSeries),
+                ("insulinEffects", LoopTimeSeries),
+                ("carbEffects", LoopTimeSeries),
+                ("retrospectiveCorrectionEffects", LoopTimeSeries),
+                ("momentumEffects", LoopTimeSeries),
+                ("activeInsulin", ctypes.c_double),
+                ("activeCarbs", ctypes.c_double),
+                ("recommendation", LoopString),
+                ("recommendationError", LoopString)]
+
+
+class LoopSweepResult(ctypes.Structure):
+    _fields_ = [("results", ctypes.POINTER(LoopAlgorithmResult)),
+                ("count", ctypes.c_int64)]
+
+
+class LoopReplayResult(ctypes.Structure):
+    _fields_ = [("dates", ctypes.POINTER(ctypes.c_double)),
+                ("automaticBolus", ctypes.POINTER(ctypes.c_double)),
+                ("tempBasalRate", ctypes.POINTER(ctypes.c_double)),
+                ("tempBasalDuration", ctypes.POINTER(ctypes.c_double)),
+                ("manualBolus", ctypes.POINTER(ctypes.c_double)),
+                ("activeInsulin", ctypes.POINTER(ctypes.c_double)),
+                ("activeCarbs", ctypes.POINTER(ctypes.c_double)),
+                ("predictions", ctypes.POINTER(ctypes.c_double)),
+                ("status", ctypes.POINTER(ctypes.c_int32)),
+                ("count", ctypes.c_int64),
+                ("horizonCount", ctypes.c_int64)]
+
+
+class LoopError(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_int32),
+                ("message", ctypes.POINTER(ctypes.c_char))]
+
+
+class LoopProfilingStats(ctypes.Structure):
+    _fields_ = [("calls", ctypes.c_int64 * len(profiling.NATIVE_STAGES)),
+                ("totalNanoseconds", ctypes.c_int64 * len(profiling.NATIVE_STAGES)),
+                ("maxNanoseconds", ctypes.c_int64 * len(profiling.NATIVE_STAGES)),
+                ("histogram", ctypes.c_int64 * profiling.HISTOGRAM_BUCKETS * len(profiling.NATIVE_STAGES))]
+
+
+_double_array = ctypes.POINTER(ctypes.c_double)
+_error = ctypes.POINTER(LoopError)
+
+# The argument and return types of every native function, declared once on the first use of each function. The ctypes
+# function objects are shared between threads, so they are never modified after this. ctypes releases the GIL for the
+# duration of each native call, and the native functions keep no shared state, so calls can run concurrently from
+# threads. A columnar input handle must only be used by one thread at a time.
+_PROTOTYPES = {
+    'freeLoopDoubleArray': ([LoopDoubleArray], None),
+    'freeLoopTimeSeries': ([LoopTimeSeries], None),
+    'freeLoopString': ([LoopString], None),
+    'freeLoopError': ([LoopError], None),
+    'freeLoopAlgorithmResult': ([LoopAlgorithmResult], None),
+    'initializeExceptionHandler': ([], None),
+    'initializeSignalHandlers': ([], None),
+    'generatePrediction': ([ctypes.c_char_p, _error], LoopDoubleArray),
+    'getPredictionDates': ([ctypes.c_char_p, _error], LoopString),
+    'getPredictionValuesAndDates': ([ctypes.c_char_p, _error], LoopTimeSeries),
+    'getDoseRecommendations': ([ctypes.c_char_p, _error], LoopString),
+    'getGlucoseEffectVelocity': ([ctypes.c_char_p, _error], LoopDoubleArray),
+    'getGlucoseEffectVelocityDates': ([ctypes.c_char_p, _error], LoopString),
+    'getGlucoseEffectVelocityAndDates': ([ctypes.c_char_p, _error], LoopString),
+    'getInsulinCounteractionEffects': ([ctypes.c_char_p, _error], LoopTimeSeries),
+    'getActiveCarbs': ([ctypes.c_char_p, _error], ctypes.c_double),
+    'getActiveInsulin': ([ctypes.c_char_p, _error], ctypes.c_double),
+    'getActiveInsulinBatch': ([ctypes.c_char_p, _double_array, _double_array, ctypes.c_int64, _double_array, _error],
+                              None),
+    'getLoopRecommendations': ([ctypes.c_char_p, _error], LoopString),
+    'insulinPercentEffectRemaining': ([ctypes.c_char_p, _error], ctypes.c_double),
+    'getDynamicCarbsOnBoard': ([ctypes.c_char_p, _error], ctypes.c_double),
+    'getDynamicCarbsOnBoardSeries': ([ctypes.c_char_p, ctypes.c_int32, ctypes.c_double, _error], LoopTimeSeriesBatch),
+    'freeLoopTimeSeriesBatch': ([LoopTimeSeriesBatch], None),
+    'runAlgorithm': ([ctypes.c_char_p, _error], LoopAlgorithmResult),
+    'percentAbsorptionAtPercentTime': ([ctypes.c_double], ctypes.c_double),
+    'percentRateAtPercentTime': ([ctypes.c_double], ctypes.c_double),
+    'linearPercentRateAtPercentTime': ([ctypes.c_double], ctypes.c_double),
+    'createColumnarInput': ([], ctypes.c_void_p),
+    'freeColumnarInput': ([ctypes.c_void_p], None),
+    'setColumnarGlucose': ([ctypes.c_void_p, _double_array, _double_array, ctypes.c_int64, _error], None),
+    'setColumnarDoses': ([ctypes.c_void_p, _double_array, _double_array, _double_array, _double_array, ctypes.c_int64,
+                          ctypes.c_char_p, _error], None),
+    'setColumnarCarbs': ([ctypes.c_void_p, _double_array, _double_array, _double_array, ctypes.c_int64, _error], None),
+    'setColumnarSchedule': ([ctypes.c_void_p, ctypes.c_int32, _double_array, _double_array, _double_array,
+                             ctypes.c_int64, _error], None),
+    'appendColumnarGlucose': ([ctypes.c_void_p, _double_array, _double_array, ctypes.c_int64, _error], None),
+    'appendColumnarDoses': ([ctypes.c_void_p, _double_array, _double_array, _double_array, _double_array,
+                             ctypes.c_int64, _error], None),
+    'appendColumnarCarbs': ([ctypes.c_void_p, _double_array, _double_array, _double_array, ctypes.c_int64, _error],
+                            None),
+    'trimColumnarInput': ([ctypes.c_void_p, ctypes.c_double, _error], None),
+    'setColumnarTarget': ([ctypes.c_void_p, _double_array, _double_array, _double_array, _double_array, ctypes.c_int64,
+                           _error], None),
+    'setColumnarSettings': ([ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double,
+                             ctypes.c_int32, ctypes.c_char_p, ctypes.c_int32, ctypes.c_int32, _error], None),
+    'generatePredictionColumnar': ([ctypes.c_void_p, _error], LoopDoubleArray),
+    'getPredictionValuesAndDatesColumnar': ([ctypes.c_void_p, _error], LoopTimeSeries),
+    'getInsulinCounteractionEffectsColumnar': ([ctypes.c_void_p, _error], LoopTimeSeries),
+    'getActiveInsulinColumnar': ([ctypes.c_void_p, _error], ctypes.c_double),
+    'getActiveCarbsColumnar': ([ctypes.c_void_p, _error], ctypes.c_double),
+    'getLoopRecommendationsColumnar': ([ctypes.c_void_p, _error], LoopString),
+    'runAlgorithmColumnar': ([ctypes.c_void_p, _error], LoopAlgorithmResult),
+    'runSettingsSweep': ([ctypes.c_void_p, _double_array, _double_array, _double_array, _double_array, _double_array,
+                          ctypes.c_int64, ctypes.c_int32, _error], LoopSweepResult),
+    'freeLoopSweepResult': ([LoopSweepResult], None),
+    'runReplay': ([ctypes.c_void_p, _double_array, ctypes.c_int64, _double_array, ctypes.c_int64, ctypes.c_double,
+                   ctypes.c_int32, _error], LoopReplayResult),
+    'freeLoopReplayResult': ([LoopReplayResult], None),
+    'setProfilingEnabled': ([ctypes.c_int32], None),
+    'isProfilingEnabled': ([], ctypes.c_int32),
+    'getProfilingStats': ([ctypes.POINTER(LoopProfilingStats)], None),
+    'resetProfilingStats': ([], None),
+}
+
+
+# Must match LOOP_ABI_VERSION in Sources/CLoopAlgorithmToPython/include/CLoopAlgorithmToPython.h
+_ABI_VERSION = 2
+
+
+def _check_abi_version(lib, path):
+    # Libraries built before the version was exported do not have the function
+    try:
+        get_version = lib.getLibraryABIVersion
+    except AttributeError:
+        version = None
+    else:
+        get_version.argtypes = []
+        get_version.restype = ctypes.c_int32
+        version = get_version()
+    if version != _ABI_VERSION:
+        raise OSError(f"The dynamic library at {path} is out of date (interface version {version}, expected "
+                      f"{_ABI_VERSION}). Rebuild it with build.sh.")
+
+
+def _declare_prototype(lib, name):
+    try:
+        function = getattr(lib, name)
+    except AttributeError:
+        raise OSError(f"The dynamic library does not export {name}, so it is out of date. Rebuild it with "
+                      f"build.sh.") from None
+    argtypes, restype = _PROTOTYPES[name]
+    function.argtypes = argtypes
+    function.restype = restype
+    return function
+
+
+class _Library:
+    """
+    The dynamic library, loaded on first use. Each prototype is declared on the first use of its function, and the
+    ctypes function is stored as an attribute, so later lookups are plain attribute reads that do not go through
+    __getattr__. A function missing from an out of date library only fails when it is used.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._cdll = None
+
+    @property
+    def loaded(self):
+        return self._cdll is not None
+
+    def load(self):
+        with self._lock:
+            if self._cdll is None:
+                cdll = ctypes.CDLL(self._path)
+                _check_abi_version(cdll, self._path)
+                self._cdll = cdll
+        return self._cdll
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet, which are the functions that have not been used
+        if name.startswith('_'):
+            raise AttributeError(name)
+        cdll = self.load()
+        with self._lock:
+            # Another thread may have declared the function while this one waited for the lock
+            function = self.__dict__.get(name)
+            if function is None:
+                if name in _PROTOTYPES:
+                    function = _declare_prototype(cdll, name)
+                else:
+                    function = getattr(cdll, name)
+                setattr(self, name, function)
+        return function
+
+
+swift_lib = _Library(lib_path)
+
+
+def _call(function, *args):
+    """
+    Call a native function that takes a trailing LoopError pointer, and raise the matching LoopAlgorithmError
+    (see loop_to_python_api.exceptions) if it reports an error.
+    """
+    error = LoopError()
+    profiler = profiling._active_profiler
+    if profiler is None:
+        result = function(*args, ctypes.byref(error))
+    else:
+        start = time.perf_counter()
+        result = function(*args, ctypes.byref(error))
+        profiler.record('native_call', time.perf_counter() - start)
+    if error.code != 0:
+        try:
+            message = ctypes.string_at(error.message).decode('utf-8') if error.message else ''
+        finally:
+            swift_lib.freeLoopError(error)
+        raise error_from_code(error.code, message)
+    return result
+
+
+class _NativeResult:
+    """
+    Owns a native result whose buffers are wrapped into numpy arrays without copying. The result is released with its
+    free function when the last array wrapping one of its buffers is garbage collected.
+    """
+
+    def __init__(self, result, free):
+        finalizer = weakref.finalize(self, free, result)
+        # Memory still in use at exit is released by the operating system
+        finalizer.atexit = False
+
+    def wrap(self, pointer, count):
+        """
+        A float64 numpy array using the buffer of the result. The array keeps the result alive.
+        """
+        if count == 0:
+            return np.empty(0)
+        return np.asarray(_NativeBuffer(self, pointer, count))
+
+
+class _NativeBuffer:
+    def __init__(self, owner, pointer, count):
+        self._owner = owner
+        self.__array_interface__ = {
+            'shape': (count,),
+            'typestr': '<f8',
+            'data': (ctypes.cast(pointer, ctypes.c_void_p).value, False),
+            'version': 3,
+        }
+
+
+@profiling.timed('parse_output')
+def _to_numpy(result, copy=True):
+    """
+    Copy a LoopDoubleArray into a numpy array and release the native buffer. Without copy, the array uses the native
+    buffer, which is released when the array is garbage collected.
+    """
+    if not copy:
+        return _NativeResult(result, swift_lib.freeLoopDoubleArray).wrap(result.values, result.count)
+    try:
+        if result.count == 0:
+            return np.empty(0)
+        return np.ctypeslib.as_array(result.values, shape=(result.count,)).copy()
+    finally:
+        swift_lib.freeLoopDoubleArray(result)
+
+
+def _copy_series(series):
+    if series.count == 0:
+        return np.empty(0), np.empty(0)
+    values = np.ctypeslib.as_array(series.values, shape=(series.count,)).copy()
+    dates = np.ctypeslib.as_array(series.dates, shape=(series.count,)).copy()
+    return values, dates
 
-    initializeSignalHandlers = swift_lib.initializeSignalHandlers
-    initializeSignalHandlers.restype = None
 
-    # Initialize the exception handler and signal handlers
-    initializeExceptionHandler()
-    initializeSignalHandlers()
+@profiling.timed('parse_output')
+def _to_numpy_series(result, copy=True):
+    """
+    Copy a LoopTimeSeries into numpy arrays of values and dates (seconds since 1970), and release the native buffers.
+    Without copy, the arrays use the native buffers, which are released when both arrays are garbage collected.
+    """
+    if not copy:
+        owner = _NativeResult(result, swift_lib.freeLoopTimeSeries)
+        return owner.wrap(result.values, result.count), owner.wrap(result.dates, result.count)
+    try:
+        return _copy_series(result)
+    finally:
+        swift_lib.freeLoopTimeSeries(result)
+
+
+@profiling.timed('parse_output')
+def _to_str(result):
+    """
+    Copy a LoopString into a Python string and release the native buffer.
+    """
+    try:
+        return ctypes.string_at(result.data, result.length).decode('utf-8')
+    finally:
+        swift_lib.freeLoopString(result)
+
+
+# This function helps with providing more informative error messages if the code fails.
+# The handlers are process-global, so they are installed once no matter how many times this is called.
+def initialize_exception_handlers():
+    swift_lib.initializeExceptionHandler()
+    swift_lib.initializeSignalHandlers()
 
 
+@cached
 def generate_prediction(json_file, len=72):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.generatePrediction.argtypes = [ctypes.c_char_p]
-    swift_lib.generatePrediction.restype = ctypes.POINTER(ctypes.c_double)
+    result = _to_numpy(_call(swift_lib.generatePrediction, json_bytes))
+    return result[:len].tolist()
+
+
+def generate_predictions(json_files, len=72, workers=None):
+    """
+    Generate predictions for many inputs concurrently with a thread pool. The native calls release the GIL, so this
+    runs in parallel without the pickling overhead of a process pool.
+
+    :param json_files: An iterable of JSON data inputs, in the same format as for generate_prediction.
+    :param len: The number of predicted values to return for each input.
+    :param workers: The number of threads. Defaults to the ThreadPoolExecutor default.
+    :return: A list with the predicted values for each input, in the same order as the inputs.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda json_file: generate_prediction(json_file, len), json_files))
+
 
-    result = swift_lib.generatePrediction(json_bytes)
-    return [result[i] for i in range(len)]
+async def generate_prediction_async(json_file, len=72):
+    """
+    Awaitable version of generate_prediction. The prediction runs in a worker thread, so the event loop keeps serving
+    other requests while it runs.
+    """
+    import asyncio
+    return await asyncio.to_thread(generate_prediction, json_file, len)
 
 
 def get_prediction_dates(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getPredictionDates.argtypes = [ctypes.c_char_p]
-    swift_lib.getPredictionDates.restype = ctypes.c_char_p
-
-    result = swift_lib.getPredictionDates(json_bytes).decode('utf-8')
+    result = _to_str(_call(swift_lib.getPredictionDates, json_bytes))
     date_list = result.split(',')[:-1]
     #date_list = [pd.to_datetime(date) for date in date_list]
 
     return date_list
 
 
+def _get_prediction_series(json_file):
+    json_bytes = helpers.get_bytes_from_json(json_file)
+
+    return _to_numpy_series(_call(swift_lib.getPredictionValuesAndDates, json_bytes))
+
+
+def get_prediction(json_file):
+    """
+    Run the prediction once, and get the predicted glucose values together with their dates.
+
+    :param json_file: The JSON data input. See python tests and test files for example inputs.
+    :return: A tuple of numpy arrays with the predicted values (mg/dL) and the prediction dates (datetime64, UTC).
+    """
+    values, dates = _get_prediction_series(json_file)
+    return values, helpers.get_datetimes_from_epoch_seconds(dates)
+
+
 def get_prediction_values_and_dates(json_file):
-    dates = get_prediction_dates(json_file)
-    values = generate_prediction(json_file, len(dates))
-    return values, dates
+    values, dates = _get_prediction_series(json_file)
+    return values.tolist(), helpers.get_iso_strings_from_epoch_seconds(dates)
 
 
 def get_dose_recommendations(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getDoseRecommendations.argtypes = [ctypes.c_char_p]
-    swift_lib.getDoseRecommendations.restype = ctypes.c_char_p
+    result = _to_str(_call(swift_lib.getDoseRecommendations, json_bytes))
+    return _parse_dose_recommendations(result)
 
-    result = swift_lib.getDoseRecommendations(json_bytes).decode('utf-8')
-    result = ast.literal_eval(result)
-    return result
+
+@profiling.timed('parse_output')
+def _parse_dose_recommendations(result):
+    return ast.literal_eval(result)
 
 
 # "Glucose effect velocity" is equivalent to insulin counteraction effect (ICE)
 def get_glucose_effect_velocity(json_file, len=72):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getGlucoseEffectVelocity.argtypes = [ctypes.c_char_p]
-    swift_lib.getGlucoseEffectVelocity.restype = ctypes.POINTER(ctypes.c_double)
-
-    result = swift_lib.getGlucoseEffectVelocity(json_bytes)
-    return [result[i] for i in range(len)]
+    result = _to_numpy(_call(swift_lib.getGlucoseEffectVelocity, json_bytes))
+    return result[:len].tolist()
 
 
 def get_glucose_effect_velocity_dates(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getGlucoseEffectVelocityDates.argtypes = [ctypes.c_char_p]
-    swift_lib.getGlucoseEffectVelocityDates.restype = ctypes.c_char_p
-
-    result = swift_lib.getGlucoseEffectVelocityDates(json_bytes).decode('utf-8')
+    result = _to_str(_call(swift_lib.getGlucoseEffectVelocityDates, json_bytes))
     date_list = result.split(',')[:-1]
     #date_list = [pd.to_datetime(date) for date in date_list]
 
@@ -109,10 +473,13 @@ def get_glucose_effect_velocity_dates(json_file):
 def get_glucose_effect_velocity_and_dates(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getGlucoseEffectVelocityAndDates.argtypes = [ctypes.c_char_p]
-    swift_lib.getGlucoseEffectVelocityAndDates.restype = ctypes.c_char_p
+    result = _to_str(_call(swift_lib.getGlucoseEffectVelocityAndDates, json_bytes))
+    return _parse_values_and_dates(result)
 
-    result = swift_lib.getGlucoseEffectVelocityAndDates(json_bytes).decode('utf-8')
+
+@profiling.timed('parse_output')
+def _parse_values_and_dates(result):
+    import pandas as pd
 
     values = []
     dates = []
@@ -125,133 +492,614 @@ def get_glucose_effect_velocity_and_dates(json_file):
     return values, dates
 
 
-def get_active_carbs(json_file):
+def get_insulin_counteraction_effects(json_file, copy=True):
+    """
+    Compute the insulin counteraction effects (ICE) for the whole glucose history in one call, without running the
+    dose recommendation.
+
+    :param json_file: The JSON data input, in the same format as for get_loop_recommendations.
+    :param copy: Copy the values out of the native buffer. Without copy, the values array uses the native buffer
+    (zero-copy), which is released when the array is garbage collected.
+    :return: A tuple of numpy arrays with the ICE values (mg/dL*s) and their start dates (datetime64, UTC).
+    """
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getActiveCarbs.argtypes = [ctypes.c_char_p]
-    swift_lib.getActiveCarbs.restype = ctypes.c_double
+    values, dates = _to_numpy_series(_call(swift_lib.getInsulinCounteractionEffects, json_bytes), copy=copy)
+    return values, helpers.get_datetimes_from_epoch_seconds(dates)
+
+
+def get_active_carbs(json_file):
+    json_bytes = helpers.get_bytes_from_json(json_file)
 
-    return swift_lib.getActiveCarbs(json_bytes)
+    return _call(swift_lib.getActiveCarbs, json_bytes)
 
 
+@cached
 def get_active_insulin(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getActiveInsulin.argtypes = [ctypes.c_char_p]
-    swift_lib.getActiveInsulin.restype = ctypes.c_double
+    return _call(swift_lib.getActiveInsulin, json_bytes)
 
-    return swift_lib.getActiveInsulin(json_bytes)
 
-def get_loop_recommendations(json_file, len=72):
+def get_active_insulin_batch(json_file, dates, window_starts=None):
+    """
+    Compute insulin on board at many dates with a single call to the dynamic library.
+
+    :param json_file: The JSON data input, in the same format as for get_active_insulin. "predictionStart" is ignored.
+    :param dates: Datetimes to evaluate insulin on board at.
+    :param window_starts: Optional datetimes, one per date. For each date, only doses starting at or after the window
+    start (and before the date) are included. By default, all doses before each date are included.
+    :return: A numpy array with the insulin on board at each date.
+    """
     json_bytes = helpers.get_bytes_from_json(json_file)
+    timestamps = helpers.get_epoch_seconds(dates)
+    output = np.empty_like(timestamps)
+
+    if window_starts is None:
+        window_start_pointer = None
+    else:
+        window_starts = helpers.get_epoch_seconds(window_starts)
+        if len(window_starts) != len(timestamps):
+            raise ValueError("window_starts must have the same length as dates.")
+        window_start_pointer = window_starts.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
 
-    swift_lib.getLoopRecommendations.argtypes = [ctypes.c_char_p]
-    swift_lib.getLoopRecommendations.restype = ctypes.c_char_p
+    _call(swift_lib.getActiveInsulinBatch, json_bytes, timestamps.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+          window_start_pointer, len(timestamps), output.ctypes.data_as(ctypes.POINTER(ctypes.c_double)))
+    return output
 
-    result = swift_lib.getLoopRecommendations(json_bytes).decode('utf-8')
+
+@cached
+def get_loop_recommendations(json_file, len=72):
+    json_bytes = helpers.get_bytes_from_json(json_file)
+
+    result = _to_str(_call(swift_lib.getLoopRecommendations, json_bytes))
     return result
 
-def add_insulin_counteraction_effect_to_df(df, basal, isf, cr, insulin_type='novolog', batch_size=300, overlap=72):
+# The columnar functions take the arrays returned by helpers.get_columnar_loop_prediction_input_from_df or
+# helpers.get_columnar_input_from_json instead of JSON. The arrays are passed to the dynamic library as pointers.
+COLUMNAR_SCHEDULE_KINDS = {'basal': 0, 'isf': 1, 'cr': 2}
+RECOMMENDATION_TYPES = ["automaticBolus", "tempBasal", "manualBolus"]
+
+
+def _double_pointer(array):
+    return array.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+
+def _create_columnar_input(columns):
+    """
+    Create a native input handle from columnar arrays. The handle must be released with swift_lib.freeColumnarInput.
+    """
+
+    # The arrays must stay alive until the setters have copied them
+    arrays = {key: np.ascontiguousarray(value, dtype=np.float64) for key, value in columns.items()
+              if isinstance(value, np.ndarray)}
+    insulin_type = columns.get('insulin_type', 'novolog')
+    helpers.validate_insulin_type(insulin_type)
+    recommendation_type = columns.get('recommendation_type', 'automaticBolus')
+    helpers.validate_recommendation_type(recommendation_type)
+    suspend_threshold = columns.get('suspend_threshold')
+
+    handle = swift_lib.createColumnarInput()
+    try:
+        _call(swift_lib.setColumnarGlucose, handle, _double_pointer(arrays['glucose_dates']),
+              _double_pointer(arrays['glucose_values']), len(arrays['glucose_dates']))
+        _call(swift_lib.setColumnarDoses, handle, _double_pointer(arrays['dose_start_dates']),
+              _double_pointer(arrays['dose_end_dates']), _double_pointer(arrays['dose_volumes']),
+              _double_pointer(arrays['dose_types']), len(arrays['dose_start_dates']), insulin_type.encode('utf-8'))
+        _call(swift_lib.setColumnarCarbs, handle, _double_pointer(arrays['carb_dates']),
+              _double_pointer(arrays['carb_grams']), _double_pointer(arrays['carb_absorption_times']),
+              len(arrays['carb_dates']))
+        for name, kind in COLUMNAR_SCHEDULE_KINDS.items():
+            _call(swift_lib.setColumnarSchedule, handle, kind, _double_pointer(arrays[f'{name}_start_dates']),
+                  _double_pointer(arrays[f'{name}_end_dates']), _double_pointer(arrays[f'{name}_values']),
+                  len(arrays[f'{name}_start_dates']))
+        _call(swift_lib.setColumnarTarget, handle, _double_pointer(arrays['target_start_dates']),
+              _double_pointer(arrays['target_end_dates']), _double_pointer(arrays['target_lower']),
+              _double_pointer(arrays['target_upper']), len(arrays['target_start_dates']))
+        _call(swift_lib.setColumnarSettings, handle, columns['prediction_start'], columns.get('max_basal_rate', 0.0),
+              columns.get('max_bolus', 0.0), np.nan if suspend_threshold is None else suspend_threshold,
+              RECOMMENDATION_TYPES.index(recommendation_type), insulin_type.encode('utf-8'),
+              int(columns.get('use_integral_retrospective_correction', False)),
+              int(columns.get('include_positive_velocity_and_rc', True)))
+    except Exception:
+        swift_lib.freeColumnarInput(handle)
+        raise
+    return handle
+
+
+def _call_columnar(function, columns, *args):
+    handle = _create_columnar_input(columns)
+    try:
+        return _call(function, handle, *args)
+    finally:
+        swift_lib.freeColumnarInput(handle)
+
+
+def generate_prediction_columnar(columns, len=72):
+    result = _to_numpy(_call_columnar(swift_lib.generatePredictionColumnar, columns))
+    return result[:len].tolist()
+
+
+def get_prediction_columnar(columns, copy=True):
+    values, dates = _to_numpy_series(_call_columnar(swift_lib.getPredictionValuesAndDatesColumnar, columns),
+                                     copy=copy)
+    return values, helpers.get_datetimes_from_epoch_seconds(dates)
+
+
+def get_insulin_counteraction_effects_columnar(columns, copy=True):
+    values, dates = _to_numpy_series(_call_columnar(swift_lib.getInsulinCounteractionEffectsColumnar, columns),
+                                     copy=copy)
+    return values, helpers.get_datetimes_from_epoch_seconds(dates)
+
+
+def get_active_carbs_columnar(columns):
+    return _call_columnar(swift_lib.getActiveCarbsColumnar, columns)
+
+
+def get_active_insulin_columnar(columns):
+    return _call_columnar(swift_lib.getActiveInsulinColumnar, columns)
+
+
+def get_loop_recommendations_columnar(columns):
+    return _to_str(_call_columnar(swift_lib.getLoopRecommendationsColumnar, columns))
+
+
+class AlgorithmResult(typing.NamedTuple):
+    """
+    All outputs of one algorithm run. Dates are datetime64 (UTC). Glucose series are in mg/dL, and insulin
+    counteraction effects in mg/dL*s. active_carbs is NaN if the algorithm returned none. recommendation is the
+    parsed dose recommendation, or None if it failed, in which case recommendation_error holds the reason.
+    """
+    prediction_values: np.ndarray
+    prediction_dates: np.ndarray
+    ice_values: np.ndarray
+    ice_dates: np.ndarray
+    insulin_effect_values: np.ndarray
+    insulin_effect_dates: np.ndarray
+    carb_effect_values: np.ndarray
+    carb_effect_dates: np.ndarray
+    retrospective_correction_values: np.ndarray
+    retrospective_correction_dates: np.ndarray
+    momentum_values: np.ndarray
+    momentum_dates: np.ndarray
+    active_insulin: float
+    active_carbs: float
+    recommendation: typing.Optional[dict]
+    recommendation_error: typing.Optional[str]
+
+
+def _copy_algorithm_result(result):
+    series = []
+    for name in ['prediction', 'insulinCounteractionEffects', 'insulinEffects', 'carbEffects',
+                 'retrospectiveCorrectionEffects', 'momentumEffects']:
+        values, dates = _copy_series(getattr(result, name))
+        series += [values, helpers.get_datetimes_from_epoch_seconds(dates)]
+    recommendation = ctypes.string_at(result.recommendation.data, result.recommendation.length).decode('utf-8')
+    error = ctypes.string_at(result.recommendationError.data, result.recommendationError.length).decode('utf-8')
+    return AlgorithmResult(*series, result.activeInsulin, result.activeCarbs,
+                           json.loads(recommendation) if recommendation else None, error or None)
+
+
+@profiling.timed('parse_output')
+def _to_algorithm_result(result):
+    """
+    Copy a LoopAlgorithmResult into an AlgorithmResult and release the native buffers.
+    """
+    try:
+        return _copy_algorithm_result(result)
+    finally:
+        swift_lib.freeLoopAlgorithmResult(result)
+
+
+def run_algorithm(json_file):
+    """
+    Run the algorithm once, and get the prediction, effects, active insulin, active carbs and dose recommendation
+    together. This replaces calling generate_prediction, get_glucose_effect_velocity_and_dates, get_active_insulin,
+    get_active_carbs and get_loop_recommendations separately, which each decode the input and run the algorithm.
+
+    Unlike generate_prediction, the prediction starts at "predictionStart", as used for the recommendation.
+
+    :param json_file: The JSON data input, in the same format as for get_loop_recommendations.
+    :return: An AlgorithmResult.
+    """
+    json_bytes = helpers.get_bytes_from_json(json_file)
+    return _to_algorithm_result(_call(swift_lib.runAlgorithm, json_bytes))
+
+
+def run_algorithm_columnar(columns):
+    return _to_algorithm_result(_call_columnar(swift_lib.runAlgorithmColumnar, columns))
+
+
+SWEEP_SETTINGS = ['basal', 'isf', 'cr', 'target_lower', 'target_upper']
+
+
+class SweepResult(typing.NamedTuple):
+    """
+    The outputs of a settings sweep, stacked with one row per settings combination. Series that are shorter than the
+    longest one are padded with NaN values and NaT dates. The settings are NaN where the input schedule was kept.
+    """
+    settings: typing.Dict[str, np.ndarray]
+    prediction_values: np.ndarray
+    prediction_dates: np.ndarray
+    ice_values: np.ndarray
+    ice_dates: np.ndarray
+    active_insulin: np.ndarray
+    active_carbs: np.ndarray
+    recommendations: typing.List[typing.Optional[dict]]
+    recommendation_errors: typing.List[typing.Optional[str]]
+    results: typing.List[AlgorithmResult]
+
+
+def _stack(arrays, fill):
+    length = max((len(array) for array in arrays), default=0)
+    dtype = arrays[0].dtype if arrays else np.float64
+    stacked = np.full((len(arrays), length), fill, dtype=dtype)
+    for row, array in enumerate(arrays):
+        stacked[row, :len(array)] = array
+    return stacked
+
+
+@profiling.timed('parse_output')
+def _to_sweep_result(result, settings):
+    try:
+        results = [_copy_algorithm_result(result.results[i]) for i in range(result.count)]
+    finally:
+        swift_lib.freeLoopSweepResult(result)
+    return SweepResult(
+        settings,
+        _stack([r.prediction_values for r in results], np.nan),
+        _stack([r.prediction_dates for r in results], np.datetime64('NaT')),
+        _stack([r.ice_values for r in results], np.nan),
+        _stack([r.ice_dates for r in results], np.datetime64('NaT')),
+        np.array([r.active_insulin for r in results]),
+        np.array([r.active_carbs for r in results]),
+        [r.recommendation for r in results],
+        [r.recommendation_error for r in results],
+        results,
+    )
+
+
+def sweep_settings(input_data, settings, threads=1):
+    """
+    Evaluate one history under many therapy settings with a single call to the dynamic library. The history is
+    converted to arrays and passed to the library once, instead of once per settings combination.
+
+    :param input_data: The JSON data input, in the same format as for get_loop_recommendations, or the arrays returned
+    by helpers.get_columnar_loop_prediction_input_from_df.
+    :param settings: A dictionary (or DataFrame) with one or more of the keys "basal" (U/hr), "isf" (mg/dL/U),
+    "cr" (g/U), "target_lower" and "target_upper" (mg/dL), with one value per combination, for example from
+    helpers.get_settings_grid. A value replaces the whole schedule of the input. Missing keys and NaN values keep the
+    schedule of the input. target_lower and target_upper must be given together.
+    :param threads: The number of threads the combinations are split over in the dynamic library.
+    :return: A SweepResult.
+    """
+    if isinstance(input_data, bytes):
+        input_data = json.loads(input_data)
+    if 'glucose_dates' not in input_data:
+        input_data = helpers.get_columnar_input_from_json(input_data)
+
+    unknown = set(settings.keys()) - set(SWEEP_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings {sorted(unknown)}. Valid settings are {SWEEP_SETTINGS}.")
+    arrays = {key: np.ascontiguousarray(settings[key], dtype=np.float64) for key in SWEEP_SETTINGS if key in settings}
+    counts = {len(array) for array in arrays.values()}
+    if len(counts) != 1:
+        raise ValueError("settings must contain at least one setting, with the same number of values for each.")
+    count = counts.pop()
+
+    pointers = [_double_pointer(arrays[key]) if key in arrays else None for key in SWEEP_SETTINGS]
+    result = _call_columnar(swift_lib.runSettingsSweep, input_data, *pointers, count, max(int(threads), 1))
+    full_settings = {key: arrays.get(key, np.full(count, np.nan)) for key in SWEEP_SETTINGS}
+    return _to_sweep_result(result, full_settings)
+
+
+def _with_setting_columns(columns, *settings):
+    # Adds the settings given as column names, which are run-length encoded into schedules by the helpers
+    return list(dict.fromkeys(columns + [setting for setting in settings if isinstance(setting, str)]))
+
+
+def add_insulin_counteraction_effect_to_df(df, basal, isf, cr, insulin_type='novolog', batch_size=None, overlap=72):
     """
     Takes a dataframe with at least the columns CGM, bolus, and basal.
+    The insulin counteraction effects for the whole dataframe are computed with a single call to the dynamic library.
     Important note: this function assumes you only give data for a single subject at a time.
-    # TODO: The therapy settings should be columns in the dataframe so we can support schedules.
 
     :param df: Dataframe with at least a "basal" and a "bolus" column, and a datetime index.
-    :param basal: Basal rate
-    :param isf: Insulin sensitivity factor
-    :param cr: Carbohydrate ratio (will not impact the results)
+    :param basal: Scheduled basal rate, or the name of a column with the scheduled basal rate at each row
+    :param isf: Insulin sensitivity factor, or the name of a column with the insulin sensitivity factor at each row
+    :param cr: Carbohydrate ratio, or the name of a column with the carbohydrate ratio at each row (will not impact
+    the results)
     :param insulin_type: Which insulin profile to use to compute the insulin on board
-    :param batch_size: How many samples to include in each batch operation. Might be reduced / increased, but default is optimized for general settings.
-    :param overlap: How many time steps to use for computing insulin activity. Can be reduced for some types of insulin, which will improve performance.
+    :param batch_size: Deprecated and not used, as the data is no longer processed in batches. Passing it raises a
+    DeprecationWarning.
+    :param overlap: How many time steps to leave empty at the start of the data, where there is not enough insulin
+    history to compute correct values.
     :return: The input df with columns for insulin on board and insulin counteraction effects. Unit of ICE is mg/dL*s
     """
-    data = df[['basal', 'bolus', 'CGM']].copy()  # Extract only necessary data to improve performance
+    if batch_size is not None:
+        warnings.warn("batch_size is deprecated and has no effect, as the data is no longer processed in batches.",
+                      DeprecationWarning, stacklevel=2)
+    # Extract only necessary data to improve performance
+    data = df[_with_setting_columns(['basal', 'bolus', 'CGM'], basal, isf, cr)].copy()
     data.loc[:, 'bolus'] = data['bolus'].replace(0.0, np.nan)
-    df.loc[:, "ice"] = np.nan
+    # The results are written back by row position, which costs the same for any index
+    order = helpers._get_sort_order(data.index)
+    if order is not None:
+        data = data.iloc[order]
+
+    if len(data) == 0:
+        df["ice"] = np.nan
+        return df
+
+    columns = helpers.get_columnar_loop_prediction_input_from_df(data, basal, isf, cr, data.index[-1], insulin_type)
+    ice_values, ice_dates = _to_numpy_series(_call_columnar(swift_lib.getInsulinCounteractionEffectsColumnar,
+                                                            columns), copy=False)
+
+    # ICE values are aligned to the rows by their start dates
+    row_dates = helpers.get_epoch_seconds(data.index)
+    positions = np.minimum(np.searchsorted(row_dates, ice_dates), len(row_dates) - 1)
+    matches = row_dates[positions] == ice_dates
+    ice = np.full(len(data), np.nan)
+    ice[positions[matches]] = ice_values[matches]
+
+    # We ignore the first overlap samples, because we need the insulin data to compute correct values
+    ice[:overlap] = np.nan
+    df["ice"] = helpers._in_row_order(ice, order)
+    return df
 
-    step_size = batch_size - overlap  # Determine step size based on overlap
-    num_rows = len(df)
 
-    for start in range(0, num_rows, step_size):
-        end = min(start + batch_size, num_rows)
-        batch_data = data.iloc[start:end]
-        json_data = helpers.get_json_loop_prediction_input_from_df(batch_data, basal, isf, cr, batch_data.index[-1],
-                                                                   insulin_type)
+# Seconds between the rows of a regular grid for the kernel path of add_insulin_on_board_to_df. The DataFrame helpers
+# create 5-minute doses, so on this grid every dose is the momentary dose of one row.
+KERNEL_INTERVAL = 300
 
-        ice_values, dates = get_glucose_effect_velocity_and_dates(json_file=json_data)
-        dates = [date.tz_localize(None) for date in dates]  # Align to UTC if needed
 
-        # We ignore the first overlap samples for each batch, because we need the insulin data to compute correct values
-        df.loc[dates[overlap:], "ice"] = ice_values[overlap:]
-    return df
+def _get_scheduled_basal_rates(data, basal, seconds):
+    """
+    The scheduled basal rate at each row for the kernel path, or None if a schedule changes between rows, where
+    LoopAlgorithm would split the doses.
+    """
+    schedule = helpers._get_setting_schedule(basal, data, seconds)
+    if schedule is None:
+        return np.full(len(seconds), float(basal))
+    if not np.isin(schedule.start_dates[1:], seconds).all():
+        return None
+    return schedule.values[np.searchsorted(schedule.start_dates, seconds, side='right') - 1]
 
 
-def add_insulin_on_board_to_df(df, basal, isf, cr, insulin_type='novolog', lookback=72):
+def add_insulin_on_board_to_df(df, basal, isf, cr, insulin_type='novolog', lookback=72, method='auto'):
     """
     Adding insulin on board to a dataframe to each row, by using data from the previous rows given by lookback.
+    All rows are computed with a single call to the dynamic library, or, when the rows are on a regular 5-minute
+    grid, with a numpy convolution of the net doses with the cached kernel of the insulin type (see
+    curves.insulin_on_board_array), which gives the same values.
     IMPORTANT NOTE: This function does not handle separate subjects within a single dataframe. A subject's data should
     be passed individually.
 
     :param df: Dataframe with at least a "basal" and a "bolus" column, and a datetime index.
-    :param basal: Basal rate
-    :param isf: Insulin sensitivity factor
-    :param cr: Carbohydrate ratio (will not impact the results)
+    :param basal: Scheduled basal rate, or the name of a column with the scheduled basal rate at each row. Basal
+    doses are counted relative to it.
+    :param isf: Insulin sensitivity factor, or the name of a column with the insulin sensitivity factor at each row
+    :param cr: Carbohydrate ratio, or the name of a column with the carbohydrate ratio at each row (will not impact
+    the results)
     :param insulin_type: Which insulin profile to use to compute the insulin on board
-    :param lookback: Lookback used to compute each iob value. Increasing lookback will lower performance, but will be
-    necessary for insulin types that are long-lasting, or for high datetime frequencies. The default of 72 is based on
-    6 hours duration of 5-minute intervals.
+    :param lookback: Number of previous rows used to compute each iob value. Should cover the insulin action duration,
+    which will be necessary for insulin types that are long-lasting, or for high datetime frequencies. The default of
+    72 is based on 6 hours duration of 5-minute intervals.
+    :param method: "auto" uses the kernel when the rows are on a regular 5-minute grid and the dynamic library
+    otherwise, "kernel" always uses the kernel and raises a ValueError if the rows are not on such a grid, and
+    "native" always uses the dynamic library.
     :return: The original dataframe with a new column "iob"
     """
-    data = df[['basal', 'bolus']].copy()  # Extract only necessary data to improve performance
+    if method not in ('auto', 'kernel', 'native'):
+        raise ValueError(f"Invalid method: '{method}'. Must be one of ['auto', 'kernel', 'native'].")
+    helpers.validate_insulin_type(insulin_type)
+    data = df[_with_setting_columns(['basal', 'bolus'], basal, isf, cr)].copy()  # Extract only necessary data
     data.loc[:, 'bolus'] = data['bolus'].replace(0.0, np.nan)
+    # The results are written back by row position, which costs the same for any index
+    order = helpers._get_sort_order(data.index)
+    if order is not None:
+        data = data.iloc[order]
+
+    iob = np.full(len(data), np.nan)
+    if len(data) < 2:
+        df["iob"] = iob
+        return df
+
+    # Timezone-aware dates are used in UTC, as for the insulin counteraction effects, so that the dates are unique and
+    # evenly spaced across daylight saving time changes
+    if data.index.tz is not None:
+        data.index = data.index.tz_convert('UTC').tz_localize(None)
+    if method != 'native':
+        seconds = helpers.get_epoch_seconds(data.index)
+        scheduled = None
+        if (np.diff(seconds) == KERNEL_INTERVAL).all():
+            scheduled = _get_scheduled_basal_rates(data, basal, seconds)
+        if scheduled is not None:
+            # A missing basal rate is no dose, not a dose of 0 U/hr
+            net_basal = np.nan_to_num((data['basal'].to_numpy(dtype=np.float64) - scheduled) / 12)
+            net_doses = np.nan_to_num(data['bolus'].to_numpy(dtype=np.float64)) + net_basal
+            iob[1:] = insulin_on_board_array(net_doses, insulin_type, KERNEL_INTERVAL / 60, lookback)[1:]
+            df["iob"] = helpers._in_row_order(iob, order)
+            return df
+        if method == 'kernel':
+            raise ValueError("The kernel method needs rows on a regular 5-minute grid, with any basal schedule "
+                             "changing at the dates of the rows.")
+
+    json_data = helpers.get_json_loop_prediction_input_from_df(data, basal, isf, cr, data.index[-1],
+                                                               insulin_type=insulin_type)
+    # The value for row i + 1 uses the doses of rows max(0, i - lookback + 1) to i
+    window_start_indexes = np.maximum(np.arange(len(data) - 1) - lookback + 1, 0)
+    iob[1:] = get_active_insulin_batch(json_data, data.index[1:], window_starts=data.index[window_start_indexes])
+    df["iob"] = helpers._in_row_order(iob, order)
+    return df
 
-    iobs = []
-    for i, date in enumerate(data.index[1:]):
-        start_index = max(0, i - lookback + 1)
-        json_data = helpers.get_json_loop_prediction_input_from_df(data.iloc[start_index:i+1], basal, isf, cr,
-                                                                   data.index[i+1], insulin_type=insulin_type)
-        iob = get_active_insulin(json_data)
-        iobs += [iob]
 
-    df.loc[:, "iob"] = np.nan
-    df.loc[df.index[1:], "iob"] = iobs
-    return df
+def _initialize_worker():
+    # Every worker process loads the dynamic library once, before its first task
+    swift_lib.load()
+
+
+def _add_iob_and_ice_to_subject(data, settings, lookback, overlap):
+    basal, isf, cr = settings['basal'], settings['isf'], settings['cr']
+    insulin_type = settings.get('insulin_type', 'novolog')
+    data = add_insulin_on_board_to_df(data, basal, isf, cr, insulin_type=insulin_type, lookback=lookback)
+    data = add_insulin_counteraction_effect_to_df(data, basal, isf, cr, insulin_type=insulin_type, overlap=overlap)
+    return data['iob'].to_numpy(), data['ice'].to_numpy()
+
+
+def add_iob_and_ice(df, by, settings, workers=None, lookback=72, overlap=72):
+    """
+    Add insulin on board and insulin counteraction effects to a dataframe with data from many subjects. The subjects
+    are processed in parallel in a pool of worker processes, which each load the dynamic library once.
+
+    If the computation fails for a subject, a warning is given, the subject's values are left empty, and the error is
+    stored in `result.attrs['failed_subjects']`. The other subjects are still processed. If a worker process exits,
+    for example because of a fatalError in the dynamic library, the pool is replaced, and only the subject that was
+    running in that worker fails, with WorkerCrashError.
+
+    :param df: Dataframe with at least the columns "basal", "bolus" and "CGM", a column identifying the subject and a
+    datetime index.
+    :param by: Name of the column identifying the subject.
+    :param settings: Dictionary with "basal", "isf", "cr" and optionally "insulin_type" used for all subjects, or a
+    dictionary from subject ID to such a dictionary. "basal", "isf" and "cr" can be numbers or names of columns with
+    the setting at each row, which are encoded into schedules once per subject.
+    :param workers: Number of worker processes. Defaults to the number of CPUs. With 1 worker, the subjects are
+    processed in the current process.
+    :param lookback: Lookback used to compute insulin on board, see add_insulin_on_board_to_df.
+    :param overlap: Number of warm-up rows per subject without insulin counteraction effects, see
+    add_insulin_counteraction_effect_to_df.
+    :return: A copy of the dataframe with the new columns "iob" and "ice", in the original row order.
+    """
+    def get_settings(subject):
+        return settings[subject] if subject in settings and isinstance(settings[subject], dict) else settings
+
+    positions = df.groupby(by, sort=False).indices
+    iob = np.full(len(df), np.nan)
+    ice = np.full(len(df), np.nan)
+    failed_subjects = {}
+
+    def collect(subject, compute):
+        try:
+            iob[positions[subject]], ice[positions[subject]] = compute()
+        except Exception as error:
+            warnings.warn(f"Computing insulin on board and ICE failed for subject {subject}: {error!r}")
+            failed_subjects[subject] = repr(error)
+
+    columns = [column for column in ['basal', 'bolus', 'CGM', 'carbs'] if column in df.columns]
+
+    def get_columns(subject):
+        subject_settings = get_settings(subject)
+        return _with_setting_columns(columns, *(subject_settings.get(key) for key in ['basal', 'isf', 'cr']))
+
+    if workers == 1:
+        for subject, subject_positions in positions.items():
+            data = df.iloc[subject_positions][get_columns(subject)]
+            collect(subject, lambda: _add_iob_and_ice_to_subject(data, get_settings(subject), lookback, overlap))
+    else:
+        def submit(executor, subject):
+            return executor.submit(_add_iob_and_ice_to_subject, df.iloc[positions[subject]][get_columns(subject)],
+                                   get_settings(subject), lookback, overlap)
+
+        def crashed():
+            raise WorkerCrashError("The worker process exited while computing the subject.")
+
+        workers = workers or os.cpu_count() or 1
+        queued = list(positions)
+        while queued:
+            # At most one task per worker is submitted at a time, so that when a worker exits, only the subjects that
+            # were running are suspects. They are computed again one at a time, and the others in a new pool.
+            suspects = []
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=_initialize_worker) as executor:
+                running = {}
+                while (queued or running) and not suspects:
+                    while queued and len(running) < workers:
+                        subject = queued.pop(0)
+                        running[submit(executor, subject)] = subject
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                        suspects = list(running.values())
+                        break
+                    for future in done:
+                        collect(running.pop(future), future.result)
+            for subject in suspects:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=_initialize_worker) as executor:
+                    future = submit(executor, subject)
+                    concurrent.futures.wait([future])
+                collect(subject, crashed if isinstance(future.exception(), BrokenProcessPool) else future.result)
+
+    result = df.copy()
+    result['iob'] = iob
+    result['ice'] = ice
+    result.attrs['failed_subjects'] = failed_subjects
+    return result
 
 
 # Calculating the percentage of carbohydrate absorption at the percent time, with piecewise linear model
 # Input is percent as fraction
 def percent_absorption_at_percent_time(percent_time):
-    swift_lib.percentAbsorptionAtPercentTime.argtypes = [ctypes.c_double]
-    swift_lib.percentAbsorptionAtPercentTime.restype = ctypes.c_double
-
     return swift_lib.percentAbsorptionAtPercentTime(percent_time)
 
 
 # Calculating the percentage rate of carbohydrate absorption at the percent time, with piecewise linear model
 # Input is percent as fraction
 def piecewise_linear_percent_rate_at_percent_time(percent_time):
-    swift_lib.percentRateAtPercentTime.argtypes = [ctypes.c_double]
-    swift_lib.percentRateAtPercentTime.restype = ctypes.c_double
-
     return swift_lib.percentRateAtPercentTime(percent_time)
 
 
 # Input is percent as fraction
 def linear_percent_rate_at_percent_time(percent_time):
-    swift_lib.linearPercentRateAtPercentTime.argtypes = [ctypes.c_double]
-    swift_lib.linearPercentRateAtPercentTime.restype = ctypes.c_double
-
     return swift_lib.linearPercentRateAtPercentTime(percent_time)
 
 
 def get_dynamic_carbs_on_board(json_file):
     json_bytes = helpers.get_bytes_from_json(json_file)
 
-    swift_lib.getDynamicCarbsOnBoard.argtypes = [ctypes.c_char_p]
-    swift_lib.getDynamicCarbsOnBoard.restype = ctypes.c_double
+    return _call(swift_lib.getDynamicCarbsOnBoard, json_bytes)
 
-    return swift_lib.getDynamicCarbsOnBoard(json_bytes)
+
+# Must match the LoopAbsorption values in CLoopAlgorithmToPython.h
+CARB_ABSORPTION_MODELS = ('piecewise_linear', 'linear', 'parabolic')
+
+
+@profiling.timed('parse_output')
+def _to_numpy_series_batch(result):
+    """
+    Copy a LoopTimeSeriesBatch into one (values, dates) tuple per series and release the native buffers.
+    """
+    try:
+        values, dates = _copy_series(result.series)
+        offsets = np.ctypeslib.as_array(result.offsets, shape=(result.count + 1,)) if result.count else np.zeros(1)
+        dates = helpers.get_datetimes_from_epoch_seconds(dates)
+        return [(values[start:end], dates[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    finally:
+        swift_lib.freeLoopTimeSeriesBatch(result)
+
+
+def get_dynamic_carbs_on_board_series(json_file, absorption_model='piecewise_linear', delta=300):
+    """
+    Compute the dynamic carbs on board over time, from all carb entries of the input and the observed insulin
+    counteraction effects. Many inputs, for example one per meal or per window of a subject's data, are computed
+    with a single call to the dynamic library.
+
+    :param json_file: An input in the format of get_dynamic_carbs_on_board, or a list of them. Each input can have
+    "start" and "end" dates of the series, formatted like the "start_at" dates of "inputICE". By default the series
+    covers the 6 hours from the first "inputICE" date.
+    :param absorption_model: The carb absorption model, one of "piecewise_linear", "linear" and "parabolic".
+    :param delta: Interval between the values of the series, in seconds.
+    :return: (values, dates) with the carbs on board in grams and their datetimes, or a list of such tuples if a list
+    of inputs was given.
+    """
+    if absorption_model not in CARB_ABSORPTION_MODELS:
+        raise ValueError(f"Invalid absorption model {absorption_model!r}. Valid models are {CARB_ABSORPTION_MODELS}.")
+    if isinstance(json_file, bytes):
+        json_file = json.loads(json_file)
+    single = isinstance(json_file, dict)
+    json_bytes = helpers.get_bytes_from_json([json_file] if single else list(json_file))
+
+    series = _to_numpy_series_batch(_call(swift_lib.getDynamicCarbsOnBoardSeries, json_bytes,
+                                          CARB_ABSORPTION_MODELS.index(absorption_model), float(delta)))
+    return series[0] if single else series
 
 
 def insulin_percent_effect_remaining(minutes, action_duration, peak_activity_time, delay):
@@ -273,9 +1121,6 @@ def insulin_percent_effect_remaining(minutes, action_duration, peak_activity_tim
     
     json_bytes = helpers.get_bytes_from_json(input_data)
 
-    swift_lib.insulinPercentEffectRemaining.argtypes = [ctypes.c_char_p]
-    swift_lib.insulinPercentEffectRemaining.restype = ctypes.c_double
-
-    return swift_lib.insulinPercentEffectRemaining(json_bytes)
+    return _call(swift_lib.insulinPercentEffectRemaining, json_bytes)
 
 
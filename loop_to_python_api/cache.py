@@ -0,0 +1,193 @@
+"""
+Opt-in result cache for the API functions. Results are keyed by a hash of the function name, the canonicalized JSON
+input and the other arguments, so identical windows are returned without calling the dynamic library.
+
+The cache is enabled with `enable_cache` (re-exported by `loop_to_python_api.api`). When it is disabled, the cached
+functions only pay for one global lookup.
+"""
+import collections
+import functools
+import hashlib
+import inspect
+import json
+import threading
+import typing
+
+
+class CacheStats(typing.NamedTuple):
+    hits: int
+    disk_hits: int
+    misses: int
+    size: int
+
+
+class ResultCache:
+    """
+    An in-memory LRU cache, optionally backed by a sqlite file that persists across processes. Results are stored as
+    JSON, so every hit returns a new object that the caller can modify.
+
+    :param max_size: The maximum number of results kept in memory.
+    :param path: Optional path to a sqlite database. Results evicted from memory are still found there. The database
+    is not size limited.
+    :param version: Identifies the dynamic library that computes the results. A database written with another version
+    is cleared when it is opened, so results of an older build are never returned.
+    """
+
+    def __init__(self, max_size=1024, path=None, version=None):
+        self.max_size = max_size
+        self.path = path
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._connection = None
+        if path is not None:
+            import sqlite3
+            # One connection shared by all threads, serialized by the lock
+            self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            with self._connection:
+                self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+                row = self._connection.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()
+                if row is None or row[0] != version:
+                    self._connection.execute("DELETE FROM results")
+                    self._connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('version', ?)",
+                                             (version,))
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: The JSON-encoded result for the key, or None.
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return value
+            if self._connection is not None:
+                row = self._connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self._disk_hits += 1
+                    return row[0]
+            self._misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                                             (key, value))
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(self._hits, self._disk_hits, self._misses, len(self._memory))
+
+    def clear(self):
+        """
+        Remove all results from memory and from the database, and reset the statistics.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._hits = self._disk_hits = self._misses = 0
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute("DELETE FROM results")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+_active_cache = None
+
+
+def enable_cache(max_size=1024, path=None):
+    """
+    Cache the results of generate_prediction, get_active_insulin and get_loop_recommendations.
+
+    :param max_size: The maximum number of results kept in memory.
+    :param path: Optional path to a sqlite database that persists results across processes. The results in it are
+    discarded when the dynamic library changes.
+    :return: The ResultCache.
+    """
+    global _active_cache
+    disable_cache()
+    _active_cache = ResultCache(max_size, path, None if path is None else get_library_version())
+    return _active_cache
+
+
+def disable_cache():
+    global _active_cache
+    if _active_cache is not None:
+        _active_cache.close()
+    _active_cache = None
+
+
+def get_cache_stats():
+    """
+    :return: CacheStats with memory hits, disk hits, misses and the number of results in memory, or None if the
+    cache is disabled.
+    """
+    return None if _active_cache is None else _active_cache.stats()
+
+
+@functools.lru_cache(maxsize=None)
+def get_library_version():
+    """
+    A hash of the dynamic library file, which changes with every rebuild of the library.
+    """
+    from loop_to_python_api.api import lib_path
+
+    with open(lib_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_cache_key(name, json_file, arguments=None):
+    """
+    A stable hash of the function name, the input and the other arguments. The input is canonicalized, so the key
+    does not depend on key order, whitespace, or whether it was passed as a dictionary or as JSON bytes.
+    """
+    if isinstance(json_file, bytes):
+        json_file = json.loads(json_file)
+    canonical = json.dumps([name, json_file, arguments or {}], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cached(function):
+    """
+    Decorator for API functions that take the JSON input as their first argument and return a JSON-serializable
+    result.
+    """
+    signature = inspect.signature(function)
+    input_name = next(iter(signature.parameters))
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        cache = _active_cache
+        if cache is None:
+            return function(*args, **kwargs)
+
+        # Binding with defaults gives the same key whether arguments are passed by position, by name or left out
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        key = get_cache_key(function.__name__, arguments.pop(input_name), arguments)
+        value = cache.get(key)
+        if value is not None:
+            return json.loads(value)
+        result = function(*args, **kwargs)
+        cache.set(key, json.dumps(result))
+        return result
+
+    return wrapper
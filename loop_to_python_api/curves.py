@@ -0,0 +1,160 @@
+"""
+Vectorized numpy versions of the carb absorption and insulin curves in LoopAlgorithm. They evaluate whole arrays at
+once without calling the dynamic library, and give the same values as the scalar functions in api.py.
+
+The insulin on board and insulin glucose effect of a series of doses on a regular grid are convolutions of the net
+doses with a fixed kernel per insulin type, which is computed once and cached.
+"""
+import functools
+
+import numpy as np
+
+# Action duration, peak activity time and delay in minutes of the exponential insulin model of each insulin type, as
+# in the presets of LoopAlgorithm
+INSULIN_MODELS = {
+    'novolog': (360, 75, 10),
+    'humalog': (360, 75, 10),
+    'apidra': (360, 75, 10),
+    'fiasp': (360, 55, 10),
+    'lyumjev': (360, 55, 10),
+    'afrezza': (300, 29, 10),
+}
+
+# Constants of PiecewiseLinearAbsorption in LoopAlgorithm
+PERCENT_END_OF_RISE = 0.15
+PERCENT_START_OF_FALL = 0.5
+PIECEWISE_LINEAR_SCALE = 2.0 / (1.0 + PERCENT_START_OF_FALL - PERCENT_END_OF_RISE)
+
+
+def percent_absorption_at_percent_time_array(percent_time):
+    """
+    Percentage of carbohydrates absorbed at each percent time, with the piecewise linear model.
+
+    :param percent_time: Array of percent times as fractions.
+    :return: A numpy array with the absorbed fractions.
+    """
+    t = np.asarray(percent_time, dtype=np.float64)
+    rise = 0.5 * PIECEWISE_LINEAR_SCALE * t ** 2 / PERCENT_END_OF_RISE
+    plateau = PIECEWISE_LINEAR_SCALE * (t - 0.5 * PERCENT_END_OF_RISE)
+    fall = PIECEWISE_LINEAR_SCALE * (PERCENT_START_OF_FALL - 0.5 * PERCENT_END_OF_RISE +
+                                     (t - PERCENT_START_OF_FALL) *
+                                     (1.0 - 0.5 * (t - PERCENT_START_OF_FALL) / (1.0 - PERCENT_START_OF_FALL)))
+    return np.select([t <= 0.0, t < PERCENT_END_OF_RISE, t < PERCENT_START_OF_FALL, t < 1.0],
+                     [0.0, rise, plateau, fall], default=1.0)
+
+
+def piecewise_linear_percent_rate_at_percent_time_array(percent_time):
+    """
+    Absorption rate at each percent time, with the piecewise linear model.
+
+    :param percent_time: Array of percent times as fractions.
+    :return: A numpy array with the absorption rates.
+    """
+    t = np.asarray(percent_time, dtype=np.float64)
+    rise = PIECEWISE_LINEAR_SCALE * t / PERCENT_END_OF_RISE
+    fall = PIECEWISE_LINEAR_SCALE * (1.0 - t) / (1.0 - PERCENT_START_OF_FALL)
+    return np.select([t <= 0.0, t < PERCENT_END_OF_RISE, t < PERCENT_START_OF_FALL, t < 1.0],
+                     [0.0, rise, PIECEWISE_LINEAR_SCALE, fall], default=0.0)
+
+
+def linear_percent_rate_at_percent_time_array(percent_time):
+    """
+    Absorption rate at each percent time, with the linear model.
+
+    :param percent_time: Array of percent times as fractions.
+    :return: A numpy array with the absorption rates.
+    """
+    t = np.asarray(percent_time, dtype=np.float64)
+    return np.where((t > 0.0) & (t <= 1.0), 1.0, 0.0)
+
+
+def insulin_percent_effect_remaining_array(minutes, action_duration, peak_activity_time, delay):
+    """
+    Percentage of insulin effect remaining at each time point, with the exponential insulin model.
+
+    :param minutes: Array of time points in minutes.
+    :param action_duration: Total duration of insulin action in minutes
+    :param peak_activity_time: Time to peak insulin activity in minutes
+    :param delay: Delay before insulin activity begins in minutes
+    :return: A numpy array with the fraction of insulin effect remaining (0.0 to 1.0)
+    """
+    # LoopAlgorithm works in seconds, so the same units are used here to get identical rounding
+    action_duration = action_duration * 60.0
+    peak_activity_time = peak_activity_time * 60.0
+    tau = peak_activity_time * (1 - peak_activity_time / action_duration) / (1 - 2 * peak_activity_time / action_duration)
+    a = 2 * tau / action_duration
+    s = 1 / (1 - a + (1 + a) * np.exp(-action_duration / tau))
+
+    t = np.asarray(minutes, dtype=np.float64) * 60.0 - delay * 60.0
+    remaining = 1 - s * (1 - a) * ((t ** 2 / (tau * action_duration * (1 - a)) - t / tau - 1) * np.exp(-t / tau) + 1)
+    return np.select([t <= 0, t >= action_duration], [1.0, 0.0], default=remaining)
+
+
+@functools.lru_cache(maxsize=None)
+def _insulin_kernel(insulin_type, interval, lookback):
+    action_duration, peak_activity_time, delay = INSULIN_MODELS[insulin_type]
+    # No effect remains after the delay and action duration, so the kernel stops there
+    length = int(np.ceil((action_duration + delay) / interval)) + 1
+    if lookback is not None:
+        length = min(length, lookback + 1)
+    kernel = insulin_percent_effect_remaining_array(np.arange(length) * interval, action_duration,
+                                                    peak_activity_time, delay)
+    # A dose does not count at its own date, as in getActiveInsulinBatch
+    kernel[0] = 0.0
+    kernel.flags.writeable = False
+    return kernel
+
+
+def insulin_kernel(insulin_type='novolog', interval=5, lookback=None):
+    """
+    The fraction of the insulin of a dose remaining after each number of intervals. kernel[0] is 0, so a dose only
+    counts after its date. The kernel is cached per insulin type, interval and lookback, and is read-only.
+
+    :param insulin_type: One of the insulin types in INSULIN_MODELS.
+    :param interval: Minutes between the dates of the grid.
+    :param lookback: Optional number of previous doses counted at each date, see add_insulin_on_board_to_df.
+    :return: A read-only numpy array.
+    """
+    if insulin_type not in INSULIN_MODELS:
+        raise ValueError(f"Invalid insulin type: '{insulin_type}'. Must be one of {list(INSULIN_MODELS)}.")
+    return _insulin_kernel(insulin_type, float(interval), lookback)
+
+
+def _convolve(values, kernel):
+    if len(values) == 0:
+        return np.empty(0)
+    return np.convolve(values, kernel)[:len(values)]
+
+
+def insulin_on_board_array(net_doses, insulin_type='novolog', interval=5, lookback=None):
+    """
+    Insulin on board at each date of a regular grid, from the doses at the previous dates. This is the same as
+    getActiveInsulin at each date for doses shorter than 5 minutes (1.05 times the 5 minute delta of LoopAlgorithm),
+    which the DataFrame helpers always create.
+
+    :param net_doses: Units of insulin above the scheduled basal at each date: the bolus plus
+    (basal rate - scheduled basal rate) / 12 for 5-minute basal deliveries. Missing values count as no dose.
+    :param insulin_type: One of the insulin types in INSULIN_MODELS.
+    :param interval: Minutes between the dates.
+    :param lookback: Optional number of previous doses counted at each date.
+    :return: A numpy array with the units of insulin on board at each date.
+    """
+    net_doses = np.nan_to_num(np.asarray(net_doses, dtype=np.float64))
+    return _convolve(net_doses, insulin_kernel(insulin_type, interval, lookback))
+
+
+def insulin_effect_array(net_doses, isf, insulin_type='novolog', interval=5):
+    """
+    Cumulative glucose effect of the doses at the previous dates, at each date of a regular grid: the insulin that
+    has acted times the insulin sensitivity at the date of each dose.
+
+    :param net_doses: Units of insulin above the scheduled basal at each date, see insulin_on_board_array.
+    :param isf: Insulin sensitivity factor (mg/dL per unit), a number or one value per date.
+    :param insulin_type: One of the insulin types in INSULIN_MODELS.
+    :param interval: Minutes between the dates.
+    :return: A numpy array with the glucose effect in mg/dL at each date, relative to the first date.
+    """
+    weighted = np.nan_to_num(np.asarray(net_doses, dtype=np.float64)) * np.asarray(isf, dtype=np.float64)
+    # All of a dose has acted except what is still on board
+    acted_and_remaining = np.concatenate([[0.0], np.cumsum(weighted)[:-1]])
+    return _convolve(weighted, insulin_kernel(insulin_type, interval)) - acted_and_remaining
@@ -0,0 +1,56 @@
+"""
+Exceptions raised when a function in the dynamic library reports an error. The error codes mirror the LoopError codes
+in Sources/CLoopAlgorithmToPython/include/CLoopAlgorithmToPython.h.
+"""
+
+
+class LoopAlgorithmError(Exception):
+    """
+    Base class for errors reported by the dynamic library.
+
+    :param code: The native error code.
+    :param message: The error message reported by the dynamic library.
+    """
+    code = None
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.message = message
+        if code is not None:
+            self.code = code
+
+
+class InvalidInputError(LoopAlgorithmError, ValueError):
+    """The input was missing, empty or inconsistent, for example an empty glucose history."""
+    code = 1
+
+
+class DecodingError(LoopAlgorithmError, ValueError):
+    """The JSON input could not be decoded into the expected structure."""
+    code = 2
+
+
+class AlgorithmError(LoopAlgorithmError):
+    """The algorithm could not produce a result for valid input, for example a failed dose recommendation."""
+    code = 3
+
+
+class WorkerCrashError(LoopAlgorithmError):
+    """
+    A worker process of the prediction server (loop_to_python_api.serve) or of api.add_iob_and_ice exited while running
+    a request or a subject, for example because the dynamic library aborted with a fatalError. The worker pool is
+    restarted, so the request can be retried.
+    """
+
+
+_ERRORS_BY_CODE = {error.code: error for error in (InvalidInputError, DecodingError, AlgorithmError)}
+
+
+def error_from_code(code, message):
+    """
+    Create the exception matching a native error code. Unknown codes give a LoopAlgorithmError.
+    """
+    error = _ERRORS_BY_CODE.get(code)
+    if error is None:
+        return LoopAlgorithmError(message, code=code)
+    return error(message)
@@ -1,22 +1,241 @@
 """
-Helper functions not directly related to the API.
+Helper functions not directly related to the API. pandas is imported by the functions that use it, so that importing
+the API does not pay for it.
 """
 import json
 import datetime
+import numbers
+import typing
 
+import numpy as np
 
+from loop_to_python_api.profiling import timed
+
+
+@timed('serialize')
 def get_bytes_from_json(json_file):
+    if isinstance(json_file, bytes):
+        # Already encoded, for example by get_json_loop_prediction_input_from_df(..., as_bytes=True)
+        return json_file
     json_str = json.dumps(json_file)  # Convert JSON data to JSON string
     json_bytes = json_str.encode('utf-8')  # Convert JSON string to bytes
     return json_bytes
 
 
+def get_epoch_seconds(dates):
+    """
+    Convert datetimes to seconds since 1970 as a contiguous float64 array, which is how the native batch functions
+    receive dates. Timezone-naive dates are interpreted as UTC, consistent with the JSON inputs.
+
+    Args:
+        dates: A datetime-like scalar, list, array or index.
+
+    Returns:
+        np.ndarray: Seconds since 1970 (float64).
+    """
+    import pandas as pd
+
+    dates = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(dates)))
+    if dates.tz is not None:
+        dates = dates.tz_convert('UTC').tz_localize(None)
+    seconds = (dates - pd.Timestamp('1970-01-01')) / pd.Timedelta(seconds=1)
+    return np.ascontiguousarray(seconds, dtype=np.float64)
+
+
+def get_datetimes_from_epoch_seconds(seconds):
+    """
+    Convert seconds since 1970 returned by the dynamic library into timezone-naive UTC datetimes.
+
+    Returns:
+        np.ndarray: datetime64[ns] array.
+    """
+    return (np.asarray(seconds, dtype=np.float64) * 1e9).round().astype('datetime64[ns]')
+
+
+def get_iso_strings_from_epoch_seconds(seconds):
+    """
+    Convert seconds since 1970 into ISO 8601 strings, formatted like the dates returned by the JSON functions
+    (for example "2023-06-22T16:45:00Z").
+    """
+    datetimes = np.floor(np.asarray(seconds, dtype=np.float64)).astype('int64').astype('datetime64[s]')
+    return [date + 'Z' for date in np.datetime_as_string(datetimes, unit='s')]
+
+
+def with_columns(data, columns):
+    """
+    Add result columns to a DataFrame or a pyarrow Table by row position, not by index label, so each column is
+    attached without index lookups. Numpy arrays are wrapped into Arrow arrays without copying where Arrow allows it.
+
+    Args:
+        data: A DataFrame or a pyarrow Table.
+        columns: Dictionary from column name to an array with one value per row of data, in row order. Existing
+            columns with the same name are replaced.
+
+    Returns:
+        A new DataFrame or Table with the columns. The input is not modified.
+    """
+    for name, values in columns.items():
+        if len(values) != len(data):
+            raise ValueError(f"Column {name!r} has {len(values)} values, but the data has {len(data)} rows.")
+
+    if hasattr(data, 'append_column'):
+        import pyarrow
+
+        for name, values in columns.items():
+            array = values if isinstance(values, (pyarrow.Array, pyarrow.ChunkedArray)) else pyarrow.array(values)
+            if name in data.column_names:
+                data = data.set_column(data.column_names.index(name), name, array)
+            else:
+                data = data.append_column(name, array)
+        return data
+
+    result = data.copy(deep=False)
+    for name, values in columns.items():
+        result[name] = values
+    return result
+
+
+def _in_row_order(values, order):
+    """
+    Put values computed for the rows sorted by order (from np.argsort) back in the original row order.
+    """
+    if order is None:
+        return values
+    result = np.empty_like(values)
+    result[order] = values
+    return result
+
+
+def _get_sort_order(index):
+    """
+    The positions that sort a DatetimeIndex, or None if it is already sorted.
+    """
+    if index.is_monotonic_increasing:
+        return None
+    return np.argsort(index.to_numpy(), kind='stable')
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _format_dates(dates):
+    """
+    Format a DatetimeIndex like strftime(DATE_FORMAT), but in one vectorized numpy call. Timezone-aware dates are
+    formatted in their own timezone, as strftime does.
+    """
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    seconds = dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[s]')
+    return [date + 'Z' for date in np.datetime_as_string(seconds, unit='s').tolist()]
+
+
+def _get_dates_and_values(column, data):
+    if column not in data.columns:
+        return data.index[:0], np.empty(0)
+    import pandas as pd
+
+    values = data[column].to_numpy()
+    mask = ~pd.isna(values)
+    return data.index[mask], values[mask]
+
+
+def _json_records(keys, columns, string_keys):
+    """
+    Format columns as a compact JSON list of objects. Strings must not need escaping, and numbers are formatted with
+    repr like json.dumps.
+    """
+    template = '{{' + ','.join('"{}":"{{}}"'.format(key) if key in string_keys else '"{}":{{!r}}'.format(key)
+                               for key in keys) + '}}'
+    return '[' + ','.join(map(template.format, *columns)) + ']'
+
+
+# The settings schedules are extended by this margin beyond the data, so that they wrap the first and last glucose
+# data and the prediction. Schedules that do not do that can crash the algorithm.
+SCHEDULE_MARGIN = 24 * 3600
+
+
+class Schedule(typing.NamedTuple):
+    """
+    A therapy setting as run-length encoded segments, with dates in seconds since 1970. Consecutive segments are
+    contiguous: end_dates[i] == start_dates[i + 1].
+    """
+    start_dates: np.ndarray
+    end_dates: np.ndarray
+    values: np.ndarray
+
+    def between(self, start, end, margin=SCHEDULE_MARGIN):
+        """
+        The segments overlapping the dates from start to end (in seconds since 1970), found with a binary search, so
+        the schedule is not encoded again. The first and last segment are cut or extended to wrap the dates by the margin,
+        as get_schedule does for the whole data.
+        """
+        first = max(np.searchsorted(self.start_dates, start, side='right') - 1, 0)
+        last = max(np.searchsorted(self.start_dates, end, side='right'), first + 1)
+        start_dates = self.start_dates[first:last].copy()
+        end_dates = self.end_dates[first:last].copy()
+        start_dates[0] = start - margin
+        end_dates[-1] = end + margin
+        return Schedule(start_dates, end_dates, self.values[first:last])
+
+
+def get_schedule(values, dates):
+    """
+    Run-length encode a therapy setting given per row, for example a scheduled basal rate column, into a Schedule.
+    Every run of equal values becomes one segment, from the date of its first row to the date of the next run. Missing
+    values continue the previous value, so a column that only has values where the setting changes also works.
+
+    Encode the setting once per subject, and pass the Schedule to get_json_loop_prediction_input_from_df or
+    get_columnar_loop_prediction_input_from_df for each window of the subject's data.
+
+    Args:
+        values: Setting values, one per date.
+        dates: Dates in ascending order, converted with `get_epoch_seconds`, or seconds since 1970.
+
+    Returns:
+        Schedule: The segments, wrapping the dates by SCHEDULE_MARGIN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    seconds = np.asarray(dates, dtype=np.float64) if np.asarray(dates).dtype.kind == 'f' else get_epoch_seconds(dates)
+    if len(values) != len(seconds):
+        raise ValueError(f"Got {len(values)} setting values for {len(seconds)} dates.")
+    valid = ~np.isnan(values)
+    if not valid.any():
+        raise ValueError("The setting has no values.")
+    # Forward fill, and fill the rows before the first value with the first value
+    filled = np.maximum.accumulate(np.where(valid, np.arange(len(values)), -1))
+    values = values[np.maximum(filled, np.argmax(valid))]
+
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    start_dates = seconds[starts]
+    end_dates = np.append(start_dates[1:], seconds[-1])
+    start_dates[0] -= SCHEDULE_MARGIN
+    end_dates[-1] += SCHEDULE_MARGIN
+    return Schedule(start_dates, end_dates, values[starts])
+
+
+def _get_setting_schedule(setting, data, seconds):
+    """
+    The schedule of a setting given as a Schedule or as the name of a column of data, for the dates of the data.
+    Returns None for a scalar setting.
+    """
+    if isinstance(setting, Schedule):
+        return setting.between(seconds[0], seconds[-1])
+    if isinstance(setting, str):
+        if setting not in data.columns:
+            raise ValueError(f"Setting column {setting!r} not found in the DataFrame.")
+        return get_schedule(data[setting].to_numpy(dtype=np.float64), seconds)
+    if not isinstance(setting, numbers.Real):
+        raise TypeError(f"A setting must be a number, a column name or a Schedule, got {type(setting).__name__}.")
+    return None
+
+
+@timed('build_input')
 def get_json_loop_prediction_input_from_df(data, basal, isf, cr, prediction_start, insulin_type='novolog',
                                            max_basal=4.0, max_bolus=9, recommendation_type='automaticBolus',
-                                           suspend_threshold=78, target_lower=101, target_upper=115):
+                                           suspend_threshold=78, target_lower=101, target_upper=115, as_bytes=False):
     """
     Convert a glucose and insulin DataFrame into a JSON payload suitable for loop prediction input in several
-    functions within `api.py`.
+    functions within `api.py`. The input DataFrame is not modified.
 
     Args:
         data (pd.DataFrame): DataFrame containing the following columns:
@@ -25,9 +244,11 @@ def get_json_loop_prediction_input_from_df(data, basal, isf, cr, prediction_star
             - 'basal' (U/hr)
             - 'carbs' (g)
             - 'date' (datetime)
-        basal (float): Scheduled basal insulin rate to use in the prediction.
-        isf (float): Insulin sensitivity factor (mg/dL per unit insulin).
-        cr (float): Carbohydrate ratio (grams per unit insulin).
+        basal (float, str or Schedule): Scheduled basal insulin rate to use in the prediction (U/hr).
+        isf (float, str or Schedule): Insulin sensitivity factor (mg/dL per unit insulin).
+        cr (float, str or Schedule): Carbohydrate ratio (grams per unit insulin).
+            Each setting is a constant, the name of a column of `data` with the setting at each row (run-length
+            encoded into a schedule), or a Schedule from `get_schedule`, which is sliced to the dates of `data`.
         prediction_start (datetime or str): Timestamp for the start of the prediction period.
         insulin_type (str): Type of insulin used. Must be one of:
             "novolog", "humalog", "apidra", "fiasp", "lyumjev", "afrezza".
@@ -39,119 +260,305 @@ def get_json_loop_prediction_input_from_df(data, basal, isf, cr, prediction_star
             Defaults to 78.
         target_lower (float, optional): Lower bound of target glucose range (mg/dL). Defaults to 101.
         target_upper (float, optional): Upper bound of target glucose range (mg/dL). Defaults to 115.
+        as_bytes (bool, optional): Return compact UTF-8 encoded JSON instead of a dictionary. The API functions accept
+            both. Defaults to False.
 
     Returns:
-        dict: JSON-serializable dictionary structured for loop prediction input,
+        dict or bytes: JSON-serializable dictionary structured for loop prediction input,
               including glucose values, insulin information, and metadata.
     """
+    import pandas as pd
+
     validate_insulin_type(insulin_type)
     validate_recommendation_type(recommendation_type)
 
-    def get_dates_and_values(column, data):
-        if column in data.columns:
-            mask = ~data[column].isna()  # ~ inverts the boolean mask
-            dates = data.index[mask].to_list()
-            values = data[column][mask].to_list()
-            return dates, values
-        else:
-            return [], []
-
-    data.sort_index(inplace=True)
-    bolus_dates, bolus_values = get_dates_and_values('bolus', data)
-    basal_dates, basal_values = get_dates_and_values('basal', data)
-
-    insulin_json_list = []
-    for date, value in zip(bolus_dates, bolus_values):
-        entry = {
-            "startDate": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "endDate": (date + datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "type": 'bolus',
-            "volume": value,
-            "insulinType": insulin_type,
-        }
-        insulin_json_list.append(entry)
-
-    for date, value in zip(basal_dates, basal_values):
-        entry = {
-            "startDate": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "endDate": (date + datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "type": 'basal',
-            "volume": value / 12,  # Converting from U/hr to delivered units in 5 minutes
-            "insulinType": insulin_type,
-        }
-        insulin_json_list.append(entry)
-    insulin_json_list.sort(key=lambda x: x['startDate'])
-
-    bg_dates, bg_values = get_dates_and_values('CGM', data)
-    bg_json_list = []
-    for date, value in zip(bg_dates, bg_values):
-        entry = {
-            "date": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "value": value
-        }
-        bg_json_list.append(entry)
-    bg_json_list.sort(key=lambda x: x['date'])
-
-    carbs_dates, carbs_values = get_dates_and_values('carbs', data)
-    carbs_json_list = []
-    for date, value in zip(carbs_dates, carbs_values):
-        entry = {
-            "date": date.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "grams": value,
-            "absorptionTime": 10800,
-        }
-        carbs_json_list.append(entry)
-    carbs_json_list.sort(key=lambda x: x['date'])
+    # Sorting returns a copy, so the caller's DataFrame is left as it is. Sorted input is used without copying.
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index()
+
+    bolus_dates, bolus_values = _get_dates_and_values('bolus', data)
+    basal_dates, basal_values = _get_dates_and_values('basal', data)
+    bg_dates, bg_values = _get_dates_and_values('CGM', data)
+    carbs_dates, carbs_values = _get_dates_and_values('carbs', data)
+
+    # Boluses come before basals at the same date, as with a stable sort of the boluses followed by the basals
+    dose_dates = bolus_dates.append(basal_dates)
+    order = np.argsort(dose_dates.asi8, kind='stable')
+    dose_dates = dose_dates[order]
+    dose_start_dates = _format_dates(dose_dates)
+    dose_end_dates = _format_dates(dose_dates + datetime.timedelta(minutes=5))
+    dose_types = np.array(['bolus'] * len(bolus_dates) + ['basal'] * len(basal_dates))[order].tolist()
+    # Converting basal from U/hr to delivered units in 5 minutes
+    dose_volumes = np.concatenate([bolus_values.astype(object), (basal_values / 12).astype(object)])[order].tolist()
+    dose_insulin_types = [insulin_type] * len(dose_start_dates)
+
+    bg_date_strings = _format_dates(bg_dates)
+    carbs_date_strings = _format_dates(carbs_dates)
 
     # It is important that the settings dates wrap the first and last glucose data to avoid a code crash
-    start_date_settings = data.index[0] - datetime.timedelta(hours=24)
-    end_date_settings = data.index[-1] + datetime.timedelta(hours=24)
+    start_date_str = (data.index[0] - datetime.timedelta(hours=24)).strftime(DATE_FORMAT)
+    end_date_str = (data.index[-1] + datetime.timedelta(hours=24)).strftime(DATE_FORMAT)
+    prediction_start_str = pd.Timestamp(prediction_start).strftime(DATE_FORMAT)
+    target_start_str = data.index[0].strftime(DATE_FORMAT)
+    target_end_str = data.index[-1].strftime(DATE_FORMAT)
 
-    start_date_str = start_date_settings.strftime('%Y-%m-%dT%H:%M:%SZ')
-    end_date_str = end_date_settings.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Schedules are compared with the dates as they are formatted, in their own timezone
+    seconds = None
+    if any(isinstance(setting, (str, Schedule)) for setting in (basal, isf, cr)):
+        seconds = get_epoch_seconds(data.index if data.index.tz is None else data.index.tz_localize(None))
 
-    basal = [{
-        "startDate": start_date_str,
-        "endDate": end_date_str,
-        "value": basal
-    }]
+    def schedule_entries(setting):
+        segments = _get_setting_schedule(setting, data, seconds) if seconds is not None else None
+        if segments is None:
+            return [(start_date_str, end_date_str, setting)]
+        return list(zip(get_iso_strings_from_epoch_seconds(segments.start_dates),
+                        get_iso_strings_from_epoch_seconds(segments.end_dates), segments.values.tolist()))
 
-    isf = [{
-        "startDate": start_date_str,
-        "endDate": end_date_str,
-        "value": isf
-    }]
+    if as_bytes:
+        def schedule(setting):
+            return '[' + ','.join(f'{{"startDate":"{start}","endDate":"{end}","value":{json.dumps(value)}}}'
+                                  for start, end, value in schedule_entries(setting)) + ']'
 
-    cr = [{
-        "startDate": start_date_str,
-        "endDate": end_date_str,
-        "value": cr
-    }]
+        target = (f'[{{"endDate":"{target_end_str}","lowerBound":{json.dumps(target_lower)},'
+                  f'"startDate":"{target_start_str}","upperBound":{json.dumps(target_upper)}}}]')
+        parts = [
+            '"carbEntries":' + _json_records(['date', 'grams', 'absorptionTime'],
+                                             [carbs_date_strings, carbs_values.tolist(),
+                                              [10800] * len(carbs_date_strings)], {'date'}),
+            '"doses":' + _json_records(['startDate', 'endDate', 'type', 'volume', 'insulinType'],
+                                       [dose_start_dates, dose_end_dates, dose_types, dose_volumes,
+                                        dose_insulin_types], {'startDate', 'endDate', 'type', 'insulinType'}),
+            '"glucoseHistory":' + _json_records(['date', 'value'], [bg_date_strings, bg_values.tolist()], {'date'}),
+            '"basal":' + schedule(basal),
+            '"carbRatio":' + schedule(cr),
+            '"sensitivity":' + schedule(isf),
+            '"maxBasalRate":' + json.dumps(max_basal),
+            '"maxBolus":' + json.dumps(max_bolus),
+            f'"predictionStart":"{prediction_start_str}"',
+            '"recommendationInsulinType":' + json.dumps(insulin_type),
+            '"recommendationType":' + json.dumps(recommendation_type),
+            '"suspendThreshold":' + json.dumps(suspend_threshold),
+            '"target":' + target,
+        ]
+        return ('{' + ','.join(parts) + '}').encode('utf-8')
+
+    insulin_json_list = [
+        {"startDate": start, "endDate": end, "type": dose_type, "volume": volume, "insulinType": insulin_type}
+        for start, end, dose_type, volume in zip(dose_start_dates, dose_end_dates, dose_types, dose_volumes)
+    ]
+    bg_json_list = [{"date": date, "value": value} for date, value in zip(bg_date_strings, bg_values.tolist())]
+    carbs_json_list = [{"date": date, "grams": value, "absorptionTime": 10800}
+                       for date, value in zip(carbs_date_strings, carbs_values.tolist())]
+
+    def schedule_json_list(setting):
+        return [{"startDate": start, "endDate": end, "value": value} for start, end, value in schedule_entries(setting)]
 
     json_data = {
         "carbEntries": carbs_json_list,
         "doses": insulin_json_list,
         "glucoseHistory": bg_json_list,
-        "basal": basal,
-        "carbRatio": cr,
-        "sensitivity": isf,
+        "basal": schedule_json_list(basal),
+        "carbRatio": schedule_json_list(cr),
+        "sensitivity": schedule_json_list(isf),
     }
     # Adding other mandatory default values for recommendations
     json_data['maxBasalRate'] = max_basal
     json_data['maxBolus'] = max_bolus
-    json_data['predictionStart'] = prediction_start.strftime('%Y-%m-%dT%H:%M:%SZ')
+    json_data['predictionStart'] = prediction_start_str
     json_data['recommendationInsulinType'] = insulin_type
     json_data['recommendationType'] = recommendation_type
     json_data['suspendThreshold'] = suspend_threshold
     json_data['target'] = [{
-            "endDate": data.index[-1].strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "endDate": target_end_str,
             "lowerBound": target_lower,
-            "startDate": data.index[0].strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "startDate": target_start_str,
             "upperBound": target_upper
     }]
     return json_data
 
 
+@timed('build_input')
+def get_columnar_loop_prediction_input_from_df(data, basal, isf, cr, prediction_start, insulin_type='novolog',
+                                               max_basal=4.0, max_bolus=9, recommendation_type='automaticBolus',
+                                               suspend_threshold=78, target_lower=101, target_upper=115):
+    """
+    Convert a glucose and insulin DataFrame into contiguous arrays for the columnar functions within `api.py`.
+    This is the binary counterpart of `get_json_loop_prediction_input_from_df`, and takes the same arguments. No
+    string formatting or JSON encoding is done, all dates are seconds since 1970.
+
+    Returns:
+        dict: Numpy float64 arrays for glucose, doses, carbs, schedules and targets, plus the scalar settings.
+    """
+    validate_insulin_type(insulin_type)
+    validate_recommendation_type(recommendation_type)
+
+    def get_dates_and_values(column):
+        if column in data.columns:
+            values = data[column].to_numpy(dtype=np.float64)
+            mask = ~np.isnan(values)
+            return seconds[mask], values[mask]
+        else:
+            return np.empty(0), np.empty(0)
+
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index()
+    seconds = get_epoch_seconds(data.index)
+
+    bolus_dates, bolus_values = get_dates_and_values('bolus')
+    basal_dates, basal_values = get_dates_and_values('basal')
+    dose_start_dates = np.concatenate([bolus_dates, basal_dates])
+    order = np.argsort(dose_start_dates, kind='stable')
+    dose_start_dates = dose_start_dates[order]
+
+    bg_dates, bg_values = get_dates_and_values('CGM')
+    carbs_dates, carbs_values = get_dates_and_values('carbs')
+
+    def schedule(setting):
+        segments = _get_setting_schedule(setting, data, seconds)
+        if segments is None:
+            # It is important that the settings dates wrap the first and last glucose data to avoid a code crash
+            return Schedule(np.array([seconds[0] - SCHEDULE_MARGIN]), np.array([seconds[-1] + SCHEDULE_MARGIN]),
+                            np.array([setting], dtype=np.float64))
+        return segments
+
+    basal_schedule, isf_schedule, cr_schedule = schedule(basal), schedule(isf), schedule(cr)
+
+    return {
+        "glucose_dates": bg_dates,
+        "glucose_values": bg_values,
+        "dose_start_dates": dose_start_dates,
+        "dose_end_dates": dose_start_dates + 5 * 60,
+        # Converting basal from U/hr to delivered units in 5 minutes
+        "dose_volumes": np.concatenate([bolus_values, basal_values / 12])[order],
+        "dose_types": np.concatenate([np.zeros(len(bolus_dates)), np.ones(len(basal_dates))])[order],
+        "carb_dates": carbs_dates,
+        "carb_grams": carbs_values,
+        "carb_absorption_times": np.full(len(carbs_dates), 10800.0),
+        "basal_start_dates": basal_schedule.start_dates,
+        "basal_end_dates": basal_schedule.end_dates,
+        "basal_values": basal_schedule.values,
+        "isf_start_dates": isf_schedule.start_dates,
+        "isf_end_dates": isf_schedule.end_dates,
+        "isf_values": isf_schedule.values,
+        "cr_start_dates": cr_schedule.start_dates,
+        "cr_end_dates": cr_schedule.end_dates,
+        "cr_values": cr_schedule.values,
+        "target_start_dates": seconds[:1],
+        "target_end_dates": seconds[-1:],
+        "target_lower": np.array([target_lower], dtype=np.float64),
+        "target_upper": np.array([target_upper], dtype=np.float64),
+        "prediction_start": get_epoch_seconds(prediction_start)[0],
+        "insulin_type": insulin_type,
+        "max_basal_rate": max_basal,
+        "max_bolus": max_bolus,
+        "suspend_threshold": suspend_threshold,
+        "recommendation_type": recommendation_type,
+        "use_integral_retrospective_correction": False,
+        "include_positive_velocity_and_rc": True,
+    }
+
+
+def get_columnar_input_from_json(json_data):
+    """
+    Convert a JSON input in the format used by the JSON functions in `api.py` (see the python test files) into the
+    arrays used by the columnar functions. Useful when migrating existing inputs to the columnar functions.
+
+    The columnar input supports one insulin type for all doses. It is read from "recommendationInsulinType", or from
+    the first dose that has an "insulinType", and defaults to "novolog".
+
+    Args:
+        json_data (dict): JSON input.
+
+    Returns:
+        dict: Arrays in the same format as returned by `get_columnar_loop_prediction_input_from_df`.
+    """
+    def column(entries, key, convert=float):
+        return np.array([convert(entry[key]) for entry in entries], dtype=np.float64)
+
+    def dates(entries, key):
+        return get_epoch_seconds([entry[key] for entry in entries]) if entries else np.empty(0)
+
+    def schedule(name, key):
+        entries = json_data.get(key, [])
+        return {
+            f"{name}_start_dates": dates(entries, 'startDate'),
+            f"{name}_end_dates": dates(entries, 'endDate'),
+            f"{name}_values": column(entries, 'value'),
+        }
+
+    glucose = json_data.get('glucoseHistory', [])
+    doses = json_data.get('doses', [])
+    carbs = json_data.get('carbEntries', [])
+    target = json_data.get('target', [])
+
+    insulin_types = [dose['insulinType'] for dose in doses if 'insulinType' in dose]
+    insulin_type = json_data.get('recommendationInsulinType', insulin_types[0] if insulin_types else 'novolog')
+
+    glucose_dates = dates(glucose, 'date')
+    prediction_start = json_data.get('predictionStart')
+    if prediction_start is not None:
+        prediction_start = get_epoch_seconds(prediction_start)[0]
+    elif len(glucose_dates) > 0:
+        prediction_start = glucose_dates.max()
+    else:
+        prediction_start = 0.0
+
+    columns = {
+        "glucose_dates": glucose_dates,
+        "glucose_values": column(glucose, 'value'),
+        "dose_start_dates": dates(doses, 'startDate'),
+        "dose_end_dates": dates(doses, 'endDate'),
+        "dose_volumes": column(doses, 'volume'),
+        "dose_types": column(doses, 'type', lambda dose_type: dose_type != 'bolus'),
+        "carb_dates": dates(carbs, 'date'),
+        "carb_grams": column(carbs, 'grams'),
+        "carb_absorption_times": np.array([entry.get('absorptionTime', 10800) for entry in carbs], dtype=np.float64),
+        "target_start_dates": dates(target, 'startDate'),
+        "target_end_dates": dates(target, 'endDate'),
+        "target_lower": column(target, 'lowerBound'),
+        "target_upper": column(target, 'upperBound'),
+        "prediction_start": prediction_start,
+        "insulin_type": insulin_type,
+        "max_basal_rate": json_data.get('maxBasalRate', 0.0),
+        "max_bolus": json_data.get('maxBolus', 0.0),
+        "suspend_threshold": json_data.get('suspendThreshold'),
+        "recommendation_type": json_data.get('recommendationType', 'automaticBolus'),
+        "use_integral_retrospective_correction": json_data.get('useIntegralRetrospectiveCorrection', False),
+        "include_positive_velocity_and_rc": json_data.get('includePositiveVelocityAndRC', True),
+    }
+    columns.update(schedule('basal', 'basal'))
+    columns.update(schedule('isf', 'sensitivity'))
+    columns.update(schedule('cr', 'carbRatio'))
+    return columns
+
+
+def get_settings_grid(**values):
+    """
+    All combinations of the given therapy settings, in the format used by `api.sweep_settings`.
+
+    Example:
+        get_settings_grid(isf=[40, 50], cr=[8, 10]) gives
+        {"isf": array([40., 40., 50., 50.]), "cr": array([8., 10., 8., 10.])}
+
+    Args:
+        **values: Lists of values for any of "basal", "isf", "cr", "target_lower" and "target_upper". A tuple of
+            (lower, upper) pairs can be given as "target" instead of separate lower and upper values.
+
+    Returns:
+        dict: One flat array per setting, with one value per combination.
+    """
+    if 'target' in values:
+        targets = np.asarray(values.pop('target'), dtype=np.float64).reshape(-1, 2)
+        values['target_index'] = np.arange(len(targets))
+    grids = np.meshgrid(*[np.asarray(value, dtype=np.float64) for value in values.values()], indexing='ij')
+    grid = {key: axis.ravel() for key, axis in zip(values, grids)}
+    if 'target_index' in grid:
+        index = grid.pop('target_index').astype(int)
+        grid['target_lower'] = targets[index, 0]
+        grid['target_upper'] = targets[index, 1]
+    return grid
+
+
 def validate_insulin_type(insulin_type):
     insulin_options = ["novolog", 'humalog', "apidra", "fiasp", "lyumjev", "afrezza"]
     if insulin_type not in insulin_options:
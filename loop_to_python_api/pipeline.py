@@ -0,0 +1,260 @@
+"""
+Out-of-core computation of insulin on board, insulin counteraction effects and carbs on board for datasets that do
+not fit in memory. The input is read in chunks (CSV with pandas, Parquet in record batches with pyarrow), each chunk
+is computed with the DataFrame functions in `api.py`, and the results are appended to an output file.
+
+Between chunks, only the last rows of each subject that the insulin and carb models need are carried over, so memory
+use is bounded by the chunk size and the number of subjects, not by the size of the dataset. The rows of each subject
+must be in time order in the input, but the subjects can be interleaved.
+
+pyarrow is only needed for Parquet input and output. It is imported when it is used.
+
+Example:
+    rows = run_pipeline('cgm.csv', 'results.parquet', {'basal': 0.8, 'isf': 45, 'cr': 10}, by='subject_id')
+"""
+import collections
+
+import numpy as np
+
+import loop_to_python_api.api as api
+import loop_to_python_api.helpers as helpers
+from loop_to_python_api.curves import percent_absorption_at_percent_time_array
+
+OUTPUT_COLUMNS = ('iob', 'ice', 'cob')
+
+# Carb absorption time and delay used for carbs on board, as in the JSON inputs built by the helpers and LoopAlgorithm
+CARB_ABSORPTION_TIME = 10800
+CARB_DELAY = 600
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Reading and writing Parquet files requires pyarrow, install it with "
+                          "`pip install pyarrow`.") from error
+    return pyarrow
+
+
+def _is_parquet(path):
+    return str(path).lower().endswith(('.parquet', '.pq'))
+
+
+def _with_date_index(chunk, date_column):
+    import pandas as pd
+
+    if date_column in chunk.columns:
+        chunk = chunk.set_index(pd.DatetimeIndex(pd.to_datetime(chunk.pop(date_column)), name=date_column))
+    elif not isinstance(chunk.index, pd.DatetimeIndex):
+        raise ValueError(f"The input has no date column {date_column!r}.")
+    return chunk
+
+
+def read_chunks(path, chunk_rows=100_000, date_column='date', columns=None):
+    """
+    Read a CSV or Parquet file in chunks, without loading the whole file.
+
+    :param path: Path to a CSV file, or a Parquet file (ending with .parquet or .pq), which is read in record batches
+    of chunk_rows rows. A batch can span several row groups.
+    :param chunk_rows: The maximum number of rows per chunk.
+    :param date_column: The column with the dates, which becomes the index of the chunks.
+    :param columns: Optional list of the columns to read, including the date column.
+    :return: An iterator of DataFrames with a datetime index.
+    """
+    import pandas as pd
+
+    if _is_parquet(path):
+        pyarrow = _import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield _with_date_index(batch.to_pandas(), date_column)
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_rows, usecols=columns):
+            yield _with_date_index(chunk, date_column)
+
+
+def carbs_on_board(dates, carbs, absorption_time=CARB_ABSORPTION_TIME, delay=CARB_DELAY):
+    """
+    Carbs on board at each date, from the carb entries at the same dates, with the piecewise linear absorption model.
+    Unlike get_dynamic_carbs_on_board, the absorption is not adjusted to the observed insulin counteraction effects.
+
+    :param dates: Dates in seconds since 1970, in ascending order.
+    :param carbs: Grams of carbs at each date. Missing values count as no carbs.
+    :param absorption_time: Absorption time of every carb entry in seconds.
+    :param delay: Seconds from a carb entry until its absorption starts.
+    :return: A numpy array with the grams of carbs on board at each date.
+    """
+    dates = np.asarray(dates, dtype=np.float64)
+    carbs = np.nan_to_num(np.asarray(carbs, dtype=np.float64))
+    cob = np.zeros(len(dates))
+    for position in np.flatnonzero(carbs > 0):
+        end = np.searchsorted(dates, dates[position] + delay + absorption_time, side='right')
+        percent_time = (dates[position:end] - dates[position] - delay) / absorption_time
+        cob[position:end] += carbs[position] * (1.0 - percent_absorption_at_percent_time_array(percent_time))
+    return cob
+
+
+def _compute_subject(data, settings, lookback, overlap, outputs):
+    basal, isf, cr = settings['basal'], settings['isf'], settings['cr']
+    insulin_type = settings.get('insulin_type', 'novolog')
+    results = {}
+    if 'iob' in outputs:
+        results['iob'] = api.add_insulin_on_board_to_df(data.copy(), basal, isf, cr, insulin_type=insulin_type,
+                                                        lookback=lookback)['iob'].to_numpy()
+    if 'ice' in outputs:
+        results['ice'] = api.add_insulin_counteraction_effect_to_df(data.copy(), basal, isf, cr,
+                                                                    insulin_type=insulin_type,
+                                                                    overlap=overlap)['ice'].to_numpy()
+    if 'cob' in outputs:
+        carbs = data['carbs'].to_numpy() if 'carbs' in data.columns else np.zeros(len(data))
+        results['cob'] = carbs_on_board(helpers.get_epoch_seconds(data.index), carbs)
+    return results
+
+
+def _carry_start(data, lookback, overlap):
+    """
+    The position of the first row the next chunk needs: the rows used to compute insulin on board and insulin
+    counteraction effects, and the carb entries that are not absorbed yet. One row more than the overlap is kept, so
+    that the effect of the last row, which is computed again with the next chunk, is after the warm-up rows.
+    """
+    seconds = helpers.get_epoch_seconds(data.index)
+    first_carb_row = np.searchsorted(seconds, seconds[-1] - CARB_ABSORPTION_TIME - CARB_DELAY, side='right')
+    return max(min(len(data) - max(lookback, overlap + 1), first_carb_row), 0)
+
+
+def compute_chunks(chunks, settings, by=None, lookback=72, overlap=72, outputs=OUTPUT_COLUMNS, max_held_chunks=4):
+    """
+    Compute insulin on board, insulin counteraction effects and carbs on board for each chunk of a dataset. The rows
+    a subject's next chunk needs are carried over between chunks, so the values match computing the whole subject at
+    once with add_insulin_on_board_to_df and add_insulin_counteraction_effect_to_df, as long as lookback and overlap
+    cover the insulin action duration.
+
+    The insulin counteraction effect of a subject's last row in a chunk needs the subject's next glucose reading, so a
+    chunk is held back until every subject with rows in it has appeared again, or until more than max_held_chunks
+    chunks are held. A last row that is written before its subject appears again has no insulin counteraction effect,
+    like the last row of each subject in the whole dataset.
+
+    :param chunks: DataFrames with a datetime index, and at least the columns "basal", "bolus" and "CGM", for example
+    from read_chunks. "carbs" is used for carbs on board.
+    :param settings: Dictionary with "basal", "isf", "cr" and optionally "insulin_type" used for all subjects, or a
+    dictionary from subject ID to such a dictionary, as for api.add_iob_and_ice.
+    :param by: Optional name of the column identifying the subject. Without it, all rows are one subject.
+    :param lookback: Lookback used to compute insulin on board, see api.add_insulin_on_board_to_df.
+    :param overlap: Number of warm-up rows per subject without insulin counteraction effects, see
+    api.add_insulin_counteraction_effect_to_df.
+    :param outputs: The columns to compute, any of "iob", "ice" and "cob".
+    :param max_held_chunks: The maximum number of computed chunks held in memory while waiting for subjects to appear
+    again.
+    :return: An iterator of the chunks with the new columns, in the input order.
+    """
+    import pandas as pd
+
+    unknown = set(outputs) - set(OUTPUT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown outputs {sorted(unknown)}. Valid outputs are {OUTPUT_COLUMNS}.")
+
+    def get_settings(subject):
+        return settings[subject] if subject in settings and isinstance(settings[subject], dict) else settings
+
+    def finish(chunk, results):
+        chunk = chunk.copy()
+        for column, values in results.items():
+            chunk[column] = values
+        return chunk
+
+    carry = {}
+    # The chunks that are held back, and for each subject the results and position of its last row in them, which is
+    # computed again when the subject appears in a later chunk
+    pending = collections.deque()
+    pending_last_rows = {}
+    for chunk in chunks:
+        results = {column: np.full(len(chunk), np.nan) for column in outputs}
+        positions = chunk.groupby(by, sort=False).indices if by is not None else {None: np.arange(len(chunk))}
+        for subject, subject_positions in positions.items():
+            rows = chunk.iloc[subject_positions]
+            previous = carry.get(subject)
+            data = rows if previous is None else pd.concat([previous, rows])
+            if not data.index.is_monotonic_increasing:
+                raise ValueError(f"The rows of subject {subject} are not in time order.")
+            subject_results = _compute_subject(data, get_settings(subject), lookback, overlap, outputs)
+            carried = 0 if previous is None else len(previous)
+            for column, values in subject_results.items():
+                results[column][subject_positions] = values[carried:]
+            if carried and subject in pending_last_rows:
+                pending_results, position = pending_last_rows.pop(subject)
+                pending_results['ice'][position] = subject_results['ice'][carried - 1]
+            carry[subject] = data.iloc[_carry_start(data, lookback, overlap):]
+
+        pending.append((chunk, results))
+        if 'ice' in outputs:
+            pending_last_rows.update({subject: (results, subject_positions[-1])
+                                      for subject, subject_positions in positions.items()})
+        while pending and (len(pending) > max_held_chunks or
+                           all(held is not pending[0][1] for held, _ in pending_last_rows.values())):
+            chunk, results = pending.popleft()
+            pending_last_rows = {subject: last_row for subject, last_row in pending_last_rows.items()
+                                 if last_row[0] is not results}
+            yield finish(chunk, results)
+    while pending:
+        yield finish(*pending.popleft())
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        self._pyarrow = _import_pyarrow()
+        self._path = path
+        self._writer = None
+
+    def write(self, df):
+        table = self._pyarrow.Table.from_pandas(df, schema=self._writer.schema if self._writer else None)
+        if self._writer is None:
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        self._path = path
+        self._header = True
+
+    def write(self, df):
+        df.to_csv(self._path, mode='w' if self._header else 'a', header=self._header)
+        self._header = False
+
+    def close(self):
+        pass
+
+
+def run_pipeline(input_path, output_path, settings, by=None, date_column='date', chunk_rows=100_000, lookback=72,
+                 overlap=72, outputs=OUTPUT_COLUMNS, columns=None, max_held_chunks=4):
+    """
+    Compute insulin on board, insulin counteraction effects and carbs on board for a CSV or Parquet file of any size,
+    and append the results chunk by chunk to an output file.
+
+    :param input_path: CSV or Parquet file with a date column, and at least the columns "basal", "bolus" and "CGM".
+    :param output_path: Output file, written as Parquet if it ends with .parquet or .pq and as CSV otherwise. It is
+    overwritten. The output has the input columns and one column per output.
+    :param settings: Therapy settings, see compute_chunks.
+    :param by: Optional name of the column identifying the subject.
+    :param date_column: Name of the date column.
+    :param chunk_rows: The maximum number of rows read at a time.
+    :param lookback, overlap, outputs, max_held_chunks: See compute_chunks.
+    :param columns: Optional list of the input columns to read, including the date column.
+    :return: The number of rows written.
+    """
+    writer = _ParquetWriter(output_path) if _is_parquet(output_path) else _CsvWriter(output_path)
+    rows = 0
+    try:
+        for chunk in compute_chunks(read_chunks(input_path, chunk_rows, date_column, columns), settings, by=by,
+                                    lookback=lookback, overlap=overlap, outputs=outputs,
+                                    max_held_chunks=max_held_chunks):
+            writer.write(chunk)
+            rows += len(chunk)
+    finally:
+        writer.close()
+    return rows
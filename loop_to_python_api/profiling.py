@@ -0,0 +1,204 @@
+"""
+Opt-in timing of where the time goes in an API call, on both sides of the dynamic library boundary.
+
+Python stages:
+- build_input: building the input from a DataFrame (helpers.get_json_loop_prediction_input_from_df and
+  helpers.get_columnar_loop_prediction_input_from_df)
+- serialize: encoding the JSON input to bytes (json.dumps)
+- native_call: the call into the dynamic library, including the ctypes overhead
+- parse_output: copying the results out of the native buffers, and parsing strings and dates
+
+Native stages, counted inside the dynamic library:
+- decode: JSON decoding, or converting columnar arrays into samples
+- algorithm: LoopAlgorithm computations
+- output: building the returned arrays and strings, for example the ISO 8601 date strings
+- export: whole export calls, including the three stages above
+
+Profiling is enabled with `enable_profiling` or the `profile` context manager (re-exported by
+`loop_to_python_api.api`). When it is disabled, each timed Python stage only pays for one global lookup, and each
+native stage for one atomic load.
+"""
+import contextlib
+import functools
+import logging
+import threading
+import time
+import typing
+
+# Must match LOOP_PROFILING_BUCKETS in CLoopAlgorithmToPython.h
+HISTOGRAM_BUCKETS = 24
+PYTHON_STAGES = ('build_input', 'serialize', 'native_call', 'parse_output')
+NATIVE_STAGES = ('decode', 'algorithm', 'output', 'export')
+
+
+class StageStats(typing.NamedTuple):
+    """
+    Cumulative timings of one stage. histogram[0] counts durations under 1 microsecond, histogram[i] counts durations
+    in [2**(i-1), 2**i) microseconds, and the last bucket also counts everything longer.
+    """
+    calls: int
+    total_seconds: float
+    max_seconds: float
+    histogram: typing.Tuple[int, ...]
+
+    @property
+    def mean_seconds(self):
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+    def percentile_seconds(self, percentile):
+        """
+        An upper bound of the percentile, from the histogram bucket it falls in.
+        """
+        if self.calls == 0:
+            return 0.0
+        rank = percentile / 100 * self.calls
+        count = 0
+        for bucket, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= rank:
+                return min(2 ** bucket * 1e-6, self.max_seconds)
+        return self.max_seconds
+
+
+def _bucket(seconds):
+    return min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+
+
+class Profiler:
+    """
+    Collects the timings of the Python stages, and reads the native counters from the dynamic library.
+
+    :param callback: Optional function called with (stage, seconds) after every timed Python stage, for example to
+    send the timings to a logging sink or a metrics system. It is called on the thread that ran the stage.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._calls = dict.fromkeys(PYTHON_STAGES, 0)
+        self._total = dict.fromkeys(PYTHON_STAGES, 0.0)
+        self._max = dict.fromkeys(PYTHON_STAGES, 0.0)
+        self._histogram = {stage: [0] * HISTOGRAM_BUCKETS for stage in PYTHON_STAGES}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._calls[stage] += 1
+            self._total[stage] += seconds
+            self._max[stage] = max(self._max[stage], seconds)
+            self._histogram[stage][_bucket(seconds)] += 1
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+    def python_stats(self):
+        with self._lock:
+            return {stage: StageStats(self._calls[stage], self._total[stage], self._max[stage],
+                                      tuple(self._histogram[stage])) for stage in PYTHON_STAGES}
+
+    def native_stats(self):
+        """
+        The native counters are process-wide, so they also include calls made by other threads while profiling was
+        enabled.
+        """
+        return get_native_stats()
+
+    def stats(self):
+        """
+        :return: A dictionary from stage name to StageStats, for the Python stages followed by the native stages.
+        """
+        return {**self.python_stats(), **self.native_stats()}
+
+    def report(self):
+        """
+        :return: A table with the calls, total, mean, p50, p99 and maximum time of every stage that ran.
+        """
+        lines = [f"{'stage':<14}{'calls':>10}{'total ms':>12}{'mean us':>12}{'p50 us':>12}{'p99 us':>12}{'max us':>12}"]
+        for stage, stats in self.stats().items():
+            if stats.calls == 0:
+                continue
+            lines.append(f"{stage:<14}{stats.calls:>10}{stats.total_seconds * 1e3:>12.2f}"
+                         f"{stats.mean_seconds * 1e6:>12.1f}{stats.percentile_seconds(50) * 1e6:>12.1f}"
+                         f"{stats.percentile_seconds(99) * 1e6:>12.1f}{stats.max_seconds * 1e6:>12.1f}")
+        return '\n'.join(lines)
+
+
+_active_profiler = None
+
+
+def enable_profiling(callback=None):
+    """
+    Start timing the Python and native stages. The native counters are reset.
+
+    :param callback: Optional function called with (stage, seconds) after every timed Python stage.
+    :return: The Profiler.
+    """
+    global _active_profiler
+    from loop_to_python_api.api import swift_lib
+    swift_lib.resetProfilingStats()
+    swift_lib.setProfilingEnabled(1)
+    _active_profiler = Profiler(callback)
+    return _active_profiler
+
+
+def disable_profiling():
+    """
+    Stop timing. The stats of the last Profiler, including the native counters, can still be read.
+    """
+    global _active_profiler
+    from loop_to_python_api.api import swift_lib
+    swift_lib.setProfilingEnabled(0)
+    _active_profiler = None
+
+
+@contextlib.contextmanager
+def profile(callback=None):
+    """
+    Time the stages of the API calls made inside the block.
+
+    Example:
+        with profile() as profiler:
+            api.generate_prediction(json_data)
+        print(profiler.report())
+    """
+    profiler = enable_profiling(callback)
+    try:
+        yield profiler
+    finally:
+        disable_profiling()
+
+
+def get_native_stats():
+    """
+    :return: A dictionary from native stage name to StageStats, counted since profiling was last enabled.
+    """
+    from loop_to_python_api.api import swift_lib, LoopProfilingStats
+    native = LoopProfilingStats()
+    swift_lib.getProfilingStats(native)
+    return {stage: StageStats(native.calls[i], native.totalNanoseconds[i] * 1e-9, native.maxNanoseconds[i] * 1e-9,
+                              tuple(native.histogram[i])) for i, stage in enumerate(NATIVE_STAGES)}
+
+
+def logging_callback(logger=None, level=logging.DEBUG):
+    """
+    A callback for enable_profiling and profile that logs every timed stage.
+    """
+    logger = logger or logging.getLogger('loop_to_python_api.profiling')
+    return lambda stage, seconds: logger.log(level, "%s took %.1f us", stage, seconds * 1e6)
+
+
+def timed(stage):
+    """
+    Decorator that records the duration of each call under the stage while profiling is enabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,154 @@
+"""
+Closed-loop replay for backtesting. The full history is passed to the dynamic library once, and a cursor steps through
+time inside the library, running the algorithm on the data known at each step. The outputs are returned as one numpy
+array per output, with one value per step, instead of one JSON string per step.
+"""
+import json
+import typing
+
+import numpy as np
+
+import loop_to_python_api.helpers as helpers
+from loop_to_python_api import profiling
+from loop_to_python_api.api import swift_lib, _call, _create_columnar_input, _double_pointer
+from loop_to_python_api.session import DEFAULT_RETENTION
+
+# Status codes of the steps, the same as the native error codes in exceptions.py
+STEP_OK = 0
+STEP_NO_GLUCOSE = 1
+STEP_RECOMMENDATION_FAILED = 3
+
+
+RECOMMENDATION_COLUMNS = ('automatic_bolus', 'temp_basal_rate', 'temp_basal_duration', 'manual_bolus', 'status')
+
+
+class ReplayResult(typing.NamedTuple):
+    """
+    The outputs at every step of a replay. Doses are NaN where none was recommended, and every output is NaN for the
+    steps without glucose readings (status STEP_NO_GLUCOSE).
+    """
+    dates: np.ndarray
+    automatic_bolus: np.ndarray
+    temp_basal_rate: np.ndarray
+    temp_basal_duration: np.ndarray
+    manual_bolus: np.ndarray
+    active_insulin: np.ndarray
+    active_carbs: np.ndarray
+    # Predicted glucose (mg/dL) with one row per step and one column per horizon
+    predictions: np.ndarray
+    horizons: np.ndarray
+    status: np.ndarray
+
+
+@profiling.timed('parse_output')
+def _to_replay_result(result, horizons):
+    try:
+        def copy(pointer, dtype=np.float64):
+            if result.count == 0:
+                return np.empty(0, dtype=dtype)
+            return np.ctypeslib.as_array(pointer, shape=(result.count,)).astype(dtype)
+
+        if result.count and result.horizonCount:
+            predictions = np.ctypeslib.as_array(result.predictions,
+                                                shape=(result.count, result.horizonCount)).copy()
+        else:
+            predictions = np.empty((result.count, result.horizonCount))
+        return ReplayResult(
+            helpers.get_datetimes_from_epoch_seconds(copy(result.dates)),
+            copy(result.automaticBolus),
+            copy(result.tempBasalRate),
+            # Minutes, like the horizons
+            copy(result.tempBasalDuration) / 60,
+            copy(result.manualBolus),
+            copy(result.activeInsulin),
+            copy(result.activeCarbs),
+            predictions,
+            horizons,
+            copy(result.status, np.int32),
+        )
+    finally:
+        swift_lib.freeLoopReplayResult(result)
+
+
+def replay(input_data, step_dates=None, horizons=(30, 60, 120), apply_recommendations=False,
+           retention=DEFAULT_RETENTION):
+    """
+    Run the algorithm at every step of a history, as Loop would have at each cycle.
+
+    In the "observed doses" mode (the default), every step uses the doses in the data. With apply_recommendations,
+    the observed basal deliveries from the first step on are replaced by the recommended temp basals, each delivered
+    until the next step or until it ends, whichever is first (and the scheduled basal when no temp basal is running),
+    and the recommended automatic boluses are delivered at their step. Observed boluses are kept, because they cannot be told apart from manual boluses. The
+    glucose readings are always the observed ones, as there is no model of how the glucose would have changed.
+
+    Example:
+        columns = helpers.get_columnar_loop_prediction_input_from_df(df, basal, isf, cr, df.index[-1])
+        result = replay(columns, horizons=[30, 60], apply_recommendations=True)
+
+    :param input_data: The arrays returned by helpers.get_columnar_loop_prediction_input_from_df for the whole history,
+    or a JSON input in the same format as for get_loop_recommendations. Its settings are used at every step.
+    :param step_dates: Dates of the steps in ascending order. Defaults to the dates of the glucose readings.
+    :param horizons: Minutes after each step to return the predicted glucose for.
+    :param apply_recommendations: Deliver the recommended doses instead of the observed basal deliveries.
+    :param retention: How much data before each step is used, as a timedelta. Older data does not affect the
+    algorithm output.
+    :return: A ReplayResult.
+    """
+    if isinstance(input_data, bytes):
+        input_data = json.loads(input_data)
+    if 'glucose_dates' not in input_data:
+        input_data = helpers.get_columnar_input_from_json(input_data)
+
+    if step_dates is None:
+        steps = np.unique(np.asarray(input_data['glucose_dates'], dtype=np.float64))
+    else:
+        steps = np.ascontiguousarray(helpers.get_epoch_seconds(step_dates), dtype=np.float64)
+    if np.any(np.diff(steps) < 0):
+        raise ValueError("step_dates must be in ascending order.")
+    horizons = np.ascontiguousarray(horizons, dtype=np.float64)
+    horizon_seconds = horizons * 60
+
+    handle = _create_columnar_input(input_data)
+    try:
+        result = _call(swift_lib.runReplay, handle, _double_pointer(steps), len(steps),
+                       _double_pointer(horizon_seconds), len(horizon_seconds), retention.total_seconds(),
+                       int(apply_recommendations))
+    finally:
+        swift_lib.freeColumnarInput(handle)
+    return _to_replay_result(result, horizons)
+
+
+def get_retrospective_recommendations(input_data, prediction_starts, retention=DEFAULT_RETENTION, as_dataframe=True):
+    """
+    The dose recommendations the algorithm would have made at many dates of a history, with a single call to the
+    dynamic library instead of one JSON input and get_loop_recommendations call per date. The history is decoded and
+    sorted once. Each recommendation uses the data from retention before its date up to the date, with the observed
+    doses.
+
+    Which of the columns are filled depends on the recommendation type of the input: automatic_bolus and the temp
+    basal for "automaticBolus", the temp basal for "tempBasal" and manual_bolus for "manualBolus". A temp basal rate
+    of NaN means that the scheduled basal should continue.
+
+    :param input_data: The arrays returned by helpers.get_columnar_loop_prediction_input_from_df for the whole history,
+    or a JSON input in the same format as for get_loop_recommendations.
+    :param prediction_starts: The dates to get recommendations for, in any order.
+    :param retention: How much data before each date is used, as a timedelta.
+    :param as_dataframe: Return a DataFrame indexed by the dates instead of a dictionary of numpy arrays.
+    :return: The columns in RECOMMENDATION_COLUMNS, with the temp basal duration in minutes and the status codes of
+    ReplayResult, in the order of prediction_starts.
+    """
+    dates = helpers.get_epoch_seconds(prediction_starts)
+    # The steps of a replay must be in ascending order
+    order = np.argsort(dates, kind='stable')
+    result = replay(input_data, dates[order], horizons=(), retention=retention)
+    columns = {}
+    for column in RECOMMENDATION_COLUMNS:
+        values = np.empty_like(getattr(result, column))
+        values[order] = getattr(result, column)
+        columns[column] = values
+    if not as_dataframe:
+        return columns
+
+    import pandas as pd
+    return pd.DataFrame(columns, index=pd.DatetimeIndex(helpers.get_datetimes_from_epoch_seconds(dates),
+                                                        name='prediction_start'))
@@ -0,0 +1,522 @@
+"""
+A local prediction server. Services can share one pool of worker processes that each keep the dynamic library loaded,
+instead of each service loading the Swift runtime and handling fatalError aborts itself. If the dynamic library aborts
+a worker, the request fails with WorkerCrashError and the workers are restarted, while the server keeps running.
+
+Start the server on a TCP port or a Unix socket:
+    python -m loop_to_python_api.serve --port 8787 --workers 4
+    python -m loop_to_python_api.serve --unix-socket /tmp/loop.sock
+
+Call it from other processes with Client, which keeps its connection open between calls:
+    with Client(port=8787) as client:
+        iob = client.call('get_active_insulin', json_data)
+        predictions = client.batch([('generate_prediction', json_data) for json_data in inputs])
+
+HTTP endpoints (HTTP/1.1 with keep-alive and JSON bodies):
+- POST /call/<function>: body {"args": [...], "kwargs": {...}}, response {"result": ...}
+- POST /batch: body {"calls": [{"function": ..., "args": [...], "kwargs": {...}}, ...]}, response
+  {"results": [{"result": ...} or {"error": ...}, ...]}. The calls are split over the workers.
+- GET /metrics: requests, errors, worker restarts, throughput and latency percentiles per function
+- GET /health
+
+The functions in FUNCTIONS can be called. Results are converted to JSON: numpy arrays become lists (NaN is written as
+NaN, as json.dumps does), dates become ISO 8601 strings and named tuples such as AlgorithmResult become dictionaries.
+Errors are returned as {"error": {"type": ..., "code": ..., "message": ...}}, and Client raises them as the exceptions
+in exceptions.py.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import http.client
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from loop_to_python_api import api, profiling
+from loop_to_python_api.exceptions import DecodingError, WorkerCrashError, error_from_code
+
+DEFAULT_PORT = 8787
+
+# The API functions the server exposes. Their inputs are JSON, so they are sent as they are.
+FUNCTIONS = (
+    'generate_prediction',
+    'get_prediction_dates',
+    'get_prediction_values_and_dates',
+    'get_dose_recommendations',
+    'get_glucose_effect_velocity',
+    'get_glucose_effect_velocity_and_dates',
+    'get_insulin_counteraction_effects',
+    'get_active_carbs',
+    'get_active_insulin',
+    'get_loop_recommendations',
+    'run_algorithm',
+)
+
+_STATUS_BY_ERROR = {
+    'InvalidInputError': 400,
+    'DecodingError': 400,
+    'ValueError': 400,
+    'TypeError': 400,
+    'AlgorithmError': 422,
+    'WorkerCrashError': 503,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def _to_jsonable(value):
+    """
+    Convert an API result into JSON types.
+    """
+    if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {key: _to_jsonable(item) for key, item in value._asdict().items()}
+    if isinstance(value, np.ndarray):
+        if np.issubdtype(value.dtype, np.datetime64):
+            return [date + 'Z' for date in np.datetime_as_string(value, unit='s').tolist()]
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _error(error):
+    return {'type': type(error).__name__, 'code': getattr(error, 'code', None), 'message': str(error)}
+
+
+def _unknown_function(function):
+    return {'type': 'ValueError', 'code': None,
+            'message': f"Unknown function: {function!r}. Must be one of {list(FUNCTIONS)}."}
+
+
+def _run_calls(calls):
+    """
+    Run (function, args, kwargs) calls in a worker process. Errors are returned per call, so that one invalid input
+    does not fail the other calls of a batch.
+    """
+    results = []
+    for function, args, kwargs in calls:
+        try:
+            results.append({'result': _to_jsonable(getattr(api, function)(*args, **kwargs))})
+        except Exception as error:
+            results.append({'error': _error(error)})
+    return results
+
+
+class WorkerPool:
+    """
+    A pool of worker processes that each load the dynamic library once. If a worker exits while running a task, for
+    example because of a fatalError in the dynamic library, the tasks running on the pool at that time fail with
+    WorkerCrashError, and the pool is replaced by a new one.
+
+    :param workers: Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        # The server is multithreaded, so the workers are spawned instead of forked from it
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=api._initialize_worker)
+
+    def run(self, function, arguments):
+        """
+        Run function(argument) for each argument in the worker processes, in parallel, and wait for the results.
+
+        :return: The results in the order of the arguments.
+        """
+        executor = self._executor
+        try:
+            futures = [executor.submit(function, argument) for argument in arguments]
+            return [future.result() for future in futures]
+        except BrokenProcessPool as error:
+            self._restart(executor)
+            raise WorkerCrashError("A worker process exited while running the request. The workers were restarted, "
+                                   "so the request can be retried.") from error
+
+    def _restart(self, broken):
+        with self._lock:
+            # Only the first request that finds the pool broken replaces it
+            if self._executor is broken:
+                logger.warning("A worker process exited, restarting the workers")
+                self._executor = self._start()
+                self.restarts += 1
+        broken.shutdown(wait=False)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class Metrics:
+    """
+    Request counts and latencies per function, measured in the server from receiving a request to having its result.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+        self._total = {}
+        self._max = {}
+        self._histogram = {}
+
+    def record(self, name, seconds, errors=0, calls=1):
+        with self._lock:
+            if name not in self._calls:
+                self._calls[name] = self._errors[name] = 0
+                self._total[name] = self._max[name] = 0.0
+                self._histogram[name] = [0] * profiling.HISTOGRAM_BUCKETS
+            self._calls[name] += calls
+            self._errors[name] += errors
+            self._total[name] += seconds
+            self._max[name] = max(self._max[name], seconds)
+            self._histogram[name][profiling._bucket(seconds)] += 1
+
+    def snapshot(self):
+        """
+        :return: A dictionary with the uptime, the number of calls and errors, the throughput in calls per second, and
+        for each function (and "batch" for batch requests) the calls, errors and latency in milliseconds.
+        """
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            functions = {}
+            for name, calls in self._calls.items():
+                requests = sum(self._histogram[name])
+                stats = profiling.StageStats(requests, self._total[name], self._max[name],
+                                             tuple(self._histogram[name]))
+                functions[name] = {
+                    'calls': calls,
+                    'errors': self._errors[name],
+                    'mean_ms': stats.mean_seconds * 1e3,
+                    'p50_ms': stats.percentile_seconds(50) * 1e3,
+                    'p99_ms': stats.percentile_seconds(99) * 1e3,
+                    'max_ms': stats.max_seconds * 1e3,
+                }
+            calls = sum(self._calls.values())
+            return {
+                'uptime_seconds': uptime,
+                'calls': calls,
+                'errors': sum(self._errors.values()),
+                'throughput_per_second': calls / uptime if uptime > 0 else 0.0,
+                'functions': functions,
+            }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so that clients reuse their connection
+    protocol_version = 'HTTP/1.1'
+    # Small responses are sent at once, instead of waiting for the acknowledgement of the previous packet
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.prediction_server
+        if self.path == '/metrics':
+            self._send(200, server.get_metrics())
+        elif self.path == '/health':
+            self._send(200, {'status': 'ok', 'workers': server.pool.workers})
+        else:
+            self._send(404, {'error': {'type': 'ValueError', 'code': None, 'message': f"Unknown path: {self.path}"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(*self.server.prediction_server.handle(self.path, body))
+
+    def _send(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class _UnixHandler(_Handler):
+    disable_nagle_algorithm = False
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class PredictionServer:
+    """
+    The HTTP server and its worker pool. Use main() to run it from the command line.
+
+    :param host: Host to listen on, for TCP.
+    :param port: Port to listen on, for TCP. 0 picks a free port, see address.
+    :param unix_socket: Path of a Unix socket to listen on instead of TCP. An existing socket at the path is replaced.
+    :param workers: Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None, workers=None):
+        self.unix_socket = unix_socket
+        if unix_socket is not None:
+            if os.path.exists(unix_socket) and stat.S_ISSOCK(os.stat(unix_socket).st_mode):
+                os.unlink(unix_socket)
+            self._server = _UnixServer(unix_socket, _UnixHandler)
+        else:
+            self._server = _TCPServer((host, port), _Handler)
+        self._server.prediction_server = self
+        self.pool = WorkerPool(workers)
+        self.metrics = Metrics()
+
+    @property
+    def address(self):
+        """
+        The (host, port) the server listens on, or the path of its Unix socket.
+        """
+        return self._server.server_address
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """
+        Stop serve_forever, from another thread.
+        """
+        self._server.shutdown()
+
+    def close(self):
+        self._server.server_close()
+        self.pool.close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+
+    def get_metrics(self):
+        metrics = self.metrics.snapshot()
+        metrics['workers'] = self.pool.workers
+        metrics['worker_restarts'] = self.pool.restarts
+        return metrics
+
+    def handle(self, path, body):
+        """
+        Handle a POST request.
+
+        :return: The HTTP status and the response.
+        """
+        try:
+            request = json.loads(body) if body else {}
+        except ValueError as error:
+            return 400, {'error': _error(DecodingError(f"The request is not valid JSON: {error}"))}
+        if not isinstance(request, dict):
+            return 400, {'error': _error(DecodingError("The request must be a JSON object."))}
+
+        if path == '/batch':
+            calls = request.get('calls', [])
+            if not isinstance(calls, list) or not all(isinstance(call, dict) for call in calls):
+                return 400, {'error': _error(DecodingError('"calls" must be a list of JSON objects.'))}
+            return self._handle_batch(calls)
+        if not path.startswith('/call/'):
+            return 404, {'error': {'type': 'ValueError', 'code': None, 'message': f"Unknown path: {path}"}}
+        function = path[len('/call/'):]
+        if function not in FUNCTIONS:
+            return 404, {'error': _unknown_function(function)}
+
+        start = time.perf_counter()
+        try:
+            result, = self.pool.run(_run_calls, [[(function, request.get('args', []), request.get('kwargs', {}))]])[0]
+        except WorkerCrashError as error:
+            result = {'error': _error(error)}
+        self.metrics.record(function, time.perf_counter() - start, errors=int('error' in result))
+        status = 200 if 'result' in result else _STATUS_BY_ERROR.get(result['error']['type'], 500)
+        return status, result
+
+    def _handle_batch(self, calls):
+        start = time.perf_counter()
+        results = [None] * len(calls)
+        valid = []
+        for position, call in enumerate(calls):
+            if call.get('function') in FUNCTIONS:
+                valid.append(position)
+            else:
+                results[position] = {'error': _unknown_function(call.get('function'))}
+
+        # One task per worker, so that the process boundary is crossed once per worker instead of once per call
+        size = -(-len(valid) // self.pool.workers) if valid else 1
+        chunks = [valid[i:i + size] for i in range(0, len(valid), size)]
+        try:
+            chunk_results = self.pool.run(_run_calls, [[(calls[position]['function'], calls[position].get('args', []),
+                                                          calls[position].get('kwargs', {})) for position in chunk]
+                                                        for chunk in chunks])
+        except WorkerCrashError as error:
+            self.metrics.record('batch', time.perf_counter() - start, errors=len(calls), calls=len(calls))
+            return 503, {'error': _error(error)}
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            for position, result in zip(chunk, chunk_result):
+                results[position] = result
+
+        errors = sum('error' in result for result in results)
+        self.metrics.record('batch', time.perf_counter() - start, errors=errors, calls=len(calls))
+        return 200, {'results': results}
+
+
+def _exception(error):
+    """
+    The exception to raise in the client for an error returned by the server.
+    """
+    if error['type'] == 'WorkerCrashError':
+        return WorkerCrashError(error['message'])
+    if error['code'] is not None:
+        return error_from_code(error['code'], error['message'])
+    if error['type'] in ('ValueError', 'TypeError'):
+        return {'ValueError': ValueError, 'TypeError': TypeError}[error['type']](error['message'])
+    return RuntimeError(f"{error['type']}: {error['message']}")
+
+
+def _encode(value):
+    # Bytes are already JSON, for example from get_json_loop_prediction_input_from_df(..., as_bytes=True), and are sent
+    # without decoding them again
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(_to_jsonable(value)).encode('utf-8')
+
+
+def _encode_arguments(args, kwargs):
+    return (b'"args":[' + b','.join(_encode(arg) for arg in args) + b'],"kwargs":{' +
+            b','.join(json.dumps(key).encode('utf-8') + b':' + _encode(value) for key, value in kwargs.items()) + b'}')
+
+
+class _TCPConnection(http.client.HTTPConnection):
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Client:
+    """
+    A client of the prediction server that reuses one connection for all its requests. A Client is not thread-safe,
+    so use one per thread.
+
+    :param host: Host of the server, for TCP.
+    :param port: Port of the server, for TCP.
+    :param unix_socket: Path of the server's Unix socket, instead of TCP.
+    :param timeout: Optional timeout of each request in seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None, timeout=None):
+        if unix_socket is not None:
+            self._connection = _UnixConnection(unix_socket, timeout=timeout)
+        else:
+            self._connection = _TCPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            try:
+                self._connection.request(method, path, body, headers)
+                return json.loads(self._connection.getresponse().read())
+            except (ConnectionError, http.client.BadStatusLine):
+                # The server closed the kept-alive connection, so connect again once
+                self._connection.close()
+                if attempt == 1:
+                    raise
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call one of the functions in FUNCTIONS in the server.
+
+        :return: The result converted to JSON types.
+        """
+        response = self._request('POST', f'/call/{function}', b'{' + _encode_arguments(args, kwargs) + b'}')
+        if 'error' in response:
+            raise _exception(response['error'])
+        return response['result']
+
+    def batch(self, calls):
+        """
+        Run many calls with one request. The server splits them over its workers.
+
+        :param calls: Tuples of a function name and its positional arguments, for example
+        [('get_active_insulin', json_data), ...].
+        :return: The results in the order of the calls. A call that failed gives its exception instead of a result.
+        """
+        body = b'{"calls":[' + b','.join(b'{"function":' + json.dumps(function).encode('utf-8') + b',' +
+                                         _encode_arguments(args, {}) + b'}' for function, *args in calls) + b']}'
+        response = self._request('POST', '/batch', body)
+        if 'error' in response:
+            raise _exception(response['error'])
+        return [result['result'] if 'result' in result else _exception(result['error'])
+                for result in response['results']]
+
+    def metrics(self):
+        """
+        :return: The server metrics, see Metrics.snapshot.
+        """
+        return self._request('GET', '/metrics')
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loop_to_python_api.serve',
+                                     description="Serve the loop_to_python_api functions over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1', help="Host to listen on (default: %(default)s).")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on (default: %(default)s).")
+    parser.add_argument('--unix-socket', help="Listen on a Unix socket at this path instead of TCP.")
+    parser.add_argument('--workers', type=int, help="Number of worker processes (default: the number of CPUs).")
+    parser.add_argument('--log-level', default='INFO', help="Logging level (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    server = PredictionServer(args.host, args.port, unix_socket=args.unix_socket, workers=args.workers)
+    logger.info("Serving on %s with %d workers", server.address, server.pool.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+A stateful session for real-time loop cycles. The decoded history and therapy settings are held by a native columnar
+input handle, so each 5-minute cycle only sends the new glucose readings, doses and carb entries to the dynamic library.
+"""
+import datetime
+
+import numpy as np
+
+import loop_to_python_api.helpers as helpers
+from loop_to_python_api.api import (
+    swift_lib,
+    _call,
+    _double_pointer,
+    _to_numpy_series,
+    _to_str,
+    _to_algorithm_result,
+    COLUMNAR_SCHEDULE_KINDS,
+    RECOMMENDATION_TYPES,
+)
+
+# Data older than this, relative to the latest glucose reading, no longer affects the algorithm output. It covers the
+# 10 hour maximum carb absorption time used for insulin counteraction effects, plus the insulin activity duration of
+# the doses that contribute to the oldest of those effects.
+DEFAULT_RETENTION = datetime.timedelta(hours=16, minutes=10)
+
+
+def _as_array(values, length=None):
+    array = np.ascontiguousarray(np.atleast_1d(values), dtype=np.float64)
+    if length is not None and len(array) == 1 and length != 1:
+        array = np.full(length, array[0])
+    return array
+
+
+class LoopSession:
+    """
+    Holds the history and settings for one user, and computes recommendations, insulin on board, carbs on board and
+    predictions for the latest glucose reading.
+
+    Settings are the same as for `helpers.get_json_loop_prediction_input_from_df`. Data older than `retention` before
+    the latest glucose reading is dropped after every append. A session must only be used by one thread at a time.
+    Release the native memory with `close()`, or use the session as a context manager.
+    """
+
+    def __init__(self, basal, isf, cr, insulin_type='novolog', max_basal=4.0, max_bolus=9,
+                 recommendation_type='automaticBolus', suspend_threshold=78, target_lower=101, target_upper=115,
+                 use_integral_retrospective_correction=False, include_positive_velocity_and_rc=True,
+                 retention=DEFAULT_RETENTION):
+        self._handle = None
+        helpers.validate_insulin_type(insulin_type)
+        helpers.validate_recommendation_type(recommendation_type)
+        self.basal = basal
+        self.isf = isf
+        self.cr = cr
+        self.insulin_type = insulin_type
+        self.max_basal = max_basal
+        self.max_bolus = max_bolus
+        self.recommendation_type = recommendation_type
+        self.suspend_threshold = suspend_threshold
+        self.target_lower = target_lower
+        self.target_upper = target_upper
+        self.use_integral_retrospective_correction = use_integral_retrospective_correction
+        self.include_positive_velocity_and_rc = include_positive_velocity_and_rc
+        self.retention = retention.total_seconds()
+
+        self._first_date = None
+        self._last_glucose_date = None
+        self._handle = swift_lib.createColumnarInput()
+        # Sets the insulin type used by the appended doses
+        empty = np.empty(0)
+        _call(swift_lib.setColumnarDoses, self._handle, _double_pointer(empty), _double_pointer(empty),
+              _double_pointer(empty), _double_pointer(empty), 0, insulin_type.encode('utf-8'))
+
+    def close(self):
+        if self._handle is not None:
+            swift_lib.freeColumnarInput(self._handle)
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _get_handle(self):
+        if self._handle is None:
+            raise ValueError("The session is closed.")
+        return self._handle
+
+    def _add_dates(self, seconds):
+        if len(seconds) == 0:
+            return
+        first = seconds.min()
+        self._first_date = first if self._first_date is None else min(self._first_date, first)
+
+    def _trim(self):
+        if self._last_glucose_date is None:
+            return
+        cutoff = self._last_glucose_date - self.retention
+        if self._first_date is not None and self._first_date < cutoff:
+            _call(swift_lib.trimColumnarInput, self._get_handle(), cutoff)
+            self._first_date = cutoff
+
+    def add_glucose(self, dates, values):
+        """
+        Append CGM readings (mg/dL).
+
+        :param dates: A datetime, or an array of datetimes.
+        :param values: A value, or an array of values with the same length as dates.
+        """
+        seconds = helpers.get_epoch_seconds(dates)
+        values = _as_array(values, len(seconds))
+        if len(values) != len(seconds):
+            raise ValueError("values must have the same length as dates.")
+        _call(swift_lib.appendColumnarGlucose, self._get_handle(), _double_pointer(seconds), _double_pointer(values),
+              len(seconds))
+        self._add_dates(seconds)
+        if len(seconds):
+            latest = seconds.max()
+            self._last_glucose_date = latest if self._last_glucose_date is None else max(self._last_glucose_date,
+                                                                                         latest)
+        self._trim()
+
+    def _add_doses(self, seconds, durations, volumes, dose_type):
+        durations = _as_array(durations, len(seconds))
+        volumes = _as_array(volumes, len(seconds))
+        if len(volumes) != len(seconds) or len(durations) != len(seconds):
+            raise ValueError("Doses must have the same length as dates.")
+        end_seconds = seconds + durations
+        types = np.full(len(seconds), float(dose_type))
+        _call(swift_lib.appendColumnarDoses, self._get_handle(), _double_pointer(seconds), _double_pointer(end_seconds),
+              _double_pointer(volumes), _double_pointer(types), len(seconds))
+        self._add_dates(seconds)
+        self._trim()
+
+    def add_bolus(self, dates, units):
+        """
+        Append boluses.
+
+        :param dates: A datetime, or an array of datetimes.
+        :param units: The delivered units, as a value or an array with the same length as dates.
+        """
+        seconds = helpers.get_epoch_seconds(dates)
+        self._add_doses(seconds, 5 * 60, units, 0)
+
+    def add_basal(self, dates, rates, duration=datetime.timedelta(minutes=5)):
+        """
+        Append basal deliveries.
+
+        :param dates: A datetime, or an array of datetimes, for the start of each delivery.
+        :param rates: The basal rates (U/hr), as a value or an array with the same length as dates.
+        :param duration: How long each rate was delivered. Defaults to 5 minutes.
+        """
+        seconds = helpers.get_epoch_seconds(dates)
+        duration = duration.total_seconds()
+        self._add_doses(seconds, duration, _as_array(rates, len(seconds)) * duration / 3600, 1)
+
+    def add_carbs(self, dates, grams, absorption_time=datetime.timedelta(hours=3)):
+        """
+        Append carb entries.
+
+        :param dates: A datetime, or an array of datetimes.
+        :param grams: The carbs (g), as a value or an array with the same length as dates.
+        :param absorption_time: The expected absorption time. Defaults to 3 hours.
+        """
+        seconds = helpers.get_epoch_seconds(dates)
+        grams = _as_array(grams, len(seconds))
+        if len(grams) != len(seconds):
+            raise ValueError("grams must have the same length as dates.")
+        absorption_times = np.full(len(seconds), absorption_time.total_seconds())
+        _call(swift_lib.appendColumnarCarbs, self._get_handle(), _double_pointer(seconds), _double_pointer(grams),
+              _double_pointer(absorption_times), len(seconds))
+        self._add_dates(seconds)
+        self._trim()
+
+    def _update_settings(self):
+        """
+        Set the prediction start to the latest glucose reading, and extend the settings schedules to cover the data.
+        """
+        if self._last_glucose_date is None:
+            raise ValueError("The session has no glucose readings.")
+        handle = self._get_handle()
+        start = np.array([self._first_date - helpers.SCHEDULE_MARGIN])
+        end = np.array([self._last_glucose_date + helpers.SCHEDULE_MARGIN])
+        for name, kind in COLUMNAR_SCHEDULE_KINDS.items():
+            value = np.array([float(getattr(self, name))])
+            _call(swift_lib.setColumnarSchedule, handle, kind, _double_pointer(start), _double_pointer(end),
+                  _double_pointer(value), 1)
+        lower = np.array([float(self.target_lower)])
+        upper = np.array([float(self.target_upper)])
+        _call(swift_lib.setColumnarTarget, handle, _double_pointer(start), _double_pointer(end), _double_pointer(lower),
+              _double_pointer(upper), 1)
+        _call(swift_lib.setColumnarSettings, handle, self._last_glucose_date, self.max_basal, self.max_bolus,
+              np.nan if self.suspend_threshold is None else self.suspend_threshold,
+              RECOMMENDATION_TYPES.index(self.recommendation_type), self.insulin_type.encode('utf-8'),
+              int(self.use_integral_retrospective_correction), int(self.include_positive_velocity_and_rc))
+        return handle
+
+    def get_loop_recommendations(self):
+        """
+        :return: A JSON string with the Loop recommendations at the latest glucose reading.
+        """
+        return _to_str(_call(swift_lib.getLoopRecommendationsColumnar, self._update_settings()))
+
+    def get_active_insulin(self):
+        """
+        :return: The insulin on board (U) at the latest glucose reading.
+        """
+        return _call(swift_lib.getActiveInsulinColumnar, self._update_settings())
+
+    def get_active_carbs(self):
+        """
+        :return: The carbs on board (g) at the latest glucose reading.
+        """
+        return _call(swift_lib.getActiveCarbsColumnar, self._update_settings())
+
+    def get_prediction(self):
+        """
+        :return: A tuple of numpy arrays with the predicted values (mg/dL) and the prediction dates (datetime64, UTC),
+        starting at the latest glucose reading.
+        """
+        values, dates = _to_numpy_series(_call(swift_lib.getPredictionValuesAndDatesColumnar, self._update_settings()))
+        return values, helpers.get_datetimes_from_epoch_seconds(dates)
+
+    def run_algorithm(self):
+        """
+        :return: An AlgorithmResult with all outputs at the latest glucose reading, from one algorithm run.
+        """
+        return _to_algorithm_result(_call(swift_lib.runAlgorithmColumnar, self._update_settings()))
@@ -1,24 +1,77 @@
+import asyncio
+import concurrent.futures
+import datetime
 import json
+import os
 import platform
+import subprocess
+import sys
+import threading
+import numpy as np
+import pandas as pd
 import pytest
 from loop_to_python_api.api import (
     initialize_exception_handlers,
     generate_prediction,
+    generate_predictions,
+    generate_prediction_async,
     get_prediction_dates,
     get_prediction_values_and_dates,
+    get_prediction,
     get_dose_recommendations,
     get_glucose_effect_velocity,
     get_glucose_effect_velocity_dates,
     get_glucose_effect_velocity_and_dates,
+    get_insulin_counteraction_effects,
     get_active_carbs,
     get_active_insulin,
+    get_active_insulin_batch,
     get_loop_recommendations,
     percent_absorption_at_percent_time,
     piecewise_linear_percent_rate_at_percent_time,
     linear_percent_rate_at_percent_time,
     get_dynamic_carbs_on_board,
+    get_dynamic_carbs_on_board_series,
     insulin_percent_effect_remaining,
+    percent_absorption_at_percent_time_array,
+    piecewise_linear_percent_rate_at_percent_time_array,
+    linear_percent_rate_at_percent_time_array,
+    insulin_percent_effect_remaining_array,
+    insulin_on_board_array,
+    insulin_effect_array,
+    add_insulin_counteraction_effect_to_df,
+    add_insulin_on_board_to_df,
+    add_iob_and_ice,
+    generate_prediction_columnar,
+    get_active_insulin_columnar,
+    get_loop_recommendations_columnar,
+    profile,
+    sweep_settings,
+    run_algorithm,
+    run_algorithm_columnar,
+    enable_cache,
+    disable_cache,
+    get_cache_stats,
 )
+from loop_to_python_api.exceptions import DecodingError, InvalidInputError, LoopAlgorithmError, WorkerCrashError
+from loop_to_python_api.session import LoopSession
+from loop_to_python_api.serve import Client, PredictionServer
+from loop_to_python_api.replay import RECOMMENDATION_COLUMNS, STEP_OK, get_retrospective_recommendations, replay
+from loop_to_python_api.pipeline import carbs_on_board, compute_chunks, run_pipeline
+from loop_to_python_api.helpers import (
+    get_columnar_input_from_json,
+    get_columnar_loop_prediction_input_from_df,
+    get_epoch_seconds,
+    get_json_loop_prediction_input_from_df,
+    get_schedule,
+    get_settings_grid,
+    with_columns,
+)
+
+# Marks the tests that call the dynamic library. The committed Windows library is built by hand and predates the
+# current interface, so loading it fails with a clear error. See "Windows CI Build Limitation" in the README.
+requires_native = pytest.mark.skipif(platform.system() == "Windows",
+                                     reason="The committed Windows library is out of date and must be rebuilt locally")
 
 
 def get_generate_prediction_input():
@@ -36,23 +89,76 @@ def get_dynamic_carbs_input():
         return json.load(f)
 
 
+def get_mock_df(n_rows=200):
+    index = pd.date_range(start="2024-02-28 00:00", periods=n_rows, freq="5min")
+    return pd.DataFrame({
+        "bolus": [10] + [0.0] * (n_rows - 1),
+        "basal": [1] * n_rows,
+        "CGM": 100 + 20 * np.sin(np.arange(n_rows) / 10),
+    }, index=index)
+
+
+# Measured at about 0.1 s, almost all of it numpy. Loading pandas and the Swift runtime at import time took several
+# times longer.
+IMPORT_TIME_BUDGET = 0.3
+
+
+def test_import_is_lazy_and_within_budget():
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import loop_to_python_api.api as api\n"
+        "elapsed = time.perf_counter() - start\n"
+        "assert 'pandas' not in sys.modules\n"
+        "assert not api.swift_lib.loaded\n"
+        "print(elapsed)\n"
+    )
+    # The fastest of a few runs, so that a busy machine does not fail the test
+    times = [float(subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout)
+             for _ in range(3)]
+    assert min(times) < IMPORT_TIME_BUDGET
+
+
+@requires_native
+def test_first_call_loads_library():
+    # The library is loaded and the prototype declared on the first call
+    assert percent_absorption_at_percent_time(0.5) == pytest.approx(percent_absorption_at_percent_time_array(0.5))
+
+
+def test_out_of_date_library_is_refused():
+    from loop_to_python_api import api
+
+    class OldLibrary:
+        pass
+
+    with pytest.raises(OSError, match="out of date"):
+        api._check_abi_version(OldLibrary(), 'libLoopAlgorithmToPython.dll')
+    # A function missing from the library only fails when it is used
+    with pytest.raises(OSError, match="does not export runReplay"):
+        api._declare_prototype(OldLibrary(), 'runReplay')
+
+
+@requires_native
 def test_initialize_exception_handlers():
     result = initialize_exception_handlers()
     assert result is None
 
 
+@requires_native
 def test_generate_prediction():
     prediction_input = get_generate_prediction_input()
     prediction_values = generate_prediction(prediction_input)
     assert isinstance(prediction_values, list)
 
 
+@requires_native
 def test_get_prediction_dates():
     prediction_input = get_generate_prediction_input()
     prediction_dates = get_prediction_dates(prediction_input)
     assert isinstance(prediction_dates, list)
 
 
+@requires_native
 def test_get_prediction_values_and_dates():
     prediction_input = get_generate_prediction_input()
     values, dates = get_prediction_values_and_dates(prediction_input)
@@ -64,6 +170,23 @@ def test_get_prediction_values_and_dates():
     assert all(isinstance(date, str) for date in dates), "All prediction dates should be strings."
 
 
+@requires_native
+def test_generate_prediction_does_not_read_past_native_buffer():
+    prediction_input = get_generate_prediction_input()
+    prediction_values = generate_prediction(prediction_input, len=10000)
+    assert len(prediction_values) == len(get_prediction_dates(prediction_input))
+
+
+@requires_native
+def test_get_prediction():
+    prediction_input = get_generate_prediction_input()
+    values, dates = get_prediction(prediction_input)
+    assert len(values) == len(dates)
+    assert values.tolist() == pytest.approx(generate_prediction(prediction_input, len=len(values)))
+    assert str(dates.dtype) == 'datetime64[ns]'
+
+
+@requires_native
 @pytest.mark.skipif(platform.system() == "Windows", reason="Windows compatibility issue - test disabled for Windows builds")
 def test_get_dose_recommendations():
     loop_algorithm_input = get_loop_algorithm_input()
@@ -71,18 +194,21 @@ def test_get_dose_recommendations():
     assert isinstance(dose_recommendations, dict)
 
 
+@requires_native
 def test_get_glucose_effect_velocity():
     prediction_input = get_generate_prediction_input()
     glucose_effect_velocity = get_glucose_effect_velocity(prediction_input)
     assert isinstance(glucose_effect_velocity, list)
 
 
+@requires_native
 def test_get_glucose_effect_velocity_dates():
     prediction_input = get_generate_prediction_input()
     glucose_effect_velocity_dates = get_glucose_effect_velocity_dates(prediction_input)
     assert isinstance(glucose_effect_velocity_dates, list)
 
 
+@requires_native
 @pytest.mark.skipif(platform.system() == "Windows", reason="Windows compatibility issue - test disabled for Windows builds")
 def test_get_glucose_effect_velocity_values_and_dates():
     loop_algorithm_input = get_loop_algorithm_input()
@@ -94,33 +220,698 @@ def test_get_glucose_effect_velocity_values_and_dates():
     assert all(isinstance(value, (int, float)) for value in values), "All prediction values should be integers or floats."
 
 
+@requires_native
+def test_get_insulin_counteraction_effects():
+    loop_algorithm_input = get_loop_algorithm_input()
+    values, dates = get_insulin_counteraction_effects(loop_algorithm_input)
+    assert len(values) == len(dates)
+    assert 0 < len(values) < len(loop_algorithm_input['glucoseHistory'])
+
+    # Without copy, the values use the native buffer, which stays valid for as long as the array is referenced
+    zero_copy_values, zero_copy_dates = get_insulin_counteraction_effects(loop_algorithm_input, copy=False)
+    view = zero_copy_values[1:]
+    del zero_copy_values
+    np.testing.assert_array_equal(view, values[1:])
+    np.testing.assert_array_equal(zero_copy_dates, dates)
+
+    # The values match the ICE of a full algorithm run, over the dates both return. The dates of the full run are
+    # formatted with whole seconds.
+    velocity, velocity_dates = get_glucose_effect_velocity_and_dates(loop_algorithm_input)
+    _, positions, velocity_positions = np.intersect1d(np.floor(get_epoch_seconds(dates)),
+                                                      get_epoch_seconds(velocity_dates), return_indices=True)
+    assert len(positions) > 0
+    np.testing.assert_allclose(values[positions], np.asarray(velocity)[velocity_positions], rtol=1e-9)
+
+
+@requires_native
+def test_add_insulin_counteraction_effect_to_unsorted_df():
+    df = get_mock_df()
+    shuffled = df.sample(frac=1, random_state=0)
+    expected = add_insulin_counteraction_effect_to_df(df.copy(), 1, 45, 12)
+    result = add_insulin_counteraction_effect_to_df(shuffled.copy(), 1, 45, 12)
+    # The results are written by position, in the original row order
+    assert (result.index == shuffled.index).all()
+    pd.testing.assert_series_equal(result['ice'].sort_index(), expected['ice'])
+
+
+def test_with_columns():
+    df = get_mock_df()
+    iob = np.arange(len(df), dtype=np.float64)
+    result = with_columns(df, {'iob': iob, 'CGM': iob * 2})
+    assert 'iob' not in df.columns
+    np.testing.assert_array_equal(result['iob'], iob)
+    np.testing.assert_array_equal(result['CGM'], iob * 2)
+    with pytest.raises(ValueError):
+        with_columns(df, {'iob': iob[1:]})
+
+    pyarrow = pytest.importorskip('pyarrow')
+    table = with_columns(pyarrow.Table.from_pandas(df), {'iob': iob, 'CGM': iob * 2})
+    assert table.column_names[-1] == 'iob'
+    np.testing.assert_array_equal(table['CGM'].to_numpy(), iob * 2)
+
+
+@requires_native
+def test_add_insulin_counteraction_effect_to_df():
+    df = add_insulin_counteraction_effect_to_df(get_mock_df(), 1, 45, 12, overlap=72)
+    assert df['ice'].iloc[:72].isna().all()
+    assert df['ice'].iloc[72:-1].notna().all()
+
+    # The values match the ICE of a full algorithm run on the same data, over the dates both return
+    json_data = get_json_loop_prediction_input_from_df(get_mock_df(), 1, 45, 12, df.index[-1])
+    velocity, velocity_dates = get_glucose_effect_velocity_and_dates(json_data)
+    ice = df['ice'].dropna()
+    _, positions, velocity_positions = np.intersect1d(get_epoch_seconds(ice.index), get_epoch_seconds(velocity_dates),
+                                                      return_indices=True)
+    assert len(positions) > 0
+    np.testing.assert_allclose(ice.to_numpy()[positions], np.asarray(velocity)[velocity_positions], rtol=1e-9)
+
+    with pytest.warns(DeprecationWarning, match="batch_size"):
+        add_insulin_counteraction_effect_to_df(get_mock_df(), 1, 45, 12, batch_size=300)
+
+
+@requires_native
 def test_get_active_carbs():
     loop_algorithm_input = get_loop_algorithm_input()
     active_carbs = get_active_carbs(loop_algorithm_input)
     assert isinstance(active_carbs, float)
 
 
+@requires_native
 def test_get_active_insulin():
     loop_algorithm_input = get_loop_algorithm_input()
     active_insulin = get_active_insulin(loop_algorithm_input)
     assert isinstance(active_insulin, float)
 
 
+@requires_native
+def test_get_active_insulin_batch():
+    loop_algorithm_input = get_loop_algorithm_input()
+    prediction_start = loop_algorithm_input['predictionStart']
+    active_insulin = get_active_insulin_batch(loop_algorithm_input, [prediction_start, prediction_start])
+    assert active_insulin.shape == (2,)
+    assert active_insulin[0] == pytest.approx(get_active_insulin(loop_algorithm_input))
+
+
+@requires_native
+def test_generate_prediction_columnar():
+    prediction_input = get_generate_prediction_input()
+    prediction_values = generate_prediction_columnar(get_columnar_input_from_json(prediction_input))
+    assert prediction_values == pytest.approx(generate_prediction(prediction_input))
+
+
+@requires_native
+def test_get_active_insulin_columnar():
+    loop_algorithm_input = get_loop_algorithm_input()
+    active_insulin = get_active_insulin_columnar(get_columnar_input_from_json(loop_algorithm_input))
+    assert active_insulin == pytest.approx(get_active_insulin(loop_algorithm_input))
+
+
+@requires_native
+def test_get_loop_recommendations_columnar():
+    loop_algorithm_input = get_loop_algorithm_input()
+    loop_recommendations = get_loop_recommendations_columnar(get_columnar_input_from_json(loop_algorithm_input))
+    assert isinstance(loop_recommendations, str)
+
+
+@requires_native
+def test_run_algorithm():
+    loop_algorithm_input = get_loop_algorithm_input()
+    result = run_algorithm(loop_algorithm_input)
+
+    assert result.active_insulin == pytest.approx(get_active_insulin(loop_algorithm_input))
+    assert result.active_carbs == pytest.approx(get_active_carbs(loop_algorithm_input))
+    assert result.recommendation == json.loads(get_loop_recommendations(loop_algorithm_input))
+    assert result.recommendation_error is None
+
+    ice_values, ice_dates = get_glucose_effect_velocity_and_dates(loop_algorithm_input)
+    assert result.ice_values == pytest.approx(ice_values)
+    assert len(result.ice_dates) == len(ice_dates)
+    assert len(result.prediction_values) == len(result.prediction_dates) > 0
+    assert (np.diff(result.prediction_dates) > np.timedelta64(0)).all()
+
+    columnar_result = run_algorithm_columnar(get_columnar_input_from_json(loop_algorithm_input))
+    assert columnar_result.prediction_values == pytest.approx(result.prediction_values)
+    assert columnar_result.recommendation == result.recommendation
+
+
+@requires_native
+def test_sweep_settings():
+    loop_algorithm_input = get_loop_algorithm_input()
+    isf = loop_algorithm_input['sensitivity'][0]['value']
+    # NaN keeps the schedule of the input, so the first rows match a plain run
+    grid = get_settings_grid(isf=[np.nan, isf * 2], basal=[np.nan, 0.5])
+    result = sweep_settings(loop_algorithm_input, grid)
+    single = run_algorithm(loop_algorithm_input)
+
+    assert result.prediction_values.shape[0] == 4
+    assert result.prediction_values[0, :len(single.prediction_values)] == pytest.approx(single.prediction_values)
+    assert result.active_insulin[0] == pytest.approx(single.active_insulin)
+    assert result.recommendations[0] == single.recommendation
+    # The insulin sensitivity changes the prediction but not the insulin on board
+    assert result.active_insulin[2] == pytest.approx(result.active_insulin[0])
+    assert not np.allclose(result.prediction_values[2], result.prediction_values[0], equal_nan=True)
+    assert result.active_insulin[1] != pytest.approx(result.active_insulin[0])
+
+    threaded = sweep_settings(json.dumps(loop_algorithm_input).encode('utf-8'), grid, threads=4)
+    np.testing.assert_allclose(threaded.prediction_values, result.prediction_values)
+    assert threaded.recommendations == result.recommendations
+
+    with pytest.raises(InvalidInputError):
+        sweep_settings(loop_algorithm_input, {'target_lower': [120], 'target_upper': [100]})
+
+
+@requires_native
+def test_result_cache(tmp_path):
+    prediction_input = get_generate_prediction_input()
+    loop_algorithm_input = get_loop_algorithm_input()
+    expected_prediction = generate_prediction(prediction_input)
+    expected_recommendations = get_loop_recommendations(loop_algorithm_input)
+    try:
+        enable_cache(max_size=16, path=str(tmp_path / 'cache.sqlite'))
+        assert generate_prediction(prediction_input) == pytest.approx(expected_prediction)
+        # Key order and passing the input as bytes do not change the key
+        reordered = dict(reversed(list(prediction_input.items())))
+        assert generate_prediction(json.dumps(reordered).encode('utf-8'), len=72) == expected_prediction
+        assert get_loop_recommendations(loop_algorithm_input) == expected_recommendations
+        assert get_loop_recommendations(loop_algorithm_input) == expected_recommendations
+        assert get_active_insulin(loop_algorithm_input) == get_active_insulin(loop_algorithm_input)
+        stats = get_cache_stats()
+        assert (stats.hits, stats.misses) == (3, 3)
+
+        # A new cache with the same file finds the results on disk
+        enable_cache(max_size=16, path=str(tmp_path / 'cache.sqlite'))
+        assert generate_prediction(prediction_input) == expected_prediction
+        assert get_cache_stats().disk_hits == 1
+    finally:
+        disable_cache()
+    assert get_cache_stats() is None
+
+
+def test_result_cache_is_cleared_for_another_library(tmp_path):
+    from loop_to_python_api.cache import ResultCache
+
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ResultCache(path=path, version='a')
+    cache.set('key', '1.0')
+    cache.close()
+    cache = ResultCache(path=path, version='a')
+    assert cache.get('key') == '1.0'
+    cache.close()
+    # Results computed by another build of the library are discarded
+    cache = ResultCache(path=path, version='b')
+    assert cache.get('key') is None
+    cache.close()
+
+
+@requires_native
+def test_profile():
+    prediction_input = get_generate_prediction_input()
+    stages = []
+    with profile(callback=lambda stage, seconds: stages.append(stage)) as profiler:
+        generate_prediction(prediction_input)
+        get_loop_recommendations(get_loop_algorithm_input())
+    stats = profiler.stats()
+
+    assert stats['serialize'].calls == 2
+    assert stats['native_call'].calls == 2
+    assert stats['parse_output'].calls == 2
+    assert stats['export'].calls == 2
+    for stage in ['decode', 'algorithm', 'output']:
+        assert stats[stage].calls >= 2
+        assert sum(stats[stage].histogram) == stats[stage].calls
+        assert 0 < stats[stage].total_seconds <= stats['export'].total_seconds
+    assert stages.count('native_call') == 2
+    assert 'native_call' in profiler.report()
+
+    # Nothing is recorded once profiling is disabled
+    generate_prediction(prediction_input)
+    assert profiler.stats()['export'].calls == 2
+
+
+@requires_native
+def test_generate_predictions_in_threads():
+    prediction_input = get_generate_prediction_input()
+    expected = generate_prediction(prediction_input)
+
+    predictions = generate_predictions([prediction_input] * 16, workers=8)
+    assert len(predictions) == 16
+    for prediction in predictions:
+        assert prediction == pytest.approx(expected)
+
+    # Different functions can also run at the same time in one process
+    loop_algorithm_input = get_loop_algorithm_input()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        active_insulin = [executor.submit(get_active_insulin, loop_algorithm_input) for _ in range(8)]
+        recommendations = [executor.submit(get_loop_recommendations, loop_algorithm_input) for _ in range(8)]
+        assert len({future.result() for future in active_insulin}) == 1
+        assert len({future.result() for future in recommendations}) == 1
+
+
+@requires_native
+def test_generate_prediction_async():
+    prediction_input = get_generate_prediction_input()
+
+    async def run():
+        return await asyncio.gather(*[generate_prediction_async(prediction_input) for _ in range(4)])
+
+    predictions = asyncio.run(run())
+    for prediction in predictions:
+        assert prediction == pytest.approx(generate_prediction(prediction_input))
+
+
+@requires_native
+def test_invalid_json_raises_decoding_error():
+    prediction_input = get_generate_prediction_input()
+    del prediction_input['glucoseHistory']
+    with pytest.raises(DecodingError):
+        generate_prediction(prediction_input)
+    # The library is still usable after an error
+    assert len(generate_prediction(get_generate_prediction_input())) > 0
+
+
+@requires_native
+def test_empty_glucose_history_raises_invalid_input_error():
+    prediction_input = get_generate_prediction_input()
+    prediction_input['glucoseHistory'] = []
+    with pytest.raises(InvalidInputError):
+        generate_prediction(prediction_input)
+
+    columns = get_columnar_input_from_json(prediction_input)
+    with pytest.raises(LoopAlgorithmError) as error:
+        generate_prediction_columnar(columns)
+    assert error.value.code == 1
+    assert 'glucose history' in error.value.message
+
+
+def test_get_json_loop_prediction_input_from_df():
+    df = get_mock_df().assign(carbs=np.nan)
+    df.loc[df.index[5], 'carbs'] = 30
+    # Reversed, so the helper has to sort, which must not change the caller's DataFrame
+    df = df.iloc[::-1]
+    original = df.copy()
+
+    json_data = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[0])
+    assert df.equals(original)
+    assert [dose['type'] for dose in json_data['doses'][:2]] == ['bolus', 'basal']
+    assert json_data['doses'][0]['startDate'] == '2024-02-28T00:00:00Z'
+    assert json_data['doses'][0]['endDate'] == '2024-02-28T00:05:00Z'
+    assert json_data['doses'][1]['volume'] == pytest.approx(1 / 12)
+    assert json_data['carbEntries'] == [{'date': '2024-02-28T00:25:00Z', 'grams': 30.0, 'absorptionTime': 10800}]
+    assert [entry['date'] for entry in json_data['glucoseHistory']] == sorted(
+        entry['date'] for entry in json_data['glucoseHistory'])
+
+    json_bytes = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[0], as_bytes=True)
+    assert json.loads(json_bytes) == json_data
+
+
+@requires_native
+def test_generate_prediction_from_json_bytes():
+    df = get_mock_df()
+    json_data = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+    json_bytes = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1], as_bytes=True)
+    assert generate_prediction(json_bytes) == pytest.approx(generate_prediction(json_data))
+
+
+@requires_native
+def test_loop_session():
+    df = get_mock_df(100).assign(carbs=np.nan)
+    df.loc[df.index[50], 'carbs'] = 40
+    json_data = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+
+    with LoopSession(1, 45, 12, retention=datetime.timedelta(days=2)) as session:
+        # The history arrives in two chunks, like consecutive loop cycles
+        for chunk in [df.iloc[:60], df.iloc[60:]]:
+            session.add_glucose(chunk.index, chunk['CGM'].to_numpy())
+            boluses = chunk[chunk['bolus'] > 0]
+            session.add_bolus(boluses.index, boluses['bolus'].to_numpy())
+            session.add_basal(chunk.index, chunk['basal'].to_numpy())
+            carbs = chunk[chunk['carbs'] > 0]
+            session.add_carbs(carbs.index, carbs['carbs'].to_numpy())
+
+        assert session.get_active_insulin() == pytest.approx(get_active_insulin(json_data))
+        assert session.get_active_carbs() == pytest.approx(get_active_carbs(json_data))
+        values, dates = session.get_prediction()
+        assert values[:72] == pytest.approx(generate_prediction(json_data))
+        assert dates[0] == np.datetime64(df.index[-1])
+        assert isinstance(session.get_loop_recommendations(), str)
+        assert session.run_algorithm().active_insulin == pytest.approx(session.get_active_insulin())
+
+    with pytest.raises(ValueError):
+        session.get_active_insulin()
+
+
+@requires_native
+def test_loop_session_trims_old_data():
+    df = get_mock_df(400)
+    with LoopSession(1, 45, 12, retention=datetime.timedelta(hours=6)) as session:
+        session.add_glucose(df.index, df['CGM'].to_numpy())
+        session.add_basal(df.index, df['basal'].to_numpy())
+        # The bolus at the first row is older than the retention, so it was dropped
+        session.add_bolus(df.index[:1], 10)
+        assert session.get_active_insulin() == pytest.approx(0, abs=1e-6)
+        session.add_glucose(df.index[-1] + datetime.timedelta(minutes=5), 120)
+        session.add_bolus(df.index[-1], 2)
+        assert session.get_active_insulin() > 1
+
+
+@requires_native
+def test_replay():
+    df = get_mock_df(100).assign(carbs=np.nan)
+    df.loc[df.index[50], 'carbs'] = 40
+    columns = get_columnar_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+    json_data = get_json_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+
+    result = replay(columns, horizons=[30, 60], retention=datetime.timedelta(days=2))
+    assert len(result.dates) == len(df)
+    assert result.predictions.shape == (len(df), 2)
+    assert (result.status == STEP_OK).all()
+    # The last step sees the whole history, like a single call at the last date
+    assert result.active_insulin[-1] == pytest.approx(get_active_insulin(json_data))
+    assert result.active_carbs[-1] == pytest.approx(get_active_carbs(json_data))
+    assert result.dates[-1] == np.datetime64(df.index[-1])
+
+    # The first step is computed before any recommended dose is delivered
+    applied = replay(columns, step_dates=df.index[40:], horizons=[30, 60], apply_recommendations=True,
+                     retention=datetime.timedelta(days=2))
+    assert len(applied.dates) == len(df) - 40
+    assert applied.active_insulin[0] == pytest.approx(result.active_insulin[40], abs=0.01)
+
+
+@requires_native
+def test_replay_delivers_scheduled_basal_after_temp_basal_ends():
+    df = get_mock_df(100)
+    columns = get_columnar_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+    # The steps are an hour apart, longer than the temp basals
+    applied = replay(columns, step_dates=df.index[[40, 52]], horizons=[], apply_recommendations=True,
+                     retention=datetime.timedelta(days=2))
+    duration = applied.temp_basal_duration[0]
+    assert 0 < duration < 60
+
+    # The temp basal rate is delivered until it ends, and the scheduled basal of 1 U/hr until the second step
+    delivered = df.iloc[:52].copy()
+    temp_basal_rows = int(duration // 5)
+    delivered.iloc[40:40 + temp_basal_rows, delivered.columns.get_loc('basal')] = applied.temp_basal_rate[0]
+    delivered.iloc[40, delivered.columns.get_loc('bolus')] += np.nan_to_num(applied.automatic_bolus[0])
+    json_data = get_json_loop_prediction_input_from_df(delivered, 1, 45, 12, df.index[52])
+    assert applied.active_insulin[1] == pytest.approx(get_active_insulin(json_data), abs=0.01)
+
+
+@requires_native
+def test_get_retrospective_recommendations():
+    df = get_mock_df(100)
+    columns = get_columnar_loop_prediction_input_from_df(df, 1, 45, 12, df.index[-1])
+    # The dates do not have to be in order
+    dates = df.index[[90, 60, 99]]
+    result = get_retrospective_recommendations(columns, dates)
+    assert list(result.columns) == list(RECOMMENDATION_COLUMNS)
+    assert (result.index == dates).all()
+
+    for date, row in result.iterrows():
+        json_data = get_json_loop_prediction_input_from_df(df.loc[:date], 1, 45, 12, date)
+        automatic = json.loads(get_loop_recommendations(json_data)).get('automatic') or {}
+        temp_basal = automatic.get('basalAdjustment') or {}
+        assert row['automatic_bolus'] == pytest.approx(automatic.get('bolusUnits', np.nan), nan_ok=True)
+        assert row['temp_basal_rate'] == pytest.approx(temp_basal.get('unitsPerHour', np.nan), nan_ok=True)
+        assert row['status'] == STEP_OK
+
+    arrays = get_retrospective_recommendations(columns, dates, as_dataframe=False)
+    np.testing.assert_array_equal(arrays['temp_basal_rate'], result['temp_basal_rate'].to_numpy())
+
+
+@requires_native
+def test_serve():
+    loop_algorithm_input = get_loop_algorithm_input()
+    server = PredictionServer(port=0, workers=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with Client(port=server.address[1]) as client:
+            assert client.call('get_active_insulin', loop_algorithm_input) == pytest.approx(
+                get_active_insulin(loop_algorithm_input))
+            # Bytes inputs are sent as they are
+            json_bytes = json.dumps(loop_algorithm_input).encode('utf-8')
+            assert client.call('generate_prediction', json_bytes, len=10) == pytest.approx(
+                generate_prediction(loop_algorithm_input, len=10))
+
+            results = client.batch([('get_active_carbs', loop_algorithm_input), ('get_active_carbs', {}),
+                                    ('unknown_function',)])
+            assert results[0] == pytest.approx(get_active_carbs(loop_algorithm_input))
+            assert isinstance(results[1], LoopAlgorithmError)
+            assert isinstance(results[2], ValueError)
+            with pytest.raises(DecodingError):
+                client.call('get_active_insulin', {'doses': 'not a list'})
+
+            # A worker that exits is replaced, and the next requests are served by the new workers
+            with pytest.raises(WorkerCrashError):
+                server.pool.run(os._exit, [1])
+            assert client.call('get_active_insulin', loop_algorithm_input) == pytest.approx(
+                get_active_insulin(loop_algorithm_input))
+
+            metrics = client.metrics()
+            assert metrics['worker_restarts'] == 1
+            assert metrics['functions']['get_active_insulin']['calls'] == 2
+            assert metrics['functions']['batch']['errors'] == 2
+    finally:
+        server.shutdown()
+        thread.join()
+        server.close()
+
+
+def test_serve_rejects_requests_that_are_not_objects():
+    server = PredictionServer(port=0, workers=1)
+    try:
+        for path, body in [('/call/get_active_insulin', b'[1, 2]'), ('/batch', b'"calls"'),
+                           ('/batch', b'{"calls": [["get_active_carbs"]]}'), ('/batch', b'{"calls": {}}')]:
+            status, response = server.handle(path, body)
+            assert status == 400
+            assert response['error']['type'] == 'DecodingError'
+    finally:
+        server.close()
+
+
+def test_add_insulin_on_board_to_df():
+    df = add_insulin_on_board_to_df(get_mock_df(), 1, 45, 12)
+    assert np.isnan(df['iob'].iloc[0])
+    # The only insulin above the scheduled basal is the first bolus, so insulin on board should decrease
+    assert df['iob'].iloc[1] == pytest.approx(10, abs=0.5)
+    assert (np.diff(df['iob'].iloc[1:].to_numpy()) <= 1e-9).all()
+
+
+def get_kernel_df():
+    df = get_mock_df(200)
+    df.loc[df.index[100], 'bolus'] = 3
+    df.loc[df.index[120:130], 'basal'] = 0
+    df.loc[df.index[140], 'basal'] = np.nan
+    df['scheduled_basal'] = np.where(np.arange(len(df)) < 60, 1.0, 0.8)
+    return df
+
+
+@requires_native
+def test_insulin_kernel():
+    df = get_kernel_df()
+    for insulin_type, basal in [('novolog', 1), ('fiasp', 'scheduled_basal'), ('afrezza', 1)]:
+        kernel = add_insulin_on_board_to_df(df.copy(), basal, 45, 12, insulin_type=insulin_type, method='kernel')
+        native = add_insulin_on_board_to_df(df.copy(), basal, 45, 12, insulin_type=insulin_type, method='native')
+        np.testing.assert_allclose(kernel['iob'], native['iob'], rtol=1e-9, atol=1e-9)
+
+    # Timezone-aware dates are used in UTC on the native path too
+    local = df.tz_localize('UTC').tz_convert('Europe/Oslo')
+    kernel = add_insulin_on_board_to_df(df.copy(), 1, 45, 12, method='kernel')
+    native = add_insulin_on_board_to_df(local.copy(), 1, 45, 12, method='native')
+    np.testing.assert_allclose(native['iob'].to_numpy(), kernel['iob'].to_numpy(), rtol=1e-9, atol=1e-9)
+
+    # "auto" falls back to the dynamic library without a regular grid
+    irregular = df.drop(df.index[10])
+    np.testing.assert_allclose(add_insulin_on_board_to_df(irregular.copy(), 1, 45, 12)['iob'],
+                               add_insulin_on_board_to_df(irregular.copy(), 1, 45, 12, method='native')['iob'])
+
+
+def test_insulin_kernel_dates():
+    df = get_kernel_df()
+    # Timezone-aware dates are used in UTC, like the insulin counteraction effects, so a frame that crosses a
+    # daylight saving time change gives the same values as the same frame in UTC
+    utc = df.set_axis(pd.date_range('2024-03-30 20:00', periods=len(df), freq='5min'))
+    local = utc.tz_localize('UTC').tz_convert('Europe/Oslo')
+    assert local.index[0].utcoffset() != local.index[-1].utcoffset()
+    expected = add_insulin_on_board_to_df(utc.copy(), 1, 45, 12, method='kernel')['iob'].to_numpy()
+    kernel = add_insulin_on_board_to_df(local.copy(), 1, 45, 12, method='kernel')
+    np.testing.assert_array_equal(kernel['iob'].to_numpy(), expected)
+    assert (kernel.index == local.index).all()
+
+    # The kernel needs a regular grid
+    with pytest.raises(ValueError):
+        add_insulin_on_board_to_df(df.drop(df.index[10]), 1, 45, 12, method='kernel')
+
+    # Everything that is not on board anymore has acted on glucose
+    net_doses = np.zeros(150)
+    net_doses[[0, 40]] = [2, -0.5]
+    effect = insulin_effect_array(net_doses, 45)
+    assert effect[1:] == pytest.approx(-45 * (np.cumsum(net_doses)[:-1] - insulin_on_board_array(net_doses)[1:]))
+    assert effect[-1] == pytest.approx(-45 * 1.5)
+
+
+def test_setting_columns():
+    df = get_mock_df()
+    df['scheduled_basal'] = np.where(np.arange(len(df)) < 6, 1.0, 1.5)
+    df.loc[df.index[8], 'scheduled_basal'] = np.nan
+
+    schedule = get_schedule(df['scheduled_basal'], df.index)
+    assert schedule.values.tolist() == [1.0, 1.5]
+    assert schedule.end_dates[0] == schedule.start_dates[1] == get_epoch_seconds(df.index[6])[0]
+
+    # A Schedule sliced to a window gives the same input as encoding the window's column
+    window = df.iloc[4:10]
+    assert (get_json_loop_prediction_input_from_df(window, schedule, 45, 12, window.index[-1]) ==
+            get_json_loop_prediction_input_from_df(window, 'scheduled_basal', 45, 12, window.index[-1]))
+    json_data = get_json_loop_prediction_input_from_df(df, 'scheduled_basal', 45, 12, df.index[-1])
+    assert [entry['value'] for entry in json_data['basal']] == [1.0, 1.5]
+
+    # A constant column gives the same results as the constant setting
+    constant = df.assign(scheduled_basal=1.0, scheduled_isf=45.0)
+    expected = add_insulin_on_board_to_df(get_mock_df(), 1, 45, 12)
+    result = add_insulin_on_board_to_df(constant, 'scheduled_basal', 'scheduled_isf', 12)
+    assert result['iob'].to_numpy() == pytest.approx(expected['iob'].to_numpy(), nan_ok=True)
+
+    # Insulin above the later, higher scheduled basal rate counts less
+    varying = add_insulin_on_board_to_df(df.copy(), 'scheduled_basal', 45, 12)
+    assert varying['iob'].iloc[-1] < expected['iob'].iloc[-1]
+
+
+@requires_native
+def test_add_iob_and_ice():
+    df = pd.concat([get_mock_df().assign(subject_id=subject) for subject in ['a', 'b', 'c']])
+    settings = {'basal': 1, 'isf': 45, 'cr': 12, 'insulin_type': 'novolog'}
+    settings_by_subject = {'a': settings, 'b': settings, 'c': dict(settings, insulin_type='invalid')}
+
+    with pytest.warns(UserWarning):
+        result = add_iob_and_ice(df, by='subject_id', settings=settings_by_subject, workers=2)
+
+    expected = add_insulin_on_board_to_df(get_mock_df(), 1, 45, 12)
+    assert list(result.attrs['failed_subjects']) == ['c']
+    assert result[result['subject_id'] == 'a']['iob'].to_numpy() == pytest.approx(expected['iob'].to_numpy(),
+                                                                                   nan_ok=True)
+    assert result[result['subject_id'] == 'c']['iob'].isna().all()
+
+
+class _ExitWorker:
+    # Unpickling this in a worker process exits the worker, like a fatalError in the dynamic library
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+@requires_native
+def test_add_iob_and_ice_with_worker_crash():
+    subjects = ['a', 'b', 'c', 'd', 'e']
+    df = pd.concat([get_mock_df().assign(subject_id=subject) for subject in subjects])
+    settings = {'basal': 1, 'isf': 45, 'cr': 12}
+    settings_by_subject = {subject: settings for subject in subjects}
+    settings_by_subject['b'] = dict(settings, exit=_ExitWorker())
+
+    with pytest.warns(UserWarning):
+        result = add_iob_and_ice(df, by='subject_id', settings=settings_by_subject, workers=2)
+
+    # Only the subject that was running in the worker that exited fails
+    assert list(result.attrs['failed_subjects']) == ['b']
+    assert 'WorkerCrashError' in result.attrs['failed_subjects']['b']
+    expected = add_insulin_on_board_to_df(get_mock_df(), 1, 45, 12)
+    for subject in ['a', 'c', 'd', 'e']:
+        assert result[result['subject_id'] == subject]['iob'].to_numpy() == pytest.approx(expected['iob'].to_numpy(),
+                                                                                           nan_ok=True)
+
+
+def test_carbs_on_board():
+    dates = np.arange(48) * 300.0
+    carbs = np.full(48, np.nan)
+    carbs[2] = 30
+    cob = carbs_on_board(dates, carbs)
+    assert (cob[:2] == 0).all()
+    # Nothing is absorbed during the 10 minute delay, and everything after the 3 hour absorption time
+    assert cob[2:5] == pytest.approx(30)
+    assert (np.diff(cob[4:]) <= 0).all()
+    assert cob[-1] == 0
+
+
+@requires_native
+def test_run_pipeline(tmp_path):
+    df = pd.concat([get_mock_df().assign(subject_id=subject) for subject in ['a', 'b']])
+    df['carbs'] = 0.0
+    df.loc[df.index[10], 'carbs'] = 20
+    # Interleave the subjects, so that each chunk has rows of both
+    df = df.sort_index(kind='stable')
+    df.rename_axis('date').reset_index().to_csv(tmp_path / 'input.csv', index=False)
+
+    settings = {'basal': 1, 'isf': 45, 'cr': 12}
+    rows = run_pipeline(tmp_path / 'input.csv', tmp_path / 'output.csv', settings, by='subject_id', chunk_rows=90)
+    assert rows == len(df)
+
+    result = pd.read_csv(tmp_path / 'output.csv', index_col='date', parse_dates=True)
+    expected = add_iob_and_ice(df, by='subject_id', settings=settings, workers=1)
+    for column in ['iob', 'ice']:
+        assert result[column].to_numpy() == pytest.approx(expected[column].to_numpy(), nan_ok=True)
+    assert result['cob'].max() == pytest.approx(20)
+
+
+@requires_native
+def test_compute_chunks_with_subject_skipping_a_chunk():
+    df = pd.concat([get_mock_df().assign(subject_id=subject) for subject in ['a', 'b']]).sort_index(kind='stable')
+    # Subject b has no rows in the second chunk, so its last row in the first chunk is only computed again with the
+    # third chunk
+    dates = df.index.unique()
+    first = df[df.index < dates[80]]
+    second = df[(df.index >= dates[80]) & (df.index < dates[120]) & (df['subject_id'] == 'a')]
+    third = df[(df.index >= dates[120]) | ((df.index >= dates[80]) & (df['subject_id'] == 'b'))].sort_index(
+        kind='stable')
+
+    settings = {'basal': 1, 'isf': 45, 'cr': 12}
+    result = pd.concat(compute_chunks([first, second, third], settings, by='subject_id', outputs=('iob', 'ice')))
+    expected = add_iob_and_ice(pd.concat([first, second, third]), by='subject_id', settings=settings, workers=1)
+    assert result['ice'].notna().sum() == expected['ice'].notna().sum()
+    for column in ['iob', 'ice']:
+        assert result[column].to_numpy() == pytest.approx(expected[column].to_numpy(), nan_ok=True)
+
+
+@requires_native
 def test_percent_absorption_at_percent_time():
     result = percent_absorption_at_percent_time(0.2)
     assert isinstance(result, float)
 
 
+@requires_native
 def test_piecewise_linear_percent_rate_at_percent_time():
     result = piecewise_linear_percent_rate_at_percent_time(0.2)
     assert isinstance(result, float)
 
 
+@requires_native
 def test_linear_percent_rate_at_percent_time():
     result = linear_percent_rate_at_percent_time(0.2)
     assert isinstance(result, float)
 
 
+@requires_native
+def test_absorption_curve_arrays_match_scalar_functions():
+    # Includes the breakpoints of the piecewise linear model and values outside [0, 1]
+    percent_times = np.concatenate([np.linspace(-0.5, 1.5, 201), [0.0, 0.15, 0.5, 1.0]])
+    curves = [
+        (percent_absorption_at_percent_time_array, percent_absorption_at_percent_time),
+        (piecewise_linear_percent_rate_at_percent_time_array, piecewise_linear_percent_rate_at_percent_time),
+        (linear_percent_rate_at_percent_time_array, linear_percent_rate_at_percent_time),
+    ]
+    for array_function, scalar_function in curves:
+        expected = [scalar_function(percent_time) for percent_time in percent_times]
+        np.testing.assert_allclose(array_function(percent_times), expected, rtol=1e-12, atol=1e-15)
+
+
+@requires_native
+def test_insulin_percent_effect_remaining_array_matches_scalar_function():
+    minutes = np.arange(-10, 400, 7.5)
+    for action_duration, peak_activity_time, delay in [(360, 75, 10), (360, 55, 10), (300, 29, 10)]:
+        expected = [insulin_percent_effect_remaining(minute, action_duration, peak_activity_time, delay)
+                    for minute in minutes]
+        result = insulin_percent_effect_remaining_array(minutes, action_duration, peak_activity_time, delay)
+        np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-15)
+
+
 @pytest.mark.skip(reason="Known unit conversion issue: 'g is not compatible with mg/dL·s' - see README.md Known Issues section")
 def test_get_dynamic_carbs_on_board():
     dynamic_carbs_input = get_dynamic_carbs_input()
@@ -128,12 +919,34 @@ def test_get_dynamic_carbs_on_board():
     assert isinstance(dynamic_carbs_on_board, float)
 
 
+@requires_native
+def test_get_dynamic_carbs_on_board_series():
+    dynamic_carbs_input = get_dynamic_carbs_input()
+    values, dates = get_dynamic_carbs_on_board_series(dynamic_carbs_input)
+    assert len(values) == len(dates) > 1
+    assert values[0] == pytest.approx(get_dynamic_carbs_on_board(dynamic_carbs_input))
+    assert (np.diff(dates) == np.timedelta64(5, 'm')).all()
+
+    # Many inputs in one call give the same series as one call per input
+    inputs = [dynamic_carbs_input, dict(dynamic_carbs_input, carbEntries=dynamic_carbs_input['carbEntries'][:1])]
+    for model in ['linear', 'parabolic']:
+        batch = get_dynamic_carbs_on_board_series(inputs, absorption_model=model)
+        assert len(batch) == 2
+        for (batch_values, _), single in zip(batch, inputs):
+            assert batch_values == pytest.approx(get_dynamic_carbs_on_board_series(single, absorption_model=model)[0])
+
+    with pytest.raises(ValueError):
+        get_dynamic_carbs_on_board_series(dynamic_carbs_input, absorption_model='exponential')
+
+
+@requires_native
 def test_get_loop_recommendations():
     loop_algorithm_input = get_loop_algorithm_input()
     loop_recommendations = get_loop_recommendations(loop_algorithm_input)
     assert isinstance(loop_recommendations, str)
 
 
+@requires_native
 @pytest.mark.skipif(platform.system() == "Windows", reason="Windows compatibility issue - test disabled for Windows builds")
 def test_insulin_percent_effect_remaining():
     # Test with typical rapid-acting insulin parameters
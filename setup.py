@@ -21,6 +21,10 @@ setup(
         'numpy',
         'pandas',
     ],
+    extras_require={
+        # Parquet input and output in loop_to_python_api.pipeline
+        'parquet': ['pyarrow'],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: MIT License',